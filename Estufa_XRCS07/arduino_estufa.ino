@@ -45,7 +45,7 @@ void loop() {
   if (Serial.available()) {
     String command = Serial.readStringUntil('\n');
     command.trim();
-
+    bool conhecido = true;
 
     if (command == "toggleIrrigador_ON") {
       digitalWrite(LED1, HIGH);
@@ -64,8 +64,16 @@ void loop() {
     } else if (command == "toggleRefrigerador_OFF") {
       digitalWrite(LED4, LOW);
     } else {
-      Serial.println("Arduino: Comando Desconhecido"); // DEBUG
+      conhecido = false;
+    }
+
+    // Confirma o comando para a borda, que só envia o próximo depois da resposta
+    if (conhecido) {
+      Serial.print("ACK:");
+    } else {
+      Serial.print("NACK:");
     }
+    Serial.println(command);
   }
   Serial.print("LDR:");
   Serial.print(valorLDR);
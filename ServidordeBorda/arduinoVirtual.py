@@ -0,0 +1,281 @@
+import argparse
+import errno
+import math
+import os
+import random
+import select
+import sys
+import time
+import tty
+
+from traceSerial import carregar_trace_serial
+
+
+# Arduino virtual para testar a borda sem a placa.
+# Abre um pseudo-terminal (pty) que fala o mesmo protocolo de arduino_estufa.ino: uma linha
+# "LDR:<0-1023>;UMIDADE:<0|1>;TEMPERATURA:<°C>" por leitura e, para cada comando recebido,
+# "ACK:<comando>" ou "NACK:<comando>". Os toggle*_ON/OFF mudam os atuadores do modelo.
+#
+# Dois modos:
+#   - física (padrão): um modelo simples da estufa (sol ao longo do dia, inércia térmica,
+#     solo secando) reage aos atuadores, então dá para ver o piloto automático fechar o laço;
+#   - replay (--replay): reenvia um trace gravado com SERIAL_GRAVAR_ARQUIVO ou um log simples.
+# --velocidade acelera o tempo simulado nos dois modos (ex.: 10 a 1000 vezes).
+#
+# Exemplos:
+#   python arduinoVirtual.py --link /tmp/ttyEstufa --velocidade 100
+#   ARDUINO_PORT=/tmp/ttyEstufa python borderServer.py
+#   python arduinoVirtual.py --link /tmp/ttyEstufa --replay gravacao.log --velocidade 1000 --repetir
+
+COMANDOS_ATUADORES = {
+    f"toggle{atuador}_{estado}": (atuador, estado == "ON")
+    for atuador in ("Irrigador", "Lampada", "Aquecedor", "Refrigerador")
+    for estado in ("ON", "OFF")
+}
+SAIDA_MAXIMA = 4096  # bytes aguardando o leitor (~100 linhas); acima disso as leituras são descartadas
+LOTE_POR_VOLTA = 1000
+
+
+class ModeloEstufa:
+    # Tempo em segundos simulados. Luz: sol senoidal das 6h às 18h mais a lâmpada.
+    # Temperatura: relaxa para a temperatura externa (mais o ganho do sol) com constante de
+    # tempo CONSTANTE_TERMICA; aquecedor e refrigerador somam/subtraem uma taxa fixa.
+    # Solo: umidade contínua que seca mais rápido no calor; o sensor é binário (1 = seco).
+    CONSTANTE_TERMICA = 900.0
+    TAXA_AQUECEDOR = 0.02      # °C/s
+    TAXA_REFRIGERADOR = 0.03   # °C/s
+    TAXA_IRRIGACAO = 0.005     # fração/s
+    LIMIAR_SECO = 0.35
+
+    def __init__(self, hora_inicial=8.0, temperatura=24.0, umidade_solo=0.5, aleatorio=None):
+        self.relogio = hora_inicial * 3600
+        self.temperatura = temperatura
+        self.umidade_solo = umidade_solo
+        self.atuadores = dict.fromkeys(("Irrigador", "Lampada", "Aquecedor", "Refrigerador"), False)
+        self.aleatorio = aleatorio or random.Random()
+
+    def sol(self):
+        hora = (self.relogio / 3600) % 24
+        return max(0.0, math.sin(math.pi * (hora - 6) / 12))
+
+    def temperatura_externa(self):
+        hora = (self.relogio / 3600) % 24
+        return 22 + 6 * math.sin(math.pi * (hora - 8) / 12)  # pico às 14h
+
+    def avancar(self, dt):
+        self.relogio += dt
+        alvo = self.temperatura_externa() + 5 * self.sol()  # efeito estufa
+        variacao = (alvo - self.temperatura) / self.CONSTANTE_TERMICA
+        if self.atuadores["Aquecedor"]:
+            variacao += self.TAXA_AQUECEDOR
+        if self.atuadores["Refrigerador"]:
+            variacao -= self.TAXA_REFRIGERADOR
+        self.temperatura += variacao * dt
+
+        secagem = 0.00005 + 0.00002 * max(self.temperatura - 20, 0)
+        irrigacao = self.TAXA_IRRIGACAO if self.atuadores["Irrigador"] else 0.0
+        self.umidade_solo = min(1.0, max(0.0, self.umidade_solo + (irrigacao - secagem) * dt))
+
+    def linha(self):
+        ldr = 150 + 750 * self.sol() + (250 if self.atuadores["Lampada"] else 0) + self.aleatorio.gauss(0, 8)
+        ldr = int(min(1023, max(0, ldr)))
+        seco = 1 if self.umidade_solo < self.LIMIAR_SECO else 0
+        temperatura = self.temperatura + self.aleatorio.gauss(0, 0.05)
+        return f"LDR:{ldr};UMIDADE:{seco};TEMPERATURA:{temperatura:.2f}"
+
+    def comando(self, comando):
+        if comando not in COMANDOS_ATUADORES:
+            return False
+        atuador, ligado = COMANDOS_ATUADORES[comando]
+        self.atuadores[atuador] = ligado
+        return True
+
+
+class TraceReplay:
+    # Linhas de um trace no formato de SERIAL_GRAVAR_ARQUIVO, lidas por traceSerial.py (o
+    # mesmo parser do replay da borda). As respostas ACK/NACK são geradas aqui para os
+    # comandos que a borda mandar de verdade.
+    def __init__(self, caminho, repetir=False, intervalo_padrao=0.1):
+        self.repetir = repetir
+        self.atuadores = dict.fromkeys(("Irrigador", "Lampada", "Aquecedor", "Refrigerador"), False)
+        self._linhas = carregar_trace_serial(caminho, intervalo_padrao)
+        if not self._linhas:
+            raise ValueError(f"Trace {caminho} não tem leituras")
+        self._indice = 0
+
+    def proxima(self):
+        # (segundos simulados até a linha, linha) ou None no fim do trace
+        if self._indice >= len(self._linhas):
+            if not self.repetir:
+                return None
+            self._indice = 0
+        item = self._linhas[self._indice]
+        self._indice += 1
+        return item
+
+    def comando(self, comando):
+        if comando not in COMANDOS_ATUADORES:
+            return False
+        atuador, ligado = COMANDOS_ATUADORES[comando]
+        self.atuadores[atuador] = ligado  # só para o status; o trace não muda
+        return True
+
+
+class ArduinoVirtual:
+    # Laço único com select(): emite as leituras no ritmo (tempo simulado / velocidade),
+    # lê os comandos da borda e responde ACK/NACK antes da próxima leitura, como o firmware.
+    # Se a borda não ler, a saída acumula até SAIDA_MAXIMA e depois as leituras são
+    # descartadas (como a serial de verdade, que não espera ninguém).
+    def __init__(self, fonte, velocidade=1.0, intervalo=0.1, link=None, intervalo_status=10.0):
+        self.fonte = fonte
+        self.velocidade = velocidade
+        self.intervalo = intervalo
+        self.intervalo_status = intervalo_status
+        self.mestre, self.escravo = os.openpty()
+        tty.setraw(self.escravo)  # sem eco nem tradução de fim de linha
+        os.set_blocking(self.mestre, False)
+        self.porta = os.ttyname(self.escravo)
+        self.link = link
+        if link:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.porta, link)
+        self._entrada = b""
+        self._saida = bytearray()
+        self.emitidas = 0
+        self.descartadas = 0
+        self.comandos = 0
+        self.recusados = 0
+
+    def _enfileirar(self, linha, obrigatoria=False):
+        if len(self._saida) >= SAIDA_MAXIMA and not obrigatoria:
+            self.descartadas += 1
+            return
+        self._saida += (linha + "\r\n").encode("utf-8")  # Serial.println termina com \r\n
+        self.emitidas += 1
+
+    def _escrever(self):
+        try:
+            escritos = os.write(self.mestre, self._saida)
+            del self._saida[:escritos]
+        except BlockingIOError:
+            pass
+
+    def _ler_comandos(self):
+        try:
+            dados = os.read(self.mestre, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno == errno.EIO:  # nenhum processo com a porta aberta
+                return
+            raise
+        self._entrada += dados
+        while b"\n" in self._entrada:
+            bruta, self._entrada = self._entrada.split(b"\n", 1)
+            comando = bruta.decode("utf-8", errors="ignore").strip()
+            if not comando:
+                continue
+            self.comandos += 1
+            if self.fonte.comando(comando):
+                self._enfileirar(f"ACK:{comando}", obrigatoria=True)
+            else:
+                self.recusados += 1
+                self._enfileirar(f"NACK:{comando}", obrigatoria=True)
+
+    def _proxima_leitura(self):
+        # (segundos reais até emitir, linha) ou None se o trace acabou
+        if isinstance(self.fonte, ModeloEstufa):
+            self.fonte.avancar(self.intervalo)
+            return self.intervalo / self.velocidade, self.fonte.linha()
+        item = self.fonte.proxima()
+        if item is None:
+            return None
+        delta, linha = item
+        return delta / self.velocidade, linha
+
+    def imprimir_status(self):
+        ligados = [nome for nome, ligado in self.fonte.atuadores.items() if ligado] or ["nenhum"]
+        estado = ""
+        if isinstance(self.fonte, ModeloEstufa):
+            hora = (self.fonte.relogio / 3600) % 24
+            estado = (f" | {int(hora):02d}:{int(hora % 1 * 60):02d} simuladas, "
+                      f"temp={self.fonte.temperatura:.1f}°C solo={self.fonte.umidade_solo:.2f}")
+        print(f"Linhas={self.emitidas} descartadas={self.descartadas} comandos={self.comandos} "
+              f"recusados={self.recusados} ligados={','.join(ligados)}{estado}")
+
+    def executar(self):
+        print(f"Arduino virtual em {self.porta}" + (f" (link {self.link})" if self.link else ""))
+        proxima = self._proxima_leitura()
+        emitir_em = time.monotonic()
+        status_em = time.monotonic() + self.intervalo_status
+        try:
+            while proxima is not None or self._saida:
+                agora = time.monotonic()
+                if proxima is not None and agora >= emitir_em:
+                    # Em velocidades altas emite tudo o que já venceu de uma vez (até um lote
+                    # por volta, para não deixar de atender os comandos)
+                    for _ in range(LOTE_POR_VOLTA):
+                        if proxima is None or agora < emitir_em:
+                            break
+                        self._enfileirar(proxima[1])
+                        proxima = self._proxima_leitura()
+                        if proxima is not None:
+                            emitir_em += proxima[0]
+                    if emitir_em < agora - 1:
+                        emitir_em = agora  # leitor lento: não tenta recuperar o atraso
+                if self._saida:
+                    self._escrever()
+                if agora >= status_em:
+                    self.imprimir_status()
+                    status_em = agora + self.intervalo_status
+                espera = max(0.0, min(emitir_em - time.monotonic(), status_em - time.monotonic()))
+                if proxima is None:
+                    espera = 0.05
+                escrita = [self.mestre] if self._saida else []
+                select.select([self.mestre], escrita, [], espera)
+                self._ler_comandos()
+            print("Fim do trace.")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.imprimir_status()
+            self.fechar()
+
+    def fechar(self):
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.mestre)
+        os.close(self.escravo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Arduino virtual da estufa em um pseudo-terminal")
+    parser.add_argument("--link", help="cria um link simbólico para a porta (ex.: /tmp/ttyEstufa)")
+    parser.add_argument("--velocidade", type=float, default=1.0,
+                        help="fator de aceleração do tempo simulado (ex.: 10 a 1000)")
+    parser.add_argument("--intervalo", type=float, default=0.1,
+                        help="segundos simulados entre leituras no modo física")
+    parser.add_argument("--replay", help="trace a reenviar (formato de SERIAL_GRAVAR_ARQUIVO)")
+    parser.add_argument("--repetir", action="store_true", help="recomeça o trace ao chegar no fim")
+    parser.add_argument("--hora-inicial", type=float, default=8.0, help="hora do dia simulada no início")
+    parser.add_argument("--temperatura-inicial", type=float, default=24.0)
+    parser.add_argument("--semente", type=int, help="semente do ruído dos sensores")
+    parser.add_argument("--intervalo-status", type=float, default=10.0, help="segundos reais entre os status")
+    args = parser.parse_args()
+    if args.velocidade <= 0 or args.intervalo <= 0:
+        parser.error("--velocidade e --intervalo devem ser positivos")
+
+    if args.replay:
+        try:
+            fonte = TraceReplay(args.replay, args.repetir, args.intervalo)
+        except (OSError, ValueError) as e:
+            print(f"Não foi possível carregar o trace: {e}")
+            sys.exit(1)
+    else:
+        fonte = ModeloEstufa(args.hora_inicial, args.temperatura_inicial, aleatorio=random.Random(args.semente))
+    ArduinoVirtual(fonte, args.velocidade, args.intervalo, args.link, args.intervalo_status).executar()
+
+
+if __name__ == '__main__':
+    main()
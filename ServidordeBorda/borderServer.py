@@ -1,11 +1,22 @@
 import time
 import datetime
 import pytz
-from threading import Thread
+from threading import Thread, Lock, RLock, Event, Condition
+from collections import namedtuple, deque
+from array import array
 import serial
 from dotenv import load_dotenv
 import os
+import json
+import queue
+import random
+import sqlite3
+import traceback
 import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from traceSerial import carregar_trace_serial
 
 load_dotenv()  # Carrega .env do diretório do script de borda
 
@@ -14,28 +25,279 @@ ARDUINO_PORT = os.getenv("ARDUINO_PORT", '/dev/ttyACM0')  # Pega do .env ou usa
 BAUD_RATE = 9600
 CLOUD_API_LEITURAS_SNAPSHOT = os.getenv("CLOUD_API_ENDPOINT_LEITURAS") 
 CLOUD_API_LEITURAS_LIVE = os.getenv("CLOUD_API_ENDPOINT_LIVE_UPDATE") 
+CLOUD_API_LEITURAS_BATCH = os.getenv("CLOUD_API_ENDPOINT_LEITURAS_BATCH") or \
+    (CLOUD_API_LEITURAS_SNAPSHOT.rstrip('/') + '/batch' if CLOUD_API_LEITURAS_SNAPSHOT else None)
 CLOUD_API_COMANDOS = os.getenv("CLOUD_API_ENDPOINT_COMANDOS")
+CLOUD_API_COMANDOS_AGUARDAR = os.getenv("CLOUD_API_ENDPOINT_COMANDOS_AGUARDAR") or \
+    (CLOUD_API_COMANDOS.rstrip('/') + '/aguardar' if CLOUD_API_COMANDOS else None)
+CLOUD_API_COMANDOS_ACK = os.getenv("CLOUD_API_ENDPOINT_COMANDOS_ACK") or \
+    (CLOUD_API_COMANDOS.rstrip('/') + '/ack' if CLOUD_API_COMANDOS else None)
+COMANDOS_LONGPOLL_TIMEOUT = float(os.getenv("COMANDOS_LONGPOLL_TIMEOUT", 25))
 DEVICE_ID = os.getenv("DEVICE_ID", "minhaEstufa01")
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "outbox_snapshots.db"))
+OUTBOX_LOTE_MAXIMO = int(os.getenv("OUTBOX_LOTE_MAXIMO", 50))
+OUTBOX_BACKOFF_MAXIMO = float(os.getenv("OUTBOX_BACKOFF_MAXIMO", 300))
+# Modo replay: lê um log serial gravado no lugar do Arduino (teste de carga sem hardware)
+SERIAL_REPLAY_ARQUIVO = os.getenv("SERIAL_REPLAY_ARQUIVO")
+SERIAL_REPLAY_VELOCIDADE = float(os.getenv("SERIAL_REPLAY_VELOCIDADE", 1))
+SERIAL_REPLAY_INTERVALO = float(os.getenv("SERIAL_REPLAY_INTERVALO", 0.1))  # para linhas sem tempo gravado
+SERIAL_REPLAY_REPETIR = os.getenv("SERIAL_REPLAY_REPETIR", "0") == "1"
+SERIAL_GRAVAR_ARQUIVO = os.getenv("SERIAL_GRAVAR_ARQUIVO")  # grava as linhas recebidas para replay
+LEITURAS_FILA_TAMANHO = int(os.getenv("LEITURAS_FILA_TAMANHO", 100))
+AMOSTRAS_BUFFER_TAMANHO = int(os.getenv("AMOSTRAS_BUFFER_TAMANHO", 600))  # leituras recentes mantidas na borda
+# Piloto automático: bandas de histerese e permanência mínima ("on,off" em segundos) por atuador
+HISTERESE_TEMP = float(os.getenv("HISTERESE_TEMP", 1.0))
+HISTERESE_LUZ = float(os.getenv("HISTERESE_LUZ", 50))
+
+
+def ler_permanencia(atuador, on_padrao, off_padrao):
+    valor = os.getenv(f"PERMANENCIA_{atuador.upper()}")
+    if not valor:
+        return on_padrao, off_padrao
+    on, _, off = valor.partition(',')
+    return float(on), float(off or on)
+
+
+PERMANENCIA_MINIMA = {
+    "Irrigador": ler_permanencia("Irrigador", 10, 30),
+    "Lampada": ler_permanencia("Lampada", 60, 60),
+    "Aquecedor": ler_permanencia("Aquecedor", 60, 60),
+    "Refrigerador": ler_permanencia("Refrigerador", 60, 60),
+}
+
+# Filtro por exceção dos live updates. FILTRO_LIVE (JSON) sobrescreve o padrão, no mesmo
+# formato aceito pelo comando set_filtro vindo da nuvem
+FILTRO_HEARTBEAT_SEGUNDOS = float(os.getenv("FILTRO_HEARTBEAT_SEGUNDOS", 30))  # silêncio máximo
+FILTRO_INTERVALO_MINIMO = float(os.getenv("FILTRO_INTERVALO_MINIMO", 0.5))  # intervalo mínimo entre envios
+FILTRO_LIVE = os.getenv("FILTRO_LIVE")
+# Telemetria: endpoint HTTP local de status (STATUS_PORTA=0 desliga) e intervalo do watchdog
+STATUS_HOST = os.getenv("STATUS_HOST", "127.0.0.1")  # endpoint sem autenticação: use 0.0.0.0 só se precisar
+STATUS_PORTA = int(os.getenv("STATUS_PORTA", 8081))
+WATCHDOG_INTERVALO = float(os.getenv("WATCHDOG_INTERVALO", 5))
+ESPERA_BATIMENTO = 5  # threads que esperam por dados acordam ao menos a cada 5s para dar sinal de vida
+COMANDO_ACK_TIMEOUT = float(os.getenv("COMANDO_ACK_TIMEOUT", 3))  # espera pelo ACK do Arduino (firmware antigo não responde)
 
 print(f"--- Configurações servidor_borda.py ---")
 print(f"ARDUINO_PORT: {ARDUINO_PORT}")
 print(f"CLOUD_API_ENDPOINT_LEITURAS (Snapshot/MongoDB): {CLOUD_API_LEITURAS_SNAPSHOT}")
 print(f"CLOUD_API_ENDPOINT_LIVE_UPDATE (Cliente): {CLOUD_API_LEITURAS_LIVE}") 
+print(f"CLOUD_API_ENDPOINT_LEITURAS_BATCH (Outbox): {CLOUD_API_LEITURAS_BATCH}")
 print(f"CLOUD_API_ENDPOINT_COMANDOS: {CLOUD_API_COMANDOS}")
+print(f"CLOUD_API_ENDPOINT_COMANDOS_AGUARDAR (Long-poll): {CLOUD_API_COMANDOS_AGUARDAR}")
 print(f"DEVICE_ID: {DEVICE_ID}")
+print(f"OUTBOX_PATH: {OUTBOX_PATH}")
+if SERIAL_REPLAY_ARQUIVO:
+    print(f"SERIAL_REPLAY_ARQUIVO: {SERIAL_REPLAY_ARQUIVO} (velocidade {SERIAL_REPLAY_VELOCIDADE}x)")
 print(f"-------------------------------------")
 
+# --- Cliente HTTP compartilhado para a nuvem ---
+# Uma única requests.Session com pool de conexões e keep-alive para todo o tráfego
+# borda -> nuvem. Cada classe de endpoint tem seu timeout e sua política de retry:
+#  - live: descartável (a próxima leitura substitui), não repete
+#  - snapshot: o outbox já reenvia com backoff, só repete falhas de conexão
+#  - comandos: repete falhas de conexão e 502/503/504
+POLITICAS_HTTP = {
+    "live": {"timeout": (3, 5), "retry": Retry(total=0, raise_on_status=False)},
+    "snapshot": {"timeout": (5, 15), "retry": Retry(total=2, connect=2, read=0, status=0, backoff_factor=1)},
+    "comandos": {"timeout": (3, 5), "retry": Retry(total=3, connect=3, read=0, status=2, backoff_factor=0.5,
+                                                   status_forcelist=(502, 503, 504), raise_on_status=False)},
+}
+HTTP_POOL_TAMANHO = int(os.getenv("HTTP_POOL_TAMANHO", 4))
+
+
+class ClienteNuvem:
+    def __init__(self):
+        self.sessao = requests.Session()
+        self.sessao.headers.update({"Connection": "keep-alive", "X-Device-Id": DEVICE_ID})
+        self._lock = Lock()
+        self._metricas = {classe: {"requisicoes": 0, "erros": 0, "latencia_total_ms": 0.0,
+                                   "latencia_max_ms": 0.0, "latencia_ultima_ms": 0.0}
+                          for classe in POLITICAS_HTTP}
+
+    def registrar_endpoint(self, classe, url):
+        # O adapter é montado pelo prefixo da URL, então /api/leituras também cobre /api/leituras/batch
+        if not url:
+            return
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_TAMANHO,
+                              max_retries=POLITICAS_HTTP[classe]["retry"])
+        self.sessao.mount(url, adapter)
+
+    def requisitar(self, classe, metodo, url, **kwargs):
+        kwargs.setdefault("timeout", POLITICAS_HTTP[classe]["timeout"])
+        inicio = time.perf_counter()
+        erro = True
+        try:
+            response = self.sessao.request(metodo, url, **kwargs)
+            erro = response.status_code >= 400
+            return response
+        finally:
+            self._registrar(classe, (time.perf_counter() - inicio) * 1000, erro)
+
+    def post(self, classe, url, **kwargs):
+        return self.requisitar(classe, "POST", url, **kwargs)
+
+    def get(self, classe, url, **kwargs):
+        return self.requisitar(classe, "GET", url, **kwargs)
+
+    def _registrar(self, classe, latencia_ms, erro):
+        with self._lock:
+            m = self._metricas[classe]
+            m["requisicoes"] += 1
+            m["erros"] += int(erro)
+            m["latencia_total_ms"] += latencia_ms
+            m["latencia_ultima_ms"] = latencia_ms
+            m["latencia_max_ms"] = max(m["latencia_max_ms"], latencia_ms)
+
+    def estatisticas(self):
+        with self._lock:
+            return {classe: dict(m, latencia_media_ms=(m["latencia_total_ms"] / m["requisicoes"]
+                                                       if m["requisicoes"] else 0.0))
+                    for classe, m in self._metricas.items()}
+
+
+cliente_nuvem = ClienteNuvem()
+cliente_nuvem.registrar_endpoint("live", CLOUD_API_LEITURAS_LIVE)
+cliente_nuvem.registrar_endpoint("snapshot", CLOUD_API_LEITURAS_BATCH)
+cliente_nuvem.registrar_endpoint("comandos", CLOUD_API_COMANDOS)
+
+
+# --- Telemetria da borda ---
+# Cada thread chama telemetria.batimento(nome, duracao) a cada volta do seu loop; os
+# contadores (linhas da serial etc.) guardam o total e a taxa no último minuto.
+class TaxaPorSegundo:
+    # Baldes de 1s em uma janela deslizante; o chamador segura o lock
+    def __init__(self, janela=60):
+        self.janela = janela
+        self.total = 0
+        self._baldes = [0] * janela
+        self._segundos = [-1] * janela
+
+    def incrementar(self, agora):
+        segundo = int(agora)
+        i = segundo % self.janela
+        if self._segundos[i] != segundo:
+            self._segundos[i] = segundo
+            self._baldes[i] = 0
+        self._baldes[i] += 1
+        self.total += 1
+
+    def taxa(self, agora):
+        limite = int(agora) - self.janela
+        return sum(balde for balde, segundo in zip(self._baldes, self._segundos) if segundo > limite) / self.janela
+
+
+class TelemetriaBorda:
+    def __init__(self):
+        self._lock = Lock()
+        self.iniciado_em = time.monotonic()
+        self._threads = {}
+        self._contadores = {}
+
+    def batimento(self, nome, duracao=None):
+        agora = time.monotonic()
+        with self._lock:
+            t = self._threads.setdefault(nome, {"ultimo_batimento": agora, "iteracoes": 0, "loop_ms_ultimo": 0.0,
+                                                "loop_ms_max": 0.0, "loop_ms_total": 0.0})
+            t["ultimo_batimento"] = agora
+            if duracao is not None:
+                ms = duracao * 1000
+                t["iteracoes"] += 1
+                t["loop_ms_ultimo"] = ms
+                t["loop_ms_max"] = max(t["loop_ms_max"], ms)
+                t["loop_ms_total"] += ms
+
+    def contar(self, nome):
+        with self._lock:
+            self._contadores.setdefault(nome, TaxaPorSegundo()).incrementar(time.monotonic())
+
+    def threads(self):
+        agora = time.monotonic()
+        with self._lock:
+            return {nome: {"segundos_desde_batimento": round(agora - t["ultimo_batimento"], 1),
+                           "iteracoes": t["iteracoes"],
+                           "loop_ms_ultimo": round(t["loop_ms_ultimo"], 2),
+                           "loop_ms_max": round(t["loop_ms_max"], 2),
+                           "loop_ms_medio": round(t["loop_ms_total"] / t["iteracoes"], 2) if t["iteracoes"] else 0.0}
+                    for nome, t in self._threads.items()}
+
+    def contadores(self):
+        agora = time.monotonic()
+        with self._lock:
+            return {nome: {"total": c.total, "por_segundo": round(c.taxa(agora), 2)}
+                    for nome, c in self._contadores.items()}
+
+    def uptime(self):
+        return time.monotonic() - self.iniciado_em
+
+
+telemetria = TelemetriaBorda()
+
 # Tempo #
 br_tz = pytz.timezone("America/Sao_Paulo")
 
-# Conexão com Arduino
-try:
-    arduino = serial.Serial(ARDUINO_PORT, BAUD_RATE, timeout=1)
-    print(f"Conectado ao Arduino em {ARDUINO_PORT}")
-    time.sleep(2)  # Aguarda a serial estabilizar
-except serial.SerialException as e:
-    print(f"Erro ao conectar com Arduino em {ARDUINO_PORT}: {e}")
-    arduino = None  # Define arduino como None se a conexão falhar
+
+
+# --- Replay de log serial ---
+# Imita a interface de serial.Serial usada aqui (readline/write/is_open/close) lendo um
+# arquivo gravado. Linhas "<epoch>\t<linha>" (formato de SERIAL_GRAVAR_ARQUIVO) são
+# reproduzidas com o intervalo original dividido pela velocidade; linhas sem tempo usam
+# SERIAL_REPLAY_INTERVALO (o formato é lido por traceSerial.py, o mesmo do arduinoVirtual.py).
+# Os comandos escritos são registrados e respondidos com ACK/NACK como o firmware.
+class SerialReplay:
+    def __init__(self, caminho, velocidade=1.0, repetir=False, intervalo_padrao=0.1):
+        self.linhas = carregar_trace_serial(caminho, intervalo_padrao)
+        self.velocidade = max(velocidade, 1e-6)
+        self.repetir = repetir
+        self.posicao = 0
+        self.comandos_escritos = []
+        self._respostas = deque()
+        self.is_open = True
+
+    def readline(self):
+        if self._respostas:
+            return self._respostas.popleft()
+        if self.posicao >= len(self.linhas):
+            if not (self.repetir and self.linhas):
+                time.sleep(1)  # Fim do log: se comporta como o timeout da serial
+                return b''
+            self.posicao = 0
+        intervalo, linha = self.linhas[self.posicao]
+        self.posicao += 1
+        if intervalo:
+            time.sleep(intervalo / self.velocidade)
+        return (linha + '\n').encode('utf-8')
+
+    def write(self, dados):
+        comando = dados.decode('utf-8', errors='ignore').strip()
+        self.comandos_escritos.append(comando)
+        # Responde como o firmware: ACK para os toggles conhecidos, NACK para o resto
+        atuador, _, estado = comando.replace("toggle", "", 1).partition('_')
+        conhecido = comando.startswith("toggle") and atuador in MAPA_ATUADORES and estado in ('ON', 'OFF')
+        self._respostas.append(f"{'ACK' if conhecido else 'NACK'}:{comando}\n".encode('utf-8'))
+        return len(dados)
+
+    def close(self):
+        self.is_open = False
+
+
+# Conexão com Arduino (ou com o log de replay)
+if SERIAL_REPLAY_ARQUIVO:
+    try:
+        arduino = SerialReplay(SERIAL_REPLAY_ARQUIVO, SERIAL_REPLAY_VELOCIDADE,
+                               SERIAL_REPLAY_REPETIR, SERIAL_REPLAY_INTERVALO)
+        print(f"Replay serial de {SERIAL_REPLAY_ARQUIVO} ({len(arduino.linhas)} linhas)")
+    except OSError as e:
+        print(f"Erro ao abrir log de replay {SERIAL_REPLAY_ARQUIVO}: {e}")
+        arduino = None
+else:
+    try:
+        # timeout=1: readline() bloqueia no read da porta (sem busy-wait) por até 1s
+        arduino = serial.Serial(ARDUINO_PORT, BAUD_RATE, timeout=1)
+        print(f"Conectado ao Arduino em {ARDUINO_PORT}")
+        time.sleep(2)  # Aguarda a serial estabilizar
+    except serial.SerialException as e:
+        print(f"Erro ao conectar com Arduino em {ARDUINO_PORT}: {e}")
+        arduino = None  # Define arduino como None se a conexão falhar
 
 # --- Variáveis Globais da Borda ---
 limiteTemp = 30
@@ -58,27 +320,55 @@ estado_atuadores = {
 }
 auto_mode = False  # Estado do piloto automático
 
-command_buffer = []  # Buffer de comandos recebidos da nuvem
-
-# Últimas leituras brutas dos sensores (atualizado por publish_sensor_data)
-sensor_data = {
-    'readLuminosidade': None,
-    'readUmidade': None,
-    'readTemperatura': None
+# Nome do atuador nos comandos toggle<Nome>_<ON|OFF> -> chave em estado_atuadores
+MAPA_ATUADORES = {
+    "Irrigador": "estadoIrrigador",
+    "Lampada": "estadoLampada",
+    "Aquecedor": "estadoAquecedor",
+    "Refrigerador": "estadoRefrigerador"
 }
 
-# Variáveis para lógica de filtragem de dados em publish_sensor_data
-last_processed_luminosidade = None
-last_processed_umidade = None
-last_processed_temperatura = None
-first_reading_processed = False
 
+# --- Outbox local dos snapshots (store-and-forward) ---
+# Todo snapshot é gravado primeiro em um SQLite local. A thread drenar_outbox_para_nuvem
+# envia em lotes e só apaga depois que a nuvem confirma, então nada se perde se a
+# conexão cair ou o servidor de borda reiniciar.
+class OutboxSnapshots:
+    def __init__(self, caminho):
+        self._lock = Lock()
+        self.novo_item = Event()
+        self._conn = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, criado_em REAL NOT NULL)")
 
-def enviar_leitura_para_nuvem_snapshot(luminosidade, umidade, temperatura, atuadores_contagem):
-    if not CLOUD_API_LEITURAS_SNAPSHOT:
-        print("URL da API para SNAPSHOT (CLOUD_API_ENDPOINT_LEITURAS) não configurada.")
-        return
+    def adicionar(self, payload):
+        with self._lock:
+            self._conn.execute("INSERT INTO outbox (payload, criado_em) VALUES (?, ?)",
+                               (json.dumps(payload), time.time()))
+        self.novo_item.set()
 
+    def proximo_lote(self, limite):
+        with self._lock:
+            linhas = self._conn.execute("SELECT id, payload FROM outbox ORDER BY id LIMIT ?", (limite,)).fetchall()
+        return [(id_linha, json.loads(payload)) for id_linha, payload in linhas]
+
+    def confirmar(self, ids):
+        if not ids:
+            return
+        with self._lock:
+            self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+
+    def tamanho(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+
+outbox_snapshots = OutboxSnapshots(OUTBOX_PATH)
+
+
+def enviar_leitura_para_nuvem_snapshot(luminosidade, umidade, temperatura, atuadores_contagem, janela=None):
     payload = {
         "device_id": DEVICE_ID,
         "timestamp": datetime.datetime.now(br_tz).isoformat(),
@@ -88,14 +378,59 @@ def enviar_leitura_para_nuvem_snapshot(luminosidade, umidade, temperatura, atuad
         "irrigador_times_on": atuadores_contagem.get("irrigador", 0),
         "lampada_times_on": atuadores_contagem.get("lampada", 0),
         "aquecedor_times_on": atuadores_contagem.get("aquecedor", 0),
-        "refrigerador_times_on": atuadores_contagem.get("refrigerador", 0)
+        "refrigerador_times_on": atuadores_contagem.get("refrigerador", 0),
+        "telemetria": resumo_telemetria_compacto()
     }
+    if janela:
+        payload.update(janela)  # estatísticas da janela e tempo ligado dos atuadores
+    # Grava no outbox; o envio para a nuvem é feito pela thread drenar_outbox_para_nuvem
+    outbox_snapshots.adicionar(payload)
+    print(f"SNAPSHOT gravado no outbox local ({outbox_snapshots.tamanho()} pendentes).")
+
+
+def enviar_lote_snapshots(payloads):
+    # Retorna True se a nuvem confirmou o lote (mesmo com itens rejeitados por serem inválidos)
     try:
-        response = requests.post(CLOUD_API_LEITURAS_SNAPSHOT, json=payload, timeout=10)
+        response = cliente_nuvem.post("snapshot", CLOUD_API_LEITURAS_BATCH, json=payloads)
+        if response.status_code == 400:
+            # Lote inteiro inválido: reenviar não adianta, descarta para não travar o outbox
+            print(f"Lote de SNAPSHOTS rejeitado pela nuvem e descartado: {response.text}")
+            return True
         response.raise_for_status()
-        print(f"SNAPSHOT enviado para MongoDB via nuvem ({CLOUD_API_LEITURAS_SNAPSHOT}): {response.status_code}")
-    except requests.exceptions.RequestException as e:
-        print(f"Erro ao enviar SNAPSHOT para nuvem ({CLOUD_API_LEITURAS_SNAPSHOT}): {e}")
+        rejeitadas = response.json().get("rejeitadas", [])
+        if rejeitadas:
+            print(f"Nuvem rejeitou {len(rejeitadas)} SNAPSHOTS inválidos: {rejeitadas}")
+        print(f"{len(payloads)} SNAPSHOTS enviados para MongoDB via nuvem ({CLOUD_API_LEITURAS_BATCH}): {response.status_code}")
+        return True
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Erro ao enviar lote de SNAPSHOTS para nuvem ({CLOUD_API_LEITURAS_BATCH}): {e}")
+        return False
+
+
+def drenar_outbox_para_nuvem():
+    if not CLOUD_API_LEITURAS_BATCH:
+        print("URL da API para SNAPSHOT (CLOUD_API_ENDPOINT_LEITURAS) não configurada. Snapshots ficarão no outbox.")
+        return
+    backoff = 0
+    while True:
+        telemetria.batimento("drenar_outbox_para_nuvem")
+        lote = outbox_snapshots.proximo_lote(OUTBOX_LOTE_MAXIMO)
+        if not lote:
+            outbox_snapshots.novo_item.wait(timeout=60)
+            outbox_snapshots.novo_item.clear()
+            continue
+        inicio = time.perf_counter()
+        confirmado = enviar_lote_snapshots([payload for _, payload in lote])
+        telemetria.batimento("drenar_outbox_para_nuvem", time.perf_counter() - inicio)
+        if confirmado:
+            outbox_snapshots.confirmar([id_linha for id_linha, _ in lote])
+            backoff = 0
+        else:
+            # Backoff exponencial com jitter até OUTBOX_BACKOFF_MAXIMO
+            backoff = min(OUTBOX_BACKOFF_MAXIMO, backoff * 2 if backoff else 2)
+            espera = random.uniform(backoff / 2, backoff)
+            print(f"Outbox com {outbox_snapshots.tamanho()} SNAPSHOTS pendentes. Nova tentativa em {espera:.0f}s.")
+            time.sleep(espera)
 
 def enviar_leitura_live_para_nuvem(luminosidade, umidade, temperatura, estado_atual_atuadores):
     if not CLOUD_API_LEITURAS_LIVE:
@@ -114,7 +449,7 @@ def enviar_leitura_live_para_nuvem(luminosidade, umidade, temperatura, estado_at
         "estado_atuadores": estado_atual_atuadores # Envia o dicionário completo de estados ON/OFF
     }
     try:
-        response = requests.post(CLOUD_API_LEITURAS_LIVE, json=payload, timeout=5) # Timeout menor para live
+        response = cliente_nuvem.post("live", CLOUD_API_LEITURAS_LIVE, json=payload) # Timeout menor para live
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f"Erro ao enviar LEITURA LIVE para nuvem ({CLOUD_API_LEITURAS_LIVE}): {e}")
@@ -125,28 +460,28 @@ def enviar_snapshot_para_nuvem():
     global irrigadorSwitch_count, lampadaSwitch_count, aquecedorSwitch_count, refrigeradorSwitch_count
     while True:
         time.sleep(300) # Mantém o envio periódico para o MongoDB
-        # lógica para pegar temp, umi, lum de sensor_data
+        inicio = time.perf_counter()
+        # Fecha a janela: o resumo cobre todas as leituras desde o último snapshot.
+        # Sem leituras a janela continua aberta, para não perder o tempo ligado dos atuadores
+        # (os contadores de acionamento também seguem para o próximo snapshot).
         try:
-            temp_raw_ts = sensor_data.get('readTemperatura')
-            umi_raw_ts = sensor_data.get('readUmidade')
-            lum_raw_ts = sensor_data.get('readLuminosidade')
-
-            if temp_raw_ts and umi_raw_ts and lum_raw_ts:
-                temperatura = float(temp_raw_ts.split('-')[0])
-                umidade = int(umi_raw_ts.split('-')[0])
-                luminosidade = float(lum_raw_ts.split('-')[0])
-
+            if agregador_janela.completa():
+                janela = agregador_janela.fechar()
+                ultima = estado_sensores.ultima()
                 atuadores_contagem_atual = {
                     "irrigador": irrigadorSwitch_count, "lampada": lampadaSwitch_count,
                     "aquecedor": aquecedorSwitch_count, "refrigerador": refrigeradorSwitch_count
                 }
-                enviar_leitura_para_nuvem_snapshot(luminosidade, umidade, temperatura, atuadores_contagem_atual)
+                # Os campos principais continuam sendo a última leitura
+                enviar_leitura_para_nuvem_snapshot(ultima.luminosidade, int(ultima.umidade),
+                                                   ultima.temperatura, atuadores_contagem_atual, janela)
 
                 irrigadorSwitch_count = 0; lampadaSwitch_count = 0; aquecedorSwitch_count = 0; refrigeradorSwitch_count = 0
             else:
                 print("Dados dos sensores incompletos para envio de SNAPSHOT à nuvem.")
         except Exception as e:
             print(f"Erro na thread de enviar_snapshot_para_nuvem: {e}")
+        telemetria.batimento("enviar_snapshot_para_nuvem", time.perf_counter() - inicio)
 
 
 def buscar_comandos_da_nuvem():
@@ -154,11 +489,11 @@ def buscar_comandos_da_nuvem():
         print("URL da API para comandos (CLOUD_API_ENDPOINT_COMANDOS) não configurada.")
         return None
     try:
-        params = {'device_id': DEVICE_ID}
-        response = requests.get(CLOUD_API_COMANDOS, params=params, timeout=5)
+        params = {'device_id': DEVICE_ID, 'ack': 1}
+        response = cliente_nuvem.get("comandos", CLOUD_API_COMANDOS, params=params)
         response.raise_for_status()
         comandos = response.json()
-        if comandos:  # A API deve retornar uma lista de strings de comando
+        if comandos:  # A API retorna uma lista de {"id", "comando"} quando pedimos ack
             print(f"Comandos recebidos da nuvem: {comandos}")
             return comandos
     except requests.exceptions.RequestException as e:
@@ -168,259 +503,956 @@ def buscar_comandos_da_nuvem():
             f"Erro ao decodificar JSON da resposta de comandos. Conteúdo: {response.text if 'response' in locals() else 'N/A'}")
     return None
 
+def aguardar_comandos_da_nuvem():
+    # Long-poll: a nuvem segura a conexão até ter comando. Retorna (comandos, conexão_ok)
+    try:
+        params = {'device_id': DEVICE_ID, 'timeout': COMANDOS_LONGPOLL_TIMEOUT, 'ack': 1}
+        response = cliente_nuvem.get("comandos", CLOUD_API_COMANDOS_AGUARDAR, params=params,
+                                     timeout=(3, COMANDOS_LONGPOLL_TIMEOUT + 10))
+        response.raise_for_status()
+        comandos = response.json()
+        if comandos:
+            print(f"Comandos recebidos da nuvem (long-poll): {comandos}")
+        return comandos, True
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Erro no long-poll de comandos ({CLOUD_API_COMANDOS_AGUARDAR}): {e}")
+        return None, False
+
+
+def confirmar_comandos_na_nuvem(ids):
+    # Sem a confirmação a nuvem reentrega os comandos quando o lease expirar
+    if not ids or not CLOUD_API_COMANDOS_ACK:
+        return
+    try:
+        response = cliente_nuvem.post("comandos", CLOUD_API_COMANDOS_ACK, json={'device_id': DEVICE_ID, 'ids': ids})
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Erro ao confirmar comandos na nuvem ({CLOUD_API_COMANDOS_ACK}): {e}")
+
+
+def adicionar_comandos_ao_buffer(novos_comandos):
+    global auto_mode
+    if novos_comandos and isinstance(novos_comandos, list):
+        ids_recebidos = []
+        for cmd_item in novos_comandos:  
+            # Desembrulha o envelope {"id", "comando"} das entregas com ack
+            if isinstance(cmd_item, dict) and 'id' in cmd_item and 'comando' in cmd_item:
+                ids_recebidos.append(cmd_item['id'])
+                cmd_item = cmd_item['comando']
+            if isinstance(cmd_item, str):
+                print(f"Adicionando comando de string ao buffer: {cmd_item}")
+                agendador_comandos.adicionar(cmd_item)
+            elif isinstance(cmd_item, dict) and 'command' in cmd_item:
+                comando_principal = cmd_item['command']
+                if comando_principal == 'set_auto_mode':
+                    auto_mode = cmd_item.get('value', False)
+                    estado_atuadores['estadoPilotoAutomatico'] = 'ON' if auto_mode else 'OFF'
+                    print(f"Piloto automático (borda) definido para: {auto_mode}")
+                elif comando_principal == 'set_filtro':
+                    try:
+                        filtro_live.configurar(cmd_item.get('value') or {})
+                        print(f"Filtro dos live updates reconfigurado pela nuvem: {cmd_item.get('value')}")
+                    except (ValueError, TypeError, AttributeError) as e:
+                        print(f"Configuração de filtro inválida recebida da nuvem: {e}")
+                else:
+                    print(f"Adicionando comando de dict ao buffer: {comando_principal}")
+                    agendador_comandos.adicionar(comando_principal)
+        confirmar_comandos_na_nuvem(ids_recebidos)
+
+
 #Pool de comandos para o Arduino
+# Usa o long-poll quando disponível; se a conexão cair, volta ao polling de 10s
+# por um minuto antes de tentar o long-poll de novo.
 def command_poller_thread():
+    retomar_longpoll_em = 0
     while True:
-        novos_comandos = buscar_comandos_da_nuvem()
-        if novos_comandos and isinstance(novos_comandos, list):
-            for cmd_item in novos_comandos:  
-                if isinstance(cmd_item, str):
-                    print(f"Adicionando comando de string ao buffer: {cmd_item}")
-                    command_buffer.append(cmd_item)
-                elif isinstance(cmd_item, dict) and 'command' in cmd_item:
-                    comando_principal = cmd_item['command']
-                    if comando_principal == 'set_auto_mode':
-                        global auto_mode  
-                        auto_mode = cmd_item.get('value', False)
-                        estado_atuadores['estadoPilotoAutomatico'] = 'ON' if auto_mode else 'OFF'
-                        print(f"Piloto automático (borda) definido para: {auto_mode}")
-                    else:
-                        print(f"Adicionando comando de dict ao buffer: {comando_principal}")
-                        command_buffer.append(comando_principal)
+        inicio = time.perf_counter()
+        if CLOUD_API_COMANDOS_AGUARDAR and time.monotonic() >= retomar_longpoll_em:
+            novos_comandos, conexao_ok = aguardar_comandos_da_nuvem()
+            adicionar_comandos_ao_buffer(novos_comandos)
+            if not conexao_ok:
+                print("Long-poll de comandos indisponível. Usando polling pelos próximos 60s.")
+                retomar_longpoll_em = time.monotonic() + 60
+            telemetria.batimento("command_poller_thread", time.perf_counter() - inicio)
+            continue
+        adicionar_comandos_ao_buffer(buscar_comandos_da_nuvem())
+        telemetria.batimento("command_poller_thread", time.perf_counter() - inicio)
         time.sleep(10)
 
 
 # --- Lógica do Arduino e Atuadores ---
-def publish_sensor_data():
-    global last_processed_luminosidade, last_processed_umidade, last_processed_temperatura
-    global first_reading_processed, sensor_data, estado_atuadores  # Adicionado estado_atuadores aqui
+# Leitura já convertida de uma linha da serial. monotonic serve para medir idade/intervalos.
+Leitura = namedtuple("Leitura", ["luminosidade", "umidade", "temperatura", "horario", "monotonic"])
 
-    if not arduino:
-        print("Arduino não conectado. Thread publish_sensor_data não pode iniciar.")
+
+def interpretar_linha_serial(linha):
+    # "LDR:512;UMIDADE:1;TEMPERATURA:23.50" -> Leitura. Qualquer outra linha -> None
+    dados_arduino = {}
+    for parte in linha.split(';'):
+        chave, separador, valor = parte.partition(':')
+        if separador:
+            dados_arduino[chave.strip()] = valor.strip()
+    try:
+        return Leitura(float(dados_arduino["LDR"]), int(dados_arduino["UMIDADE"]),
+                       float(dados_arduino["TEMPERATURA"]), datetime.datetime.now(), time.monotonic())
+    except (KeyError, ValueError):
+        return None
+
+
+class DistribuidorLeituras:
+    # Fan-out em processo das leituras da serial. Cada consumidor tem a sua fila limitada;
+    # se ele atrasar, a leitura mais antiga da fila dele é descartada.
+    def __init__(self, tamanho_fila):
+        self.tamanho_fila = tamanho_fila
+        self._lock = Lock()
+        self._filas = []
+        self.descartadas = 0
+
+    def inscrever(self):
+        fila = queue.Queue(maxsize=self.tamanho_fila)
+        with self._lock:
+            self._filas.append(fila)
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            if fila in self._filas:
+                self._filas.remove(fila)
+
+    def publicar(self, leitura):
+        with self._lock:
+            filas = list(self._filas)
+        for fila in filas:
+            while True:
+                try:
+                    fila.put_nowait(leitura)
+                    break
+                except queue.Full:
+                    try:
+                        fila.get_nowait()
+                        self.descartadas += 1
+                    except queue.Empty:
+                        pass
+
+
+distribuidor_leituras = DistribuidorLeituras(LEITURAS_FILA_TAMANHO)
+
+
+class BufferAmostras:
+    # Ring buffer numérico de tamanho fixo: uma coluna array('d') pré-alocada por campo,
+    # então adicionar uma amostra não aloca nada e as estatísticas percorrem a memória direto.
+    CAMPOS = ("luminosidade", "umidade", "temperatura", "monotonic")
+
+    def __init__(self, capacidade):
+        self.capacidade = capacidade
+        self._colunas = {campo: array('d', bytes(8 * capacidade)) for campo in self.CAMPOS}
+        self._proximo = 0
+        self.tamanho = 0
+
+    def adicionar(self, leitura):
+        i = self._proximo
+        for campo, coluna in self._colunas.items():
+            coluna[i] = getattr(leitura, campo)
+        self._proximo = (i + 1) % self.capacidade
+        self.tamanho = min(self.tamanho + 1, self.capacidade)
+
+    def estatisticas(self, campo):
+        # (quantidade, mínimo, máximo, média) das amostras guardadas, sem copiar a coluna
+        if not self.tamanho:
+            return None
+        valores = memoryview(self._colunas[campo])[:self.tamanho]
+        return self.tamanho, min(valores), max(valores), sum(valores) / self.tamanho
+
+
+class EstadoSensores:
+    # Última leitura (tupla imutável trocada de uma vez, nunca meio atualizada) mais as
+    # leituras recentes no ring buffer. O lock só protege o buffer.
+    def __init__(self, capacidade):
+        self._lock = Lock()
+        self._ultima = None
+        self.amostras = BufferAmostras(capacidade)
+
+    def atualizar(self, leitura):
+        with self._lock:
+            self.amostras.adicionar(leitura)
+            self._ultima = leitura
+
+    def ultima(self):
+        return self._ultima
+
+    def resumo(self):
+        # Estatísticas das leituras recentes (últimos AMOSTRAS_BUFFER_TAMANHO), para o /status
+        with self._lock:
+            resumo = {}
+            for campo in ("luminosidade", "umidade", "temperatura"):
+                estatisticas = self.amostras.estatisticas(campo)
+                if estatisticas:
+                    n, minimo, maximo, media = estatisticas
+                    resumo[campo] = {"n": n, "min": minimo, "max": maximo, "media": round(media, 3)}
+            return resumo
+
+
+# Última leitura e leituras recentes (atualizado pelo leitor da serial antes de distribuir
+# a leitura, então quem acorda pela fila já encontra o registro novo)
+estado_sensores = EstadoSensores(AMOSTRAS_BUFFER_TAMANHO)
+
+
+# --- Agregação por janela de snapshot ---
+# Em vez de mandar só a última leitura a cada 5 min, cada snapshot resume todas as leituras
+# da janela. As estatísticas são incrementais (Welford): O(1) por leitura e por sensor,
+# sem guardar as amostras.
+class EstatisticaCorrente:
+    __slots__ = ("n", "minimo", "maximo", "media", "_m2", "ultimo")
+
+    def __init__(self):
+        self.n = 0
+        self.minimo = self.maximo = self.ultimo = None
+        self.media = 0.0
+        self._m2 = 0.0
+
+    def adicionar(self, valor):
+        self.n += 1
+        delta = valor - self.media
+        self.media += delta / self.n
+        self._m2 += delta * (valor - self.media)
+        self.minimo = valor if self.minimo is None else min(self.minimo, valor)
+        self.maximo = valor if self.maximo is None else max(self.maximo, valor)
+        self.ultimo = valor
+
+    def resumo(self):
+        return {"n": self.n, "min": self.minimo, "max": self.maximo, "media": round(self.media, 4),
+                "variancia": round(self._m2 / (self.n - 1), 4) if self.n > 1 else 0.0,
+                "ultimo": self.ultimo}
+
+
+class AgregadorJanela:
+    # Uma EstatisticaCorrente por sensor e o tempo ligado de cada atuador (ponderado pelo
+    # tempo: soma dos intervalos em ON dentro da janela). fechar() devolve o resumo e
+    # começa a próxima janela; um atuador que segue ligado continua contando nela.
+    SENSORES = ("luminosidade", "umidade", "temperatura")
+
+    def __init__(self):
+        self._lock = Lock()
+        agora = time.monotonic()
+        self._inicio = agora
+        self._sensores = {campo: EstatisticaCorrente() for campo in self.SENSORES}
+        self._ligado_desde = {atuador: agora for atuador, chave in MAPA_ATUADORES.items()
+                              if estado_atuadores[chave] == 'ON'}
+        self._segundos_ligado = dict.fromkeys(MAPA_ATUADORES, 0.0)
+
+    def adicionar(self, leitura):
+        with self._lock:
+            for campo, estatistica in self._sensores.items():
+                estatistica.adicionar(getattr(leitura, campo))
+
+    def atuador_mudou(self, atuador, estado):
+        agora = time.monotonic()
+        with self._lock:
+            if estado == 'ON':
+                self._ligado_desde.setdefault(atuador, agora)
+            elif atuador in self._ligado_desde:
+                self._segundos_ligado[atuador] += agora - self._ligado_desde.pop(atuador)
+
+    def completa(self):
+        # True se todos os sensores já têm leitura nesta janela (só cresce até o fechar)
+        with self._lock:
+            return all(e.n for e in self._sensores.values())
+
+    def fechar(self):
+        agora = time.monotonic()
+        with self._lock:
+            for atuador, desde in self._ligado_desde.items():
+                self._segundos_ligado[atuador] += agora - desde
+                self._ligado_desde[atuador] = agora
+            resumo = {
+                "janela_segundos": round(agora - self._inicio, 1),
+                "estatisticas": {campo: e.resumo() for campo, e in self._sensores.items() if e.n},
+            }
+            for atuador, segundos in self._segundos_ligado.items():
+                resumo[f"{atuador.lower()}_segundos_ligado"] = round(segundos, 1)
+            self._inicio = agora
+            self._sensores = {campo: EstatisticaCorrente() for campo in self.SENSORES}
+            self._segundos_ligado = dict.fromkeys(MAPA_ATUADORES, 0.0)
+            return resumo
+
+
+agregador_janela = AgregadorJanela()
+
+
+def processar_linha_serial(linha, gravacao=None):
+    telemetria.contar("linhas_serial")
+    if gravacao:
+        gravacao.write(f"{time.time():.3f}\t{linha}\n")
+        gravacao.flush()
+    if agendador_comandos.registrar_resposta(linha):
+        telemetria.contar("respostas_serial")
         return
+    leitura = interpretar_linha_serial(linha)
+    if leitura is None:
+        telemetria.contar("rejeitadas_serial")
+        print(f"Linha da serial ignorada: '{linha}'")
+        return
+    telemetria.contar("leituras_serial")
+    estado_sensores.atualizar(leitura)
+    distribuidor_leituras.publicar(leitura)
+
 
+def leitor_serial():
+    # Única thread que lê a serial. readline() bloqueia até chegar uma linha completa
+    # (ou até o timeout da porta), então a thread dorme entre as leituras do Arduino.
+    if not arduino:
+        print("Arduino não conectado. Thread leitor_serial não pode iniciar.")
+        return
+    gravacao = open(SERIAL_GRAVAR_ARQUIVO, 'a', encoding='utf-8') if SERIAL_GRAVAR_ARQUIVO else None
     while True:
-        if arduino.in_waiting > 0:
+        try:
+            bruto = arduino.readline()
+        except serial.SerialException as e:
+            print(f"Erro ao ler a serial do Arduino: {e}")
+            telemetria.batimento("leitor_serial")
+            time.sleep(1)
+            continue
+        linha = bruto.decode('utf-8', errors='ignore').strip()
+        if not linha:
+            telemetria.batimento("leitor_serial")  # timeout da porta sem dados
+            continue
+        inicio = time.perf_counter()
+        processar_linha_serial(linha, gravacao)
+        telemetria.batimento("leitor_serial", time.perf_counter() - inicio)
+
+
+# --- Filtro por exceção dos live updates ---
+# Configuração: {"heartbeat": s, "intervalo_minimo": s, "sensores": {<campo>: {...}}}, onde cada
+# sensor aceita "absoluta" (mesma unidade do sensor), "relativa" (%), "suavizacao"
+# ("nenhuma" | "ewma" | "mediana"), "alfa" (ewma) e "janela" (mediana).
+FILTRO_PADRAO = {
+    "heartbeat": FILTRO_HEARTBEAT_SEGUNDOS,
+    "intervalo_minimo": FILTRO_INTERVALO_MINIMO,
+    "sensores": {
+        "luminosidade": {"absoluta": 5, "relativa": 2.0, "suavizacao": "nenhuma"},
+        "umidade": {"absoluta": 0.5, "relativa": 0, "suavizacao": "nenhuma"},
+        "temperatura": {"absoluta": 0.2, "relativa": 2.0, "suavizacao": "nenhuma"},
+    },
+}
+
+
+class SuavizacaoEwma:
+    def __init__(self, alfa):
+        self.alfa = alfa
+        self.valor = None
+
+    def aplicar(self, valor):
+        self.valor = valor if self.valor is None else self.alfa * valor + (1 - self.alfa) * self.valor
+        return self.valor
+
+
+class SuavizacaoMediana:
+    def __init__(self, janela):
+        self.valores = deque(maxlen=max(1, int(janela)))
+
+    def aplicar(self, valor):
+        self.valores.append(valor)
+        ordenados = sorted(self.valores)
+        meio = len(ordenados) // 2
+        return ordenados[meio] if len(ordenados) % 2 else (ordenados[meio - 1] + ordenados[meio]) / 2
+
+
+def criar_suavizacao(config_sensor):
+    tipo = config_sensor.get("suavizacao", "nenhuma")
+    if tipo == "ewma":
+        alfa = float(config_sensor.get("alfa", 0.3))
+        if not 0 < alfa <= 1:
+            raise ValueError(f"alfa da EWMA deve estar em (0, 1]: {alfa}")
+        return SuavizacaoEwma(alfa)
+    if tipo == "mediana":
+        return SuavizacaoMediana(config_sensor.get("janela", 5))
+    if tipo == "nenhuma":
+        return None
+    raise ValueError(f"Suavização desconhecida: {tipo}")
+
+
+class FiltroPorExcecao:
+    # Decide quais leituras viram live update. Uma leitura é enviada quando algum sensor
+    # (já suavizado) sai da banda morta em torno do último valor enviado, ou quando o último
+    # envio passou de "heartbeat" segundos; nunca com menos de "intervalo_minimo" entre envios.
+    # A banda é max(absoluta, relativa% do último valor), então perto de zero vale a absoluta.
+    def __init__(self, config=None):
+        self._lock = Lock()
+        self.configurar(config or {})
+
+    def configurar(self, config):
+        # Valida tudo antes de trocar, para uma configuração ruim da nuvem não derrubar o filtro
+        sensores = {campo: dict(padrao, **(config.get("sensores", {}).get(campo) or {}))
+                    for campo, padrao in FILTRO_PADRAO["sensores"].items()}
+        suavizacoes = {campo: criar_suavizacao(cfg) for campo, cfg in sensores.items()}
+        heartbeat = float(config.get("heartbeat", FILTRO_PADRAO["heartbeat"]))
+        intervalo_minimo = float(config.get("intervalo_minimo", FILTRO_PADRAO["intervalo_minimo"]))
+        with self._lock:
+            self.sensores = sensores
+            self.suavizacoes = suavizacoes
+            self.heartbeat = heartbeat
+            self.intervalo_minimo = intervalo_minimo
+            self._enviados = None
+            self._ultimo_envio = None
+
+    def _saiu_da_banda(self, campo, valor):
+        cfg = self.sensores[campo]
+        referencia = self._enviados[campo]
+        banda = max(float(cfg.get("absoluta") or 0), float(cfg.get("relativa") or 0) / 100 * abs(referencia))
+        return abs(valor - referencia) > banda
+
+    def avaliar(self, leitura):
+        # Retorna os valores a enviar ({campo: valor}) ou None para segurar a leitura
+        with self._lock:
+            valores = {}
+            for campo, suavizacao in self.suavizacoes.items():
+                valor = getattr(leitura, campo)
+                valores[campo] = suavizacao.aplicar(valor) if suavizacao else valor
+            agora = leitura.monotonic
+            if self._ultimo_envio is not None:
+                desde_ultimo = agora - self._ultimo_envio
+                if desde_ultimo < self.intervalo_minimo:
+                    return None
+                if desde_ultimo < self.heartbeat and \
+                        not any(self._saiu_da_banda(campo, valor) for campo, valor in valores.items()):
+                    return None
+            self._enviados = valores
+            self._ultimo_envio = agora
+            return valores
+
+
+try:
+    filtro_live = FiltroPorExcecao(json.loads(FILTRO_LIVE) if FILTRO_LIVE else None)
+except (ValueError, AttributeError) as e:
+    print(f"FILTRO_LIVE inválido ({e}). Usando o filtro padrão.")
+    filtro_live = FiltroPorExcecao()
+
+
+def publish_sensor_data():
+    fila_leituras = distribuidor_leituras.inscrever()
+    try:
+        while True:
             try:
-                linha = arduino.readline().decode('utf-8', errors='ignore').strip()
-                if not linha: time.sleep(0.005); continue
-                partes = linha.split(';')
-                dados_arduino = {}
-                for parte in partes:
-                    if ':' in parte:
-                        key_value = parte.split(':', 1)
-                        if len(key_value) == 2: dados_arduino[key_value[0].strip()] = key_value[1].strip()
-                current_luminosidade_str = dados_arduino.get("LDR")
-                current_umidade_str = dados_arduino.get("UMIDADE")
-                current_temperatura_str = dados_arduino.get("TEMPERATURA")
-                if not (current_luminosidade_str and current_umidade_str and current_temperatura_str):
-                    time.sleep(0.005);
-                    continue
-                current_luminosidade = float(current_luminosidade_str)
-                current_umidade = int(current_umidade_str)
-                current_temperatura = float(current_temperatura_str)
-
-                timestamp_obj = datetime.datetime.now()
-                timestamp_str = timestamp_obj.strftime('%H:%M:%S')
-
-                sensor_data['readLuminosidade'] = f'{current_luminosidade:.2f}-{timestamp_str}'
-                sensor_data['readUmidade'] = f'{current_umidade}-{timestamp_str}'
-                sensor_data['readTemperatura'] = f'{current_temperatura:.2f}-{timestamp_str}'
-
-                process_this_reading = False
-                # QUERO APENAS OS DADOS VARIANTES EM 2%
-                if not first_reading_processed:
-                    process_this_reading = True
-                else:
-                    if last_processed_luminosidade is not None:
-                        if abs(last_processed_luminosidade) < 1e-6:
-                            if abs(current_luminosidade) > 1e-6: process_this_reading = True
-                        elif (abs(current_luminosidade - last_processed_luminosidade) / abs(
-                            last_processed_luminosidade)) * 100 > 2.0:
-                            process_this_reading = True
-                    if not process_this_reading and last_processed_umidade is not None:
-                        if current_umidade != last_processed_umidade: process_this_reading = True
-                    if not process_this_reading and last_processed_temperatura is not None:
-                        if abs(last_processed_temperatura) < 1e-6:
-                            if abs(current_temperatura) > 1e-6: process_this_reading = True
-                        elif (abs(current_temperatura - last_processed_temperatura) / abs(
-                            last_processed_temperatura)) * 100 > 2.0:
-                            process_this_reading = True
-
-                if process_this_reading:
+                leitura = fila_leituras.get(timeout=ESPERA_BATIMENTO)
+            except queue.Empty:
+                telemetria.batimento("publish_sensor_data")
+                continue
+            inicio = time.perf_counter()
+            try:
+                agregador_janela.adicionar(leitura)
+
+                valores = filtro_live.avaliar(leitura)
+                if valores:
+                    current_luminosidade = valores["luminosidade"]
+                    current_umidade = int(round(valores["umidade"]))
+                    current_temperatura = valores["temperatura"]
                     umidadetexto = 'Molhado' if current_umidade == 0 else 'Seco'
                     print(
-                        f"Leitura SIGNIFICATIVA ({timestamp_str}): Lum={current_luminosidade:.2f}, Umi={umidadetexto}({current_umidade}), Temp={current_temperatura:.2f}°C. ENVIANDO PARA STREAM...")
+                        f"Leitura SIGNIFICATIVA ({leitura.horario.strftime('%H:%M:%S')}): Lum={current_luminosidade:.2f}, Umi={umidadetexto}({current_umidade}), Temp={current_temperatura:.2f}°C. ENVIANDO PARA STREAM...")
 
                     # Envia para o NOVO endpoint de "live update"
                     # Passa uma cópia do estado_atuadores para evitar problemas com threads se ele for modificado enquanto é enviado
                     enviar_leitura_live_para_nuvem(current_luminosidade, current_umidade, current_temperatura,
                                                    dict(estado_atuadores))
 
-                    last_processed_luminosidade = current_luminosidade
-                    last_processed_umidade = current_umidade
-                    last_processed_temperatura = current_temperatura
-                    if not first_reading_processed: first_reading_processed = True
-
             except Exception as e:
-                print(f"Erro em publish_sensor_data: {e}. Linha: '{linha if 'linha' in locals() else 'N/A'}'")
-        time.sleep(0.005)
+                print(f"Erro em publish_sensor_data: {e}. Leitura: {leitura}")
+            telemetria.batimento("publish_sensor_data", time.perf_counter() - inicio)
+    finally:
+        distribuidor_leituras.cancelar(fila_leituras)  # se a thread morrer, o watchdog inscreve outra fila
 
 
-def process_command_buffer():
+class ComandoAgendado:
+    __slots__ = ("comando", "chave", "automatico", "enfileirado_em")
+
+    def __init__(self, comando, chave, automatico):
+        self.comando = comando
+        self.chave = chave
+        self.automatico = automatico
+        self.enfileirado_em = time.monotonic()
+
+
+class AgendadorComandos:
+    # Fila de comandos para o Arduino, segura entre threads (deque + Condition).
+    # - Comandos manuais (dashboard) saem antes dos do piloto automático.
+    # - Há no máximo um comando por chave (atuador ou limite) na fila: um novo substitui o
+    #   anterior mantendo a posição; ON seguido de OFF ainda na fila se anulam.
+    # - O ritmo da serial vem do ACK do Arduino (enviar_com_ack), não de um sleep fixo.
+    def __init__(self):
+        self._cond = Condition()
+        self._manuais = deque()
+        self._automaticos = deque()
+        self._por_chave = {}
+        self.ao_descartar = None  # chamado com o comando substituído/anulado
+        self._ack_cond = Condition()
+        self._ack_esperado = None
+        self._ack_resultado = None
+        self._metricas = {"processados": 0, "coalescidos": 0, "anulados": 0, "ack_timeouts": 0, "nacks": 0,
+                          "latencia_total_ms": 0.0, "latencia_max_ms": 0.0, "latencia_ultima_ms": 0.0}
+
+    @staticmethod
+    def chave_do_comando(comando):
+        if comando.startswith("toggle"):
+            return comando[len("toggle"):].partition('_')[0]
+        if comando.startswith("set_limite"):
+            return comando.rpartition('_')[0]
+        return None
+
+    def adicionar(self, comando, automatico=False):
+        # Retorna False se o comando anulou outro ainda na fila (nada será enviado)
+        descartado = None
+        resultado = True
+        with self._cond:
+            chave = self.chave_do_comando(comando)
+            existente = self._por_chave.get(chave) if chave else None
+            if existente:
+                if existente.comando != comando:
+                    descartado = existente.comando
+                    self._metricas["coalescidos"] += 1
+                chave_estado = MAPA_ATUADORES.get(chave)
+                if descartado and chave_estado and comando.endswith('_' + estado_atuadores[chave_estado]):
+                    # O atuador já está no estado final: os dois comandos se anulam
+                    (self._automaticos if existente.automatico else self._manuais).remove(existente)
+                    del self._por_chave[chave]
+                    self._metricas["anulados"] += 1
+                    resultado = False
+                else:
+                    existente.comando = comando
+                    if existente.automatico and not automatico:
+                        self._automaticos.remove(existente)  # promovido para a fila manual
+                        existente.automatico = False
+                        self._manuais.append(existente)
+            else:
+                entrada = ComandoAgendado(comando, chave, automatico)
+                (self._automaticos if automatico else self._manuais).append(entrada)
+                if chave:
+                    self._por_chave[chave] = entrada
+                self._cond.notify()
+        if descartado and self.ao_descartar:
+            self.ao_descartar(descartado)
+        return resultado
+
+    def proximo(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._manuais or self._automaticos, timeout):
+                return None
+            entrada = (self._manuais or self._automaticos).popleft()
+            if entrada.chave and self._por_chave.get(entrada.chave) is entrada:
+                del self._por_chave[entrada.chave]
+            return entrada
+
+    def concluir(self, entrada):
+        # Latência do comando: da entrada na fila até o fim do processamento
+        latencia_ms = (time.monotonic() - entrada.enfileirado_em) * 1000
+        with self._cond:
+            m = self._metricas
+            m["processados"] += 1
+            m["latencia_total_ms"] += latencia_ms
+            m["latencia_ultima_ms"] = latencia_ms
+            m["latencia_max_ms"] = max(m["latencia_max_ms"], latencia_ms)
+
+    def enviar_com_ack(self, comando, escrever, timeout):
+        # True: ACK, False: NACK, None: sem resposta dentro do timeout (firmware sem ACK)
+        with self._ack_cond:
+            self._ack_esperado = comando
+            self._ack_resultado = None
+            escrever()
+            self._ack_cond.wait_for(lambda: self._ack_resultado is not None, timeout)
+            resultado = self._ack_resultado
+            self._ack_esperado = None
+        with self._cond:
+            if resultado is None:
+                self._metricas["ack_timeouts"] += 1
+            elif not resultado:
+                self._metricas["nacks"] += 1
+        return resultado
+
+    def registrar_resposta(self, linha):
+        # Chamado pelo leitor_serial; retorna True se a linha era uma resposta a comando
+        if linha.startswith("ACK:") or linha.startswith("NACK:"):
+            tipo, _, comando = linha.partition(':')
+            confirmado = tipo == "ACK"
+        elif linha == "Arduino: Comando Desconhecido":  # firmware antigo
+            comando, confirmado = None, False
+        else:
+            return False
+        with self._ack_cond:
+            if self._ack_esperado and comando in (None, self._ack_esperado):
+                self._ack_resultado = confirmado
+                self._ack_cond.notify_all()
+        return True
+
+    def profundidade(self):
+        with self._cond:
+            return {"manual": len(self._manuais), "automatico": len(self._automaticos)}
+
+    def estatisticas(self):
+        with self._cond:
+            m = dict(self._metricas)
+            m["profundidade"] = {"manual": len(self._manuais), "automatico": len(self._automaticos)}
+        m["latencia_media_ms"] = m["latencia_total_ms"] / m["processados"] if m["processados"] else 0.0
+        return m
+
+
+agendador_comandos = AgendadorComandos()
+
+
+def atualizar_limite(command_str):
+    # Atualização de limites. O Arduino nao precisa processar eles.
     global limiteTemp, limiteLuz
+    try:
+        novo_valor = float(command_str.split('_')[-1])
+    except ValueError:
+        print(f"Comando mal formatado: {command_str}")
+        return
+    if command_str.startswith("set_limiteTemp_"):
+        if 10 <= novo_valor <= 50:
+            limiteTemp = novo_valor
+            print(f"Limite de Temperatura atualizado na borda: {limiteTemp}°C")
+        else:
+            print(f"Valor inválido para limiteTemp: {novo_valor}")
+    else:
+        if 100 <= novo_valor <= 1000:
+            limiteLuz = novo_valor
+            print(f"Limite de Luminosidade atualizado na borda: {limiteLuz} Lux")
+        else:
+            print(f"Valor inválido para limiteLuz: {novo_valor}")
+
+
+def process_command_buffer():
     if not arduino:
         print("Arduino não conectado. Thread process_command_buffer não pode operar.")
         return
     while True:
-        if command_buffer:
-            command_str = command_buffer.pop(0)
-            print(f"Processando comando do buffer: {command_str}")
-            try:
-                # Atualização de limites. O Arduino nao precisa processar eles.
-                if command_str.startswith("set_limiteTemp_"):
-                    try:
-                        novo_temp = float(command_str.split('_')[-1])
-                        if 10 <= novo_temp <= 50:
-                            limiteTemp = novo_temp
-                            print(f"Limite de Temperatura atualizado na borda: {limiteTemp}°C")
-                        else:
-                            print(f"Valor inválido para limiteTemp: {novo_temp}")
-                    except ValueError:
-                        print(f"Comando mal formatado: {command_str}")
-                    continue  # Não enviar para Arduino
-
-                elif command_str.startswith("set_limiteLuz_"):
-                    try:
-                        novo_luz = float(command_str.split('_')[-1])
-                        if 100 <= novo_luz <= 1000:
-                            limiteLuz = novo_luz
-                            print(f"Limite de Luminosidade atualizado na borda: {limiteLuz} Lux")
-                        else:
-                            print(f"Valor inválido para limiteLuz: {novo_luz}")
-                    except ValueError:
-                        print(f"Comando mal formatado: {command_str}")
-                    continue  # Não enviar para Arduino
-
-                # Outros comandos para enviar ao Arduino
-                arduino.write((command_str + '\n').encode('utf-8'))
-                print(f"Comando '{command_str}\\n' enviado para Arduino.")
-
-                # Atualiza estado_atuadores se for ON/OFF
-                partes_comando = command_str.split('_')
-                if len(partes_comando) == 2:
-                    atuador_nome_cmd = partes_comando[0].replace("toggle", "")
-                    atuador_estado_cmd = partes_comando[1]
-                    mapa_atuadores = {
-                        "Irrigador": "estadoIrrigador",
-                        "Lampada": "estadoLampada",
-                        "Aquecedor": "estadoAquecedor",
-                        "Refrigerador": "estadoRefrigerador"
-                    }
-                    if atuador_nome_cmd in mapa_atuadores:
-                        chave_estado = mapa_atuadores[atuador_nome_cmd]
-                        if estado_atuadores[chave_estado] != atuador_estado_cmd:
-                            estado_atuadores[chave_estado] = atuador_estado_cmd
-                            print(f"Estado local de {chave_estado} atualizado para {atuador_estado_cmd}")
+        entrada = agendador_comandos.proximo(timeout=ESPERA_BATIMENTO)
+        if entrada is None:
+            telemetria.batimento("process_command_buffer")
+            continue
+        inicio = time.perf_counter()
+        command_str = entrada.comando
+        print(f"Processando comando do buffer: {command_str}")
+        try:
+            if command_str.startswith("set_limiteTemp_") or command_str.startswith("set_limiteLuz_"):
+                atualizar_limite(command_str)  # Não vai para o Arduino, então não espera a serial
+                continue
 
-            except Exception as e:
-                print(f"Erro ao processar comando '{command_str}': {e}")
+            # Outros comandos para enviar ao Arduino; o próximo só sai depois do ACK
+            confirmado = agendador_comandos.enviar_com_ack(
+                command_str, lambda: arduino.write((command_str + '\n').encode('utf-8')), COMANDO_ACK_TIMEOUT)
+            if confirmado is False:
+                print(f"Arduino recusou o comando '{command_str}'.")
+                controle_atuadores.comando_descartado(command_str)
+                continue
+            print(f"Comando '{command_str}\\n' enviado para Arduino{'' if confirmado else ' (sem ACK)'}.")
+
+            # Atualiza estado_atuadores se for ON/OFF
+            partes_comando = command_str.split('_')
+            if len(partes_comando) == 2:
+                atuador_nome_cmd = partes_comando[0].replace("toggle", "")
+                atuador_estado_cmd = partes_comando[1]
+                if atuador_nome_cmd in MAPA_ATUADORES:
+                    chave_estado = MAPA_ATUADORES[atuador_nome_cmd]
+                    mudou = estado_atuadores[chave_estado] != atuador_estado_cmd
+                    if mudou:
+                        estado_atuadores[chave_estado] = atuador_estado_cmd
+                        agregador_janela.atuador_mudou(atuador_nome_cmd, atuador_estado_cmd)
+                        print(f"Estado local de {chave_estado} atualizado para {atuador_estado_cmd}")
+                    controle_atuadores.comando_aplicado(atuador_nome_cmd, atuador_estado_cmd,
+                                                        entrada.automatico and mudou)
+
+        except Exception as e:
+            print(f"Erro ao processar comando '{command_str}': {e}")
+            controle_atuadores.comando_descartado(command_str)
+        finally:
+            agendador_comandos.concluir(entrada)
+            telemetria.batimento("process_command_buffer", time.perf_counter() - inicio)
+
+
+class ControleAtuadores:
+    # Intenções do piloto automático por atuador. Um comando enfileirado fica "pendente" até
+    # process_command_buffer aplicá-lo, então a mesma troca nunca é enfileirada duas vezes.
+    # Também guarda a hora da última troca aplicada (de qualquer origem) para a permanência mínima.
+    def __init__(self, permanencia_minima):
+        self._lock = RLock()  # o agendador chama comando_descartado de dentro de solicitar
+        self.permanencia_minima = permanencia_minima
+        self.pendentes = {}
+        self.ultima_troca = {}
+
+    def estado_efetivo(self, atuador):
+        with self._lock:
+            return self.pendentes.get(atuador) or estado_atuadores[MAPA_ATUADORES[atuador]]
 
-            time.sleep(3)
+    def solicitar(self, atuador, estado):
+        # Enfileira toggle<atuador>_<estado> se for uma troca e a permanência mínima já passou
+        agora = time.monotonic()
+        with self._lock:
+            atual = self.pendentes.get(atuador) or estado_atuadores[MAPA_ATUADORES[atuador]]
+            if atual == estado:
+                return False
+            minimo_on, minimo_off = self.permanencia_minima[atuador]
+            minimo = minimo_on if atual == 'ON' else minimo_off
+            if agora - self.ultima_troca.get(atuador, float('-inf')) < minimo:
+                return False
+            if not agendador_comandos.adicionar(f'toggle{atuador}_{estado}', automatico=True):
+                self.pendentes.pop(atuador, None)  # anulou um comando ainda na fila
+                return False
+            self.pendentes[atuador] = estado
+        return True
+
+    def comando_aplicado(self, atuador, estado, troca_automatica=False):
+        # O agendador mantém no máximo um toggle por atuador, então qualquer comando
+        # aplicado resolve a intenção pendente daquele atuador
+        global irrigadorSwitch_count, lampadaSwitch_count, aquecedorSwitch_count, refrigeradorSwitch_count
+        with self._lock:
+            self.ultima_troca[atuador] = time.monotonic()
+            self.pendentes.pop(atuador, None)
+        # Os contadores do snapshot só contam o que o piloto automático ligou de fato
+        # (um ON enfileirado pode ser coalescido ou anulado antes de chegar ao Arduino)
+        if troca_automatica and estado == 'ON':
+            if atuador == "Irrigador":
+                irrigadorSwitch_count += 1
+            elif atuador == "Lampada":
+                lampadaSwitch_count += 1
+            elif atuador == "Aquecedor":
+                aquecedorSwitch_count += 1
+            elif atuador == "Refrigerador":
+                refrigeradorSwitch_count += 1
+
+    def comando_descartado(self, command_str):
+        atuador, _, estado = command_str.replace("toggle", "", 1).partition('_')
+        with self._lock:
+            if self.pendentes.get(atuador) == estado:
+                del self.pendentes[atuador]
+
+    def avaliar(self, leitura):
+        temp = leitura.temperatura
+        umi = leitura.umidade  # 0 (molhado) ou 1 (seco)
+        lum = leitura.luminosidade
+
+        # Lógica Refrigerador: liga no limite, só desliga HISTERESE_TEMP abaixo dele
+        if temp >= limiteTemp:
+            self.solicitar("Refrigerador", 'ON')
+        elif temp < limiteTemp - HISTERESE_TEMP:
+            self.solicitar("Refrigerador", 'OFF')
+
+        # Lógica Aquecedor (inverso do refrigerador, não devem ligar juntos). Ex: liga se temp < 25
+        if temp < (limiteTemp - 5):
+            if self.estado_efetivo("Refrigerador") == 'OFF':
+                self.solicitar("Aquecedor", 'ON')
+        elif temp >= (limiteTemp - 5) + HISTERESE_TEMP:
+            self.solicitar("Aquecedor", 'OFF')
+
+        # Lógica Irrigador:
+        # inversorUmi = 0: UMI=1 (seco) -> Ligar Irrigador. UMI=0 (molhado) -> Desligar.
+        # inversorUmi = 1: UMI=0 (molhado) -> Ligar Irrigador. UMI=1 (seco) -> Desligar.
+        # O sensor é binário: quem evita o liga/desliga repetido é a permanência mínima.
+        deve_irrigar = (inversorUmi == 0 and umi == 1) or \
+                       (inversorUmi == 1 and umi == 0)
+        if deve_irrigar:
+            self.solicitar("Irrigador", 'ON')
         else:
-            time.sleep(0.5)
+            self.solicitar("Irrigador", 'OFF')
 
+        # Lógica Lâmpada: liga abaixo de limiteLuz, só desliga HISTERESE_LUZ acima dele
+        if lum < limiteLuz:
+            self.solicitar("Lampada", 'ON')
+        elif lum >= limiteLuz + HISTERESE_LUZ:
+            self.solicitar("Lampada", 'OFF')
 
-def piloto_automatico():
-    global auto_mode, irrigadorSwitch_count, lampadaSwitch_count, aquecedorSwitch_count, refrigeradorSwitch_count
 
+controle_atuadores = ControleAtuadores(PERMANENCIA_MINIMA)
+agendador_comandos.ao_descartar = controle_atuadores.comando_descartado
+
+
+def piloto_automatico():
+    # Reage a cada leitura nova da serial em vez de checar a cada 5s
     print(f"Piloto automático iniciado. Modo atual: {'ATIVO' if auto_mode else 'INATIVO'}")
     if estado_atuadores['estadoPilotoAutomatico'] == 'OFF' and auto_mode:  # Sincroniza display
         estado_atuadores['estadoPilotoAutomatico'] = 'ON'
 
-    while True:
-        if auto_mode:
+    fila_leituras = distribuidor_leituras.inscrever()
+    try:
+        while True:
             try:
-                temp_data_ts = sensor_data.get('readTemperatura')
-                umi_data_ts = sensor_data.get('readUmidade')  # Espera 0 (molhado) ou 1 (seco)
-                lum_data_ts = sensor_data.get('readLuminosidade')
-
-                if temp_data_ts and umi_data_ts and lum_data_ts:
-                    temp = float(temp_data_ts.split('-')[0])
-                    umi = int(umi_data_ts.split('-')[0])  # 0 ou 1
-                    lum = float(lum_data_ts.split('-')[0])
-
-                    # Lógica Refrigerador
-                    if temp >= limiteTemp and estado_atuadores['estadoRefrigerador'] == 'OFF':
-                        command_buffer.append('toggleRefrigerador_ON')
-                        # estado_atuadores['estadoRefrigerador'] = 'ON' # Será atualizado por process_command_buffer
-                        refrigeradorSwitch_count += 1
-                    elif temp < limiteTemp and estado_atuadores['estadoRefrigerador'] == 'ON':
-                        command_buffer.append('toggleRefrigerador_OFF')
-                        # estado_atuadores['estadoRefrigerador'] = 'OFF'
-
-                    # Lógica Aquecedor (inverso do refrigerador, não devem ligar juntos)
-                    if temp < (limiteTemp - 5) and estado_atuadores['estadoAquecedor'] == 'OFF' and estado_atuadores[
-                        'estadoRefrigerador'] == 'OFF':  # Ex: Ligar aquecedor se temp < 25
-                        command_buffer.append('toggleAquecedor_ON')
-                        # estado_atuadores['estadoAquecedor'] = 'ON'
-                        aquecedorSwitch_count += 1
-                    elif temp >= (limiteTemp - 5) and estado_atuadores['estadoAquecedor'] == 'ON':
-                        command_buffer.append('toggleAquecedor_OFF')
-                        # estado_atuadores['estadoAquecedor'] = 'OFF'
-
-                    # Lógica Irrigador:
-                    # inversorUmi = 0: UMI=1 (seco) -> Ligar Irrigador. UMI=0 (molhado) -> Desligar.
-                    # inversorUmi = 1: UMI=0 (molhado) -> Ligar Irrigador. UMI=1 (seco) -> Desligar.
-                    deve_irrigar = (inversorUmi == 0 and umi == 1) or \
-                                   (inversorUmi == 1 and umi == 0)
-
-                    if deve_irrigar and estado_atuadores['estadoIrrigador'] == 'OFF':
-                        command_buffer.append('toggleIrrigador_ON')
-                        # estado_atuadores['estadoIrrigador'] = 'ON'
-                        irrigadorSwitch_count += 1
-                    elif not deve_irrigar and estado_atuadores['estadoIrrigador'] == 'ON':
-                        command_buffer.append('toggleIrrigador_OFF')
-                        # estado_atuadores['estadoIrrigador'] = 'OFF'
-
-                    # Lógica Lâmpada
-                    if lum < limiteLuz and estado_atuadores['estadoLampada'] == 'OFF':  #  < limiteLuz
-                        command_buffer.append('toggleLampada_ON')
-                        # estado_atuadores['estadoLampada'] = 'ON'
-                        lampadaSwitch_count += 1
-                    elif lum >= limiteLuz and estado_atuadores['estadoLampada'] == 'ON':  # >= limiteLuz
-                        command_buffer.append('toggleLampada_OFF')
-                        # estado_atuadores['estadoLampada'] = 'OFF'
-                else:
-                    print("Piloto Automático: Dados dos sensores não disponíveis ou incompletos.")
-            except Exception as e:
-                print(f"Erro no piloto automático: {e}")
-        else:  # Se auto_mode for False, garantir que o estadoPilotoAutomatico reflita isso
-            if estado_atuadores['estadoPilotoAutomatico'] == 'ON':
-                estado_atuadores['estadoPilotoAutomatico'] = 'OFF'
-                print("Piloto automático DESATIVADO.")
+                leitura = fila_leituras.get(timeout=ESPERA_BATIMENTO)
+            except queue.Empty:
+                telemetria.batimento("piloto_automatico")
+                continue
+            inicio = time.perf_counter()
+            # A fila só acorda o piloto: o controle usa a última leitura registrada, então
+            # leituras acumuladas são descartadas
+            while not fila_leituras.empty():
+                fila_leituras.get_nowait()
+            leitura = estado_sensores.ultima()
+            if auto_mode:
+                try:
+                    controle_atuadores.avaliar(leitura)
+                except Exception as e:
+                    print(f"Erro no piloto automático: {e}")
+            else:  # Se auto_mode for False, garantir que o estadoPilotoAutomatico reflita isso
+                if estado_atuadores['estadoPilotoAutomatico'] == 'ON':
+                    estado_atuadores['estadoPilotoAutomatico'] = 'OFF'
+                    print("Piloto automático DESATIVADO.")
+            telemetria.batimento("piloto_automatico", time.perf_counter() - inicio)
+    finally:
+        distribuidor_leituras.cancelar(fila_leituras)
+
+
+# --- Watchdog das threads ---
+# Reinicia as threads que morreram com exceção. Uma thread que retornou normalmente (ex.:
+# endpoint não configurado) fica como encerrada. Threads vivas sem batimento há mais que
+# o seu silêncio máximo são marcadas como travadas (em Python não dá para matá-las).
+class SupervisorThreads:
+    def __init__(self):
+        self._lock = Lock()
+        self._registros = {}
+
+    def iniciar(self, alvo, silencio_maximo):
+        nome = alvo.__name__
+        with self._lock:
+            self._registros[nome] = {"alvo": alvo, "silencio_maximo": silencio_maximo, "thread": None,
+                                     "reinicios": 0, "ultimo_erro": None, "encerrada": False}
+        self._disparar(nome)
+
+    def _disparar(self, nome):
+        registro = self._registros[nome]
+        registro["encerrada"] = False
+        telemetria.batimento(nome)
+        registro["thread"] = Thread(target=self._executar, args=(nome,), name=nome, daemon=True)
+        registro["thread"].start()
+
+    def _executar(self, nome):
+        registro = self._registros[nome]
+        try:
+            registro["alvo"]()
+            registro["encerrada"] = True
+        except Exception as e:
+            registro["ultimo_erro"] = f"{type(e).__name__}: {e}"
+            print(f"Thread {nome} morreu: {registro['ultimo_erro']}")
+            traceback.print_exc()
+
+    def verificar(self):
+        with self._lock:
+            for nome, registro in self._registros.items():
+                if not registro["thread"].is_alive() and not registro["encerrada"]:
+                    registro["reinicios"] += 1
+                    print(f"Watchdog: reiniciando a thread {nome} (reinício {registro['reinicios']}).")
+                    self._disparar(nome)
+
+    def estado(self):
+        threads = telemetria.threads()
+        with self._lock:
+            estado = {}
+            for nome, registro in self._registros.items():
+                viva = registro["thread"].is_alive()
+                info = dict(threads.get(nome, {}), viva=viva, encerrada=registro["encerrada"],
+                            reinicios=registro["reinicios"], ultimo_erro=registro["ultimo_erro"])
+                info["travada"] = viva and info.get("segundos_desde_batimento", 0) > registro["silencio_maximo"]
+                estado[nome] = info
+            return estado
+
+    def saudavel(self):
+        return all((info["viva"] or info["encerrada"]) and not info["travada"] for info in self.estado().values())
+
+
+supervisor_threads = SupervisorThreads()
+
 
-        time.sleep(5)  # Intervalo de checagem do piloto automático
+def resumo_telemetria():
+    return {
+        "device_id": DEVICE_ID,
+        "uptime_s": round(telemetria.uptime()),
+        "threads": supervisor_threads.estado(),
+        "serial": telemetria.contadores(),
+        "leituras_descartadas": distribuidor_leituras.descartadas,
+        "sensores_recentes": estado_sensores.resumo(),
+        "comandos": agendador_comandos.estatisticas(),
+        "http": cliente_nuvem.estatisticas(),
+        "outbox_pendentes": outbox_snapshots.tamanho(),
+        "auto_mode": auto_mode,
+    }
+
+
+def resumo_telemetria_compacto():
+    # Versão curta que vai junto com cada snapshot para a nuvem
+    threads = supervisor_threads.estado()
+    serial_contadores = telemetria.contadores()
+    comandos = agendador_comandos.estatisticas()
+    http = cliente_nuvem.estatisticas()
+    return {
+        "uptime_s": round(telemetria.uptime()),
+        "threads_vivas": sum(1 for info in threads.values() if info["viva"]),
+        "threads_travadas": [nome for nome, info in threads.items() if info["travada"]],
+        "reinicios": sum(info["reinicios"] for info in threads.values()),
+        "serial_leituras_s": serial_contadores.get("leituras_serial", {}).get("por_segundo", 0.0),
+        "serial_rejeitadas_s": serial_contadores.get("rejeitadas_serial", {}).get("por_segundo", 0.0),
+        "fila_comandos": sum(comandos["profundidade"].values()),
+        "comando_latencia_media_ms": round(comandos["latencia_media_ms"], 1),
+        "http_erros": {classe: m["erros"] for classe, m in http.items()},
+        "http_latencia_media_ms": {classe: round(m["latencia_media_ms"], 1) for classe, m in http.items()},
+        "outbox_pendentes": outbox_snapshots.tamanho(),
+    }
+
+
+# --- Endpoint HTTP local de status ---
+# GET /status: telemetria completa em JSON. GET /saude: 200 ou 503 conforme o watchdog.
+class ManipuladorStatus(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path in ('/', '/status'):
+            codigo, corpo = 200, resumo_telemetria()
+        elif self.path == '/saude':
+            saudavel = supervisor_threads.saudavel()
+            codigo, corpo = (200 if saudavel else 503), {"saudavel": saudavel}
+        else:
+            codigo, corpo = 404, {"error": "Rota não encontrada"}
+        dados = json.dumps(corpo, default=str).encode('utf-8')
+        self.send_response(codigo)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def log_message(self, formato, *args):
+        pass  # não polui o console com cada consulta
+
+
+def iniciar_servidor_status():
+    if not STATUS_PORTA:
+        return None
+    try:
+        servidor = ThreadingHTTPServer((STATUS_HOST, STATUS_PORTA), ManipuladorStatus)
+    except OSError as e:
+        print(f"Não foi possível abrir o endpoint de status em {STATUS_HOST}:{STATUS_PORTA}: {e}")
+        return None
+    servidor.daemon_threads = True
+    Thread(target=servidor.serve_forever, name="servidor_status", daemon=True).start()
+    print(f"Status da borda em http://{STATUS_HOST}:{STATUS_PORTA}/status")
+    return servidor
 
 
 if __name__ == '__main__':
     if not arduino:
-        print("Script de borda encerrando pois o Arduino não está conectado.")
+        print("Script de borda encerrando pois o Arduino (ou o log de replay) não está disponível.")
         exit()
 
     print("Servidor de borda iniciado...")
     # auto_mode é False por padrão. Pode ser alterado por comando da nuvem.
 
-    # Inicializa as threads
-    Thread(target=publish_sensor_data, daemon=True).start()
-    Thread(target=piloto_automatico, daemon=True).start()
-    Thread(target=process_command_buffer, daemon=True).start()
-    Thread(target=command_poller_thread, daemon=True).start()
-    Thread(target=enviar_snapshot_para_nuvem,daemon=True).start()  
+    # Inicializa as threads (consumidores antes do leitor para não perder as primeiras leituras).
+    # O segundo argumento é o silêncio máximo (s) antes de a thread ser considerada travada.
+    supervisor_threads.iniciar(publish_sensor_data, ESPERA_BATIMENTO * 3)
+    supervisor_threads.iniciar(piloto_automatico, ESPERA_BATIMENTO * 3)
+    supervisor_threads.iniciar(process_command_buffer, ESPERA_BATIMENTO * 3 + COMANDO_ACK_TIMEOUT)
+    supervisor_threads.iniciar(command_poller_thread, COMANDOS_LONGPOLL_TIMEOUT + 60)
+    supervisor_threads.iniciar(enviar_snapshot_para_nuvem, 360)
+    supervisor_threads.iniciar(drenar_outbox_para_nuvem, OUTBOX_BACKOFF_MAXIMO + 90)
+    supervisor_threads.iniciar(leitor_serial, 10)
+    iniciar_servidor_status()
 
     try:
         while True:
-            time.sleep(60)
+            time.sleep(WATCHDOG_INTERVALO)
+            supervisor_threads.verificar()
     except KeyboardInterrupt:
         print("Encerrando servidor de borda...")
     finally:
@@ -0,0 +1,34 @@
+# Leitura dos traces da serial, compartilhada pelo replay da borda (SerialReplay em
+# borderServer.py) e pelo Arduino virtual (arduinoVirtual.py).
+# Formato gravado por SERIAL_GRAVAR_ARQUIVO: "<epoch>\t<linha>" por linha. Também aceita um
+# log simples, uma linha por leitura, espaçadas por intervalo_padrao.
+# Respostas a comandos gravadas (ACK:/NACK: e a mensagem do firmware antigo) são puladas:
+# quem reproduz o trace responde aos comandos enviados de verdade.
+PREFIXOS_RESPOSTA = ("ACK:", "NACK:", "Arduino: Comando Desconhecido")
+
+
+def carregar_trace_serial(caminho, intervalo_padrao=0.1):
+    # Retorna [(segundos desde a linha anterior, linha)]; a primeira linha tem intervalo 0
+    linhas = []
+    tempo_anterior = None
+    with open(caminho, encoding='utf-8', errors='ignore') as arquivo:
+        for bruta in arquivo:
+            bruta = bruta.rstrip('\r\n')
+            if not bruta.strip():
+                continue
+            tempo, separador, conteudo = bruta.partition('\t')
+            try:
+                tempo, linha = (float(tempo), conteudo) if separador else (None, bruta)
+            except ValueError:
+                tempo, linha = None, bruta
+            if linha.startswith(PREFIXOS_RESPOSTA):
+                continue
+            if not linhas:
+                intervalo = 0.0
+            elif tempo is not None and tempo_anterior is not None:
+                intervalo = max(0.0, tempo - tempo_anterior)
+            else:
+                intervalo = intervalo_padrao
+            tempo_anterior = tempo
+            linhas.append((intervalo, linha))
+    return linhas
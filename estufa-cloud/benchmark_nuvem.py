@@ -0,0 +1,352 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+
+import requests
+
+
+# Teste de carga da API da nuvem com uma frota simulada de bordas.
+# Cada dispositivo simulado envia live updates (/api/live_update), snapshots (/api/leituras)
+# e consulta a fila de comandos (/api/comandos); um "dashboard" enfileira comandos e M
+# clientes SSE ficam conectados em /stream medindo a latência de ponta a ponta.
+# O resultado vai para um JSON em resultados_benchmark/ para comparar execuções.
+#
+# Exemplos:
+#   python benchmark_nuvem.py --mongo-memoria --dispositivos 20 --assinantes 5 --duracao 30
+#   python benchmark_nuvem.py --url http://127.0.0.1:8080   (servidor já rodando, ex.: nuvem_asgi.py)
+#
+# Sem --url o app Flask de nuvem.py sobe neste processo usando MONGO_URI_PROD (um MongoDB local
+# descartável) ou, com --mongo-memoria, o mongomock (pip install mongomock).
+
+
+def percentil(ordenados, p):
+    # Nearest-rank sobre uma lista já ordenada
+    if not ordenados:
+        return None
+    indice = max(0, min(len(ordenados) - 1, int(round(p / 100 * len(ordenados))) - 1))
+    return ordenados[indice]
+
+
+def resumir_latencias(latencias_ms):
+    ordenados = sorted(latencias_ms)
+    return {
+        "p50_ms": percentil(ordenados, 50),
+        "p95_ms": percentil(ordenados, 95),
+        "p99_ms": percentil(ordenados, 99),
+        "max_ms": ordenados[-1] if ordenados else None,
+    }
+
+
+class Medidor:
+    # Latências e erros por rota, compartilhado entre as threads da frota
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rotas = {}
+
+    def registrar(self, rota, latencia_ms, ok):
+        with self._lock:
+            m = self.rotas.setdefault(rota, {"latencias": [], "erros": 0})
+            m["latencias"].append(latencia_ms)
+            m["erros"] += int(not ok)
+
+    def resumo(self, duracao):
+        with self._lock:
+            return {rota: dict(requisicoes=len(m["latencias"]), erros=m["erros"],
+                               vazao_rps=len(m["latencias"]) / duracao, **resumir_latencias(m["latencias"]))
+                    for rota, m in sorted(self.rotas.items())}
+
+
+def requisitar(sessao, medidor, rota, metodo, url, **kwargs):
+    inicio = time.perf_counter()
+    try:
+        response = sessao.request(metodo, url, timeout=10, **kwargs)
+        ok = response.status_code < 400
+    except requests.exceptions.RequestException:
+        response, ok = None, False
+    medidor.registrar(rota, (time.perf_counter() - inicio) * 1000, ok)
+    return response if ok else None
+
+
+def timestamp_de(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).isoformat()
+
+
+class DispositivoSimulado(threading.Thread):
+    def __init__(self, indice, base_url, args, medidor, publicados, fim):
+        super().__init__(daemon=True)
+        self.device_id = f"bench{indice:04d}"
+        self.base_url = base_url
+        self.args = args
+        self.medidor = medidor
+        self.publicados = publicados  # lista de (device_id, timestamp) aceitos pela nuvem
+        self.fim = fim
+        self.aleatorio = random.Random(args.semente + indice)
+        self.comandos_recebidos = 0
+
+    def leitura(self):
+        return {
+            "device_id": self.device_id,
+            "luminosidade": self.aleatorio.uniform(100, 1000),
+            "umidade": self.aleatorio.randint(0, 1),
+            "temperatura": round(self.aleatorio.uniform(15, 35), 2),
+        }
+
+    def run(self):
+        sessao = requests.Session()
+        agora = time.monotonic()
+        # Desencontra os dispositivos para não baterem todos no mesmo instante
+        proximos = {tarefa: agora + self.aleatorio.uniform(0, intervalo) for tarefa, intervalo in (
+            ("live", self.args.intervalo_live), ("snapshot", self.args.intervalo_snapshot),
+            ("comandos", self.args.intervalo_comandos))}
+        while time.monotonic() < self.fim:
+            tarefa, quando = min(proximos.items(), key=lambda item: item[1])
+            espera = min(quando, self.fim) - time.monotonic()
+            if espera > 0:
+                time.sleep(espera)
+            if time.monotonic() >= self.fim:
+                break
+            if tarefa == "live":
+                payload = dict(self.leitura(), timestamp=timestamp_de(time.time()), estado_atuadores={})
+                if requisitar(sessao, self.medidor, "POST /api/live_update", "POST",
+                              f"{self.base_url}/api/live_update", json=payload) is not None:
+                    self.publicados.append((self.device_id, payload["timestamp"]))
+                intervalo = self.args.intervalo_live
+            elif tarefa == "snapshot":
+                payload = dict(self.leitura(), timestamp=timestamp_de(time.time()))
+                requisitar(sessao, self.medidor, "POST /api/leituras", "POST",
+                           f"{self.base_url}/api/leituras", json=payload)
+                intervalo = self.args.intervalo_snapshot
+            else:
+                response = requisitar(sessao, self.medidor, "GET /api/comandos", "GET",
+                                      f"{self.base_url}/api/comandos", params={"device_id": self.device_id})
+                if response is not None:
+                    try:
+                        self.comandos_recebidos += len(response.json() or [])
+                    except ValueError:
+                        pass
+                intervalo = self.args.intervalo_comandos
+            proximos[tarefa] += intervalo
+
+
+class DashboardSimulado(threading.Thread):
+    # Enfileira comandos para dispositivos aleatórios, como o botão de um atuador no dashboard
+    def __init__(self, base_url, args, medidor, fim):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.args = args
+        self.medidor = medidor
+        self.fim = fim
+        self.aleatorio = random.Random(args.semente - 1)
+        self.enviados = 0
+
+    def run(self):
+        sessao = requests.Session()
+        while time.monotonic() + self.args.intervalo_dashboard < self.fim:
+            time.sleep(self.args.intervalo_dashboard)
+            device_id = f"bench{self.aleatorio.randrange(self.args.dispositivos):04d}"
+            comando = f"toggle{self.aleatorio.choice(['Irrigador', 'Lampada', 'Aquecedor', 'Refrigerador'])}_" \
+                      f"{self.aleatorio.choice(['ON', 'OFF'])}"
+            if requisitar(sessao, self.medidor, "POST /api/enviar_comando_atuador", "POST",
+                          f"{self.base_url}/api/enviar_comando_atuador",
+                          json={"device_id": device_id, "comando": comando}) is not None:
+                self.enviados += 1
+
+
+def socket_da_resposta(response):
+    # Socket por baixo de uma resposta em streaming do requests/urllib3 (atributos internos)
+    try:
+        return response.raw._fp.fp.raw._sock
+    except AttributeError:
+        return None
+
+
+class AssinanteSSE(threading.Thread):
+    def __init__(self, indice, base_url):
+        super().__init__(daemon=True)
+        self.indice = indice
+        self.url = f"{base_url}/stream"
+        self.recebidos = set()
+        self.latencias_ms = []
+        self.conectado = threading.Event()
+        self.response = None
+        self.socket = None
+        self.encerrado = False
+        self.erro = None
+
+    def run(self):
+        try:
+            self.response = requests.get(self.url, stream=True, timeout=(5, None))
+            self.socket = socket_da_resposta(self.response)
+            self.conectado.set()
+            for linha in self.response.iter_lines(decode_unicode=True):
+                if not linha or not linha.startswith("data:"):
+                    continue
+                evento = json.loads(linha[len("data:"):])
+                chegada = time.time()
+                chave = (evento.get("device_id"), evento.get("timestamp"))
+                if chave in self.recebidos:
+                    continue
+                self.recebidos.add(chave)
+                try:
+                    enviado = datetime.datetime.fromisoformat(evento["timestamp"]).timestamp()
+                    self.latencias_ms.append((chegada - enviado) * 1000)
+                except (KeyError, TypeError, ValueError):
+                    pass
+        except (requests.exceptions.RequestException, AttributeError, ValueError) as e:
+            # encerrar() fecha a resposta de outra thread, o que também termina aqui
+            if not self.encerrado:
+                self.erro = str(e)
+        finally:
+            self.conectado.set()
+
+    def encerrar(self):
+        # Derruba o socket antes de fechar: response.close() sozinho espera a leitura em
+        # andamento em iter_lines, ou seja, o próximo keep-alive do servidor (15 s)
+        self.encerrado = True
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # já desconectado
+        if self.response is not None:
+            self.response.close()
+
+
+def iniciar_servidor_local(args):
+    # Sobe o app Flask de nuvem.py em uma thread deste processo (servidor threaded do werkzeug)
+    if args.mongo_memoria:
+        import mongomock
+        import pymongo.mongo_client
+        pymongo.mongo_client.MongoClient = mongomock.MongoClient
+        os.environ.setdefault("MONGO_URI_PROD", "mongodb://memoria")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import nuvem
+    from werkzeug.serving import make_server
+
+    if args.mongo_memoria and nuvem.ingestao_leituras:
+        # O mongomock não implementa os upserts em lote dos rollups; mede só a ingestão
+        nuvem.ingestao_leituras.ao_gravar = None
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    servidor = make_server("127.0.0.1", args.porta, nuvem.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_port}"
+
+
+def executar(args):
+    servidor = None
+    base_url = args.url.rstrip('/') if args.url else None
+    if not base_url:
+        servidor, base_url = iniciar_servidor_local(args)
+    print(f"Benchmark contra {base_url}: {args.dispositivos} dispositivos, {args.assinantes} assinantes SSE, "
+          f"{args.duracao}s")
+
+    medidor = Medidor()
+    assinantes = [AssinanteSSE(i, base_url) for i in range(args.assinantes)]
+    for assinante in assinantes:
+        assinante.start()
+    for assinante in assinantes:
+        assinante.conectado.wait(10)
+    time.sleep(0.5)  # garante que os assinantes já estão registrados no broadcaster
+
+    publicados = []
+    inicio = time.monotonic()
+    fim = inicio + args.duracao
+    frota = [DispositivoSimulado(i, base_url, args, medidor, publicados, fim) for i in range(args.dispositivos)]
+    dashboard = DashboardSimulado(base_url, args, medidor, fim) if args.intervalo_dashboard > 0 else None
+    for thread in frota + ([dashboard] if dashboard else []):
+        thread.start()
+    for thread in frota + ([dashboard] if dashboard else []):
+        thread.join()
+    duracao = time.monotonic() - inicio
+
+    time.sleep(args.espera_final)  # deixa os eventos em trânsito chegarem aos assinantes
+    for assinante in assinantes:
+        assinante.encerrar()
+    for assinante in assinantes:
+        assinante.join(5)
+    if servidor:
+        servidor.shutdown()
+
+    esperados = set(publicados)
+    latencias_entrega = [latencia for assinante in assinantes for latencia in assinante.latencias_ms]
+    perdidos = [len(esperados - assinante.recebidos) for assinante in assinantes]
+    return {
+        "configuracao": {
+            "alvo": args.url or ("local/mongomock" if args.mongo_memoria else "local/mongodb"),
+            "dispositivos": args.dispositivos,
+            "assinantes": args.assinantes,
+            "duracao_s": args.duracao,
+            "intervalo_live_s": args.intervalo_live,
+            "intervalo_snapshot_s": args.intervalo_snapshot,
+            "intervalo_comandos_s": args.intervalo_comandos,
+            "intervalo_dashboard_s": args.intervalo_dashboard,
+            "semente": args.semente,
+        },
+        "ambiente": {"python": platform.python_version(), "plataforma": platform.platform(),
+                     "cpus": os.cpu_count()},
+        "inicio": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "duracao_medida_s": duracao,
+        "rotas": medidor.resumo(duracao),
+        "entrega_live": dict(
+            publicados=len(esperados),
+            entregas=sum(len(a.recebidos) for a in assinantes),
+            perdidos_por_assinante=perdidos,
+            perdidos_total=sum(perdidos),
+            erros_assinantes=[a.erro for a in assinantes if a.erro],
+            **resumir_latencias(latencias_entrega)),
+        "comandos": {
+            "enfileirados": dashboard.enviados if dashboard else 0,
+            "entregues": sum(dispositivo.comandos_recebidos for dispositivo in frota),
+        },
+    }
+
+
+def imprimir_resumo(resultado):
+    print(f"\n{'rota':<36}{'req':>8}{'erros':>7}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for rota, m in resultado["rotas"].items():
+        print(f"{rota:<36}{m['requisicoes']:>8}{m['erros']:>7}{m['vazao_rps']:>9.1f}"
+              f"{m['p50_ms'] or 0:>9.1f}{m['p95_ms'] or 0:>9.1f}{m['p99_ms'] or 0:>9.1f}")
+    entrega = resultado["entrega_live"]
+    print(f"\nEntrega live (ms): p50={entrega['p50_ms']} p95={entrega['p95_ms']} p99={entrega['p99_ms']} | "
+          f"publicados={entrega['publicados']} perdidos={entrega['perdidos_por_assinante']}")
+    print(f"Comandos: {resultado['comandos']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga da API da nuvem com uma frota de bordas simulada")
+    parser.add_argument("--url", help="URL de um servidor já rodando; sem ela o app sobe neste processo")
+    parser.add_argument("--mongo-memoria", action="store_true", help="usa mongomock no lugar do MongoDB")
+    parser.add_argument("--porta", type=int, default=0, help="porta do servidor local (0 = livre)")
+    parser.add_argument("--dispositivos", type=int, default=10)
+    parser.add_argument("--assinantes", type=int, default=5, help="clientes SSE em /stream")
+    parser.add_argument("--duracao", type=float, default=30, help="segundos de carga")
+    parser.add_argument("--intervalo-live", type=float, default=1.0)
+    parser.add_argument("--intervalo-snapshot", type=float, default=5.0)
+    parser.add_argument("--intervalo-comandos", type=float, default=2.0)
+    parser.add_argument("--intervalo-dashboard", type=float, default=1.0, help="0 desliga o dashboard simulado")
+    parser.add_argument("--espera-final", type=float, default=2.0, help="segundos para drenar os eventos no fim")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--saida", help="arquivo JSON do resultado (padrão: resultados_benchmark/<data>.json)")
+    args = parser.parse_args()
+
+    resultado = executar(args)
+    imprimir_resumo(resultado)
+
+    saida = args.saida or os.path.join("resultados_benchmark",
+                                       datetime.datetime.now().strftime("benchmark_%Y%m%d-%H%M%S.json"))
+    os.makedirs(os.path.dirname(saida) or ".", exist_ok=True)
+    with open(saida, "w", encoding="utf-8") as arquivo:
+        json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+    print(f"\nResultado salvo em {saida}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,23 @@
-from flask import Flask, request, jsonify, render_template, Response
+from flask import Flask, request, jsonify, render_template, Response, g
 from pymongo.mongo_client import MongoClient
-from pymongo import DESCENDING
+from pymongo import DESCENDING, ASCENDING, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import ObjectId
 from dotenv import load_dotenv
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 import os
+import sys
+import bisect
 import datetime
 import time
-import queue
 import json
+import queue
+import uuid
+import threading
+import atexit
+from collections import deque, Counter
+from contextlib import contextmanager
 import pytz
 import requests
 
@@ -24,11 +33,10 @@ FROM_EMAIL = os.getenv("FROM_EMAIL_PROD")
 TO_EMAIL = os.getenv("TO_EMAIL_PROD")
 
 print(f"--- Configurações nuvem.py ---")
-print(f"MONGO_URI_PROD: {MONGO_URI}")
+print(f"MONGO_URI_PROD: {'********' if MONGO_URI else None}")
 print(f"SENDGRID_API_KEY_PROD: {'********' if SENDGRID_API_KEY else None}") 
 print(f"PORT: {os.getenv('PORT', 8080)}")
 print(f"-----------------------------")
-cache_ultimo_estado = None
 
 # Validação 
 if not MONGO_URI:
@@ -36,8 +44,160 @@ if not MONGO_URI:
 if not SENDGRID_API_KEY:
     app.logger.warning("SENDGRID_API_KEY_PROD não configurado. Funcionalidade de email será afetada.")
 
+# --- Métricas (formato texto do Prometheus em /metrics) ---
+# Histogramas de latência por rota HTTP, por operação do MongoDB (monitoramento de comandos
+# do pymongo, que cobre todas as coleções sem embrulhar cada chamada) e das chamadas ao
+# SendGrid/Twitch, mais contadores e gauges lidos na hora do scrape.
+METRICAS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escapar_rotulo(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatar_rotulos(rotulos):
+    if not rotulos:
+        return ""
+    return "{" + ",".join(f'{chave}="{escapar_rotulo(valor)}"' for chave, valor in rotulos) + "}"
+
+
+class RegistroMetricas:
+    def __init__(self, buckets=METRICAS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._descricoes = {}  # nome -> (tipo, ajuda)
+        self._histogramas = {}  # nome -> {rótulos: [contagem por bucket..., +Inf, soma]}
+        self._contadores = {}  # nome -> {rótulos: valor}
+        self._gauges = []  # (nome, função) avaliados no scrape; a função devolve um número ou {rótulos: valor}
+
+    def descrever(self, nome, tipo, ajuda):
+        self._descricoes[nome] = (tipo, ajuda)
+
+    def observar(self, nome, valor, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        indice = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            series = self._histogramas.setdefault(nome, {})
+            serie = series.get(chave)
+            if serie is None:
+                serie = series[chave] = [0] * (len(self.buckets) + 1) + [0.0]
+            serie[indice] += 1
+            serie[-1] += valor
+
+    def incrementar(self, nome, valor=1, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        with self._lock:
+            series = self._contadores.setdefault(nome, {})
+            series[chave] = series.get(chave, 0) + valor
+
+    def gauge(self, nome, tipo, ajuda, funcao):
+        self.descrever(nome, tipo, ajuda)
+        self._gauges.append((nome, funcao))
+
+    @contextmanager
+    def cronometrar(self, nome, **rotulos):
+        inicio = time.perf_counter()
+        resultado = "erro"
+        try:
+            yield
+            resultado = "ok"
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, resultado=resultado, **rotulos)
+
+    def renderizar(self):
+        linhas = []
+
+        def cabecalho(nome):
+            tipo, ajuda = self._descricoes.get(nome, ("untyped", nome))
+            linhas.append(f"# HELP {nome} {ajuda}")
+            linhas.append(f"# TYPE {nome} {tipo}")
+
+        with self._lock:
+            histogramas = {nome: {chave: list(serie) for chave, serie in series.items()}
+                           for nome, series in self._histogramas.items()}
+            contadores = {nome: dict(series) for nome, series in self._contadores.items()}
+        limites = [f"{limite:g}" for limite in self.buckets] + ["+Inf"]
+        for nome, series in sorted(histogramas.items()):
+            cabecalho(nome)
+            for chave, serie in sorted(series.items()):
+                acumulado = 0
+                for limite, contagem in zip(limites, serie[:-1]):
+                    acumulado += contagem
+                    linhas.append(f"{nome}_bucket{formatar_rotulos(chave + (('le', limite),))} {acumulado}")
+                linhas.append(f"{nome}_sum{formatar_rotulos(chave)} {serie[-1]}")
+                linhas.append(f"{nome}_count{formatar_rotulos(chave)} {acumulado}")
+        for nome, series in sorted(contadores.items()):
+            cabecalho(nome)
+            for chave, valor in sorted(series.items()):
+                linhas.append(f"{nome}{formatar_rotulos(chave)} {valor}")
+        for nome, funcao in self._gauges:
+            try:
+                valor = funcao()
+            except Exception as e:
+                app.logger.warning(f"Erro ao calcular a métrica {nome}: {e}")
+                continue
+            if valor is None or valor == {}:
+                continue
+            cabecalho(nome)
+            for chave, v in (valor.items() if isinstance(valor, dict) else [((), valor)]):
+                linhas.append(f"{nome}{formatar_rotulos(chave)} {v}")
+        return "\n".join(linhas) + "\n"
+
+
+metricas = RegistroMetricas()
+metricas.descrever("estufa_http_requisicao_segundos", "histogram", "Latência das rotas HTTP até o início da resposta")
+metricas.descrever("estufa_mongo_operacao_segundos", "histogram", "Duração dos comandos enviados ao MongoDB")
+metricas.descrever("estufa_servico_externo_segundos", "histogram", "Duração das chamadas ao SendGrid e à Twitch")
+metricas.descrever("estufa_live_eventos_total", "counter", "Live updates recebidos da borda")
+metricas.descrever("estufa_ingestao_rejeitadas_total", "counter", "Requisições de leitura recusadas com o buffer cheio")
+metricas.descrever("estufa_comandos_falhos_total", "counter", "Comandos abandonados após COMANDOS_ENTREGAS_MAXIMAS entregas sem confirmação")
+
+
+class MonitorMongo(monitoring.CommandListener):
+    def __init__(self, registro):
+        self.registro = registro
+        self._lock = threading.Lock()
+        self._colecoes = {}  # comando em andamento -> nome da coleção
+
+    def started(self, event):
+        colecao = event.command.get(event.command_name)
+        with self._lock:
+            self._colecoes[(event.connection_id, event.request_id)] = colecao if isinstance(colecao, str) else ""
+
+    def _finalizar(self, event, resultado):
+        with self._lock:
+            colecao = self._colecoes.pop((event.connection_id, event.request_id), "")
+        self.registro.observar("estufa_mongo_operacao_segundos", event.duration_micros / 1e6,
+                               operacao=event.command_name, colecao=colecao, resultado=resultado)
+
+    def succeeded(self, event):
+        self._finalizar(event, "ok")
+
+    def failed(self, event):
+        self._finalizar(event, "erro")
+
+
+monitor_mongo = MonitorMongo(metricas)
+
+
+@app.before_request
+def iniciar_cronometro_requisicao():
+    g.inicio_requisicao = time.perf_counter()
+
+
+@app.after_request
+def registrar_latencia_requisicao(response):
+    inicio = g.pop("inicio_requisicao", None)
+    if inicio is not None:
+        # Rótulo pela regra (/api/relatorios/<job_id>), não pela URL, para não explodir as séries
+        rota = request.url_rule.rule if request.url_rule else "nao_encontrada"
+        metricas.observar("estufa_http_requisicao_segundos", time.perf_counter() - inicio,
+                          metodo=request.method, rota=rota, status=response.status_code)
+    return response
+
+
 try:
-    client = MongoClient(MONGO_URI)
+    client = MongoClient(MONGO_URI, event_listeners=[monitor_mongo])
     db = client["EstufaBD"]
     colecao_leituras = db["LeiturasTable"]
     colecao_comandos = db["ComandosTable"]
@@ -48,8 +208,622 @@ except Exception as e:
     app.logger.error(f"Erro ao conectar com MongoDB: {e}")
     client = None  
 
-# Fila para armazenar as atualizações ao vivo que serão enviadas via SSE
-live_update_queue = queue.Queue()
+# --- Fila de comandos ---
+# Um comando é reivindicado atomicamente (find_one_and_update) e, quando a borda pede
+# com ack=1, recebe um lease: se a borda não confirmar em COMANDOS_LEASE_SEGUNDOS ele
+# volta a ser entregue, até COMANDOS_ENTREGAS_MAXIMAS entregas; depois disso o comando
+# termina como 'falhou'. Comandos concluídos ganham 'concluido_em' e o índice TTL os
+# remove depois de COMANDOS_TTL_SEGUNDOS.
+COMANDOS_LEASE_SEGUNDOS = int(os.getenv("COMANDOS_LEASE_SEGUNDOS", 60))
+COMANDOS_ENTREGAS_MAXIMAS = int(os.getenv("COMANDOS_ENTREGAS_MAXIMAS", 5))
+COMANDOS_TTL_SEGUNDOS = int(os.getenv("COMANDOS_TTL_SEGUNDOS", 7 * 24 * 3600))
+COMANDOS_POR_ENTREGA = 5
+
+
+def criar_indices_comandos():
+    try:
+        colecao_comandos.create_index(
+            [("device_id", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING)],
+            name="fila_por_dispositivo")
+        # Usado pelo gauge de /metrics, que só conta os comandos ainda ativos
+        colecao_comandos.create_index("status", name="por_status")
+        colecao_comandos.create_index("concluido_em", name="ttl_concluidos",
+                                      expireAfterSeconds=COMANDOS_TTL_SEGUNDOS)
+    except Exception as e:
+        app.logger.error(f"Erro ao criar índices de 'ComandosTable': {e}")
+
+
+# --- Coleção de leituras ---
+# LeiturasTable é criada como coleção time-series (MongoDB 5.0+) com device_id como
+# metaField. Se ela já existir como coleção comum, ou o servidor não suportar
+# time-series, garantimos ao menos os índices usados pelas consultas por tempo.
+def provisionar_colecao_leituras():
+    try:
+        if "LeiturasTable" not in db.list_collection_names():
+            db.create_collection("LeiturasTable", timeseries={
+                "timeField": "timestamp",
+                "metaField": "device_id",
+                "granularity": "minutes"
+            })
+            app.logger.info("Coleção time-series 'LeiturasTable' criada.")
+    except Exception as e:
+        app.logger.warning(f"Não foi possível criar 'LeiturasTable' como time-series: {e}")
+    try:
+        colecao_leituras.create_index([("timestamp", DESCENDING)], name="por_timestamp")
+        colecao_leituras.create_index([("device_id", ASCENDING), ("timestamp", DESCENDING)],
+                                      name="por_dispositivo_timestamp")
+    except Exception as e:
+        app.logger.error(f"Erro ao criar índices de 'LeiturasTable': {e}")
+
+
+if client:
+    criar_indices_comandos()
+    provisionar_colecao_leituras()
+
+# --- Broadcaster das atualizações ao vivo (SSE) ---
+# Cada cliente do /stream recebe seu próprio buffer circular limitado. Um publish
+# entrega o evento a todos os assinantes; se um cliente lento encher o buffer,
+# os eventos mais antigos são descartados em vez de bloquear quem publica.
+LIVE_BUFFER_TAMANHO = int(os.getenv("LIVE_BUFFER_TAMANHO", 100))
+SSE_KEEPALIVE_SEGUNDOS = float(os.getenv("SSE_KEEPALIVE_SEGUNDOS", 15))
+SSE_COALESCER_SEGUNDOS = float(os.getenv("SSE_COALESCER_SEGUNDOS", 0.05))
+
+
+class AssinanteLive:
+    def __init__(self, tamanho_buffer, dispositivos=None):
+        self.buffer = deque(maxlen=tamanho_buffer)
+        self.condicao = threading.Condition()
+        self.descartados = 0
+        self.dispositivos = dispositivos  # None = recebe eventos de todos os device_id
+
+    def entregar(self, evento):
+        with self.condicao:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.descartados += 1  # deque com maxlen descarta o mais antigo
+            self.buffer.append(evento)
+            self.condicao.notify()
+
+    def obter(self, timeout=None):
+        # Retorna o próximo evento ou None se o timeout expirar
+        with self.condicao:
+            if not self.buffer:
+                self.condicao.wait(timeout)
+            if self.buffer:
+                return self.buffer.popleft()
+            return None
+
+    def drenar(self):
+        # Retira de uma vez todos os eventos já acumulados
+        with self.condicao:
+            eventos = list(self.buffer)
+            self.buffer.clear()
+            return eventos
+
+
+class LiveBroadcaster:
+    def __init__(self, tamanho_buffer=LIVE_BUFFER_TAMANHO):
+        self.tamanho_buffer = tamanho_buffer
+        self._lock = threading.Lock()
+        self._todos = set()
+        self._por_dispositivo = {}  # device_id -> assinantes filtrados por esse dispositivo
+        self._descartados_encerrados = 0  # descartes de assinantes que já saíram
+
+    def assinar(self, dispositivos=None):
+        return self.registrar(AssinanteLive(self.tamanho_buffer, dispositivos))
+
+    def registrar(self, assinante):
+        # Aceita qualquer objeto com entregar(evento) e dispositivos, como o AssinanteAsync do modo ASGI
+        with self._lock:
+            if assinante.dispositivos is None:
+                self._todos.add(assinante)
+            else:
+                for device_id in assinante.dispositivos:
+                    self._por_dispositivo.setdefault(device_id, set()).add(assinante)
+        return assinante
+
+    def cancelar(self, assinante):
+        with self._lock:
+            if assinante in self._todos or any(assinante in assinantes for assinantes in self._por_dispositivo.values()):
+                self._descartados_encerrados += assinante.descartados
+            self._todos.discard(assinante)
+            for device_id in assinante.dispositivos or ():
+                assinantes = self._por_dispositivo.get(device_id)
+                if assinantes is not None:
+                    assinantes.discard(assinante)
+                    if not assinantes:
+                        del self._por_dispositivo[device_id]
+
+    def publicar(self, evento):
+        # Copia os conjuntos para não segurar o lock enquanto entrega
+        with self._lock:
+            assinantes = list(self._todos)
+            assinantes.extend(self._por_dispositivo.get(evento.get("device_id"), ()))
+        for assinante in assinantes:
+            assinante.entregar(evento)
+        return len(assinantes)
+
+    def total_assinantes(self):
+        with self._lock:
+            return len(self._todos | set().union(*self._por_dispositivo.values()))
+
+    def profundidade_buffers(self):
+        # (soma, maior) dos eventos aguardando entrega nos buffers dos assinantes
+        with self._lock:
+            assinantes = self._todos | set().union(*self._por_dispositivo.values())
+        tamanhos = [len(assinante.buffer) for assinante in assinantes]
+        return sum(tamanhos), max(tamanhos, default=0)
+
+    def total_descartados(self):
+        with self._lock:
+            assinantes = self._todos | set().union(*self._por_dispositivo.values())
+            return self._descartados_encerrados + sum(assinante.descartados for assinante in assinantes)
+
+
+live_broadcaster = LiveBroadcaster()
+
+# --- Rollups (agregados por hora e por dia) ---
+# Cada lote gravado atualiza incrementalmente um documento por (device_id, resolução,
+# início do intervalo) em LeiturasRollup com min/max/soma/contagem de temperatura e
+# luminosidade e a soma dos contadores *_times_on e *_segundos_ligado. A média é
+# soma/contagem na leitura. Snapshots com "estatisticas" da janela entram com o min/max
+# da janela e a soma ponderada pelo número de leituras.
+# Os intervalos são em UTC: o bucket de um dia vai de 00:00 a 24:00 UTC (21:00 a 21:00 em
+# America/Sao_Paulo), não de meia-noite a meia-noite no horário local.
+RESOLUCOES_ROLLUP = {
+    "hora": datetime.timedelta(hours=1),
+    "dia": datetime.timedelta(days=1),
+}
+CAMPOS_ROLLUP_ESTATISTICA = ("temperatura", "luminosidade")
+CAMPOS_SEGUNDOS_LIGADO = ("irrigador_segundos_ligado", "lampada_segundos_ligado",
+                          "aquecedor_segundos_ligado", "refrigerador_segundos_ligado")
+CAMPOS_ROLLUP_CONTADOR = ("irrigador_times_on", "lampada_times_on", "aquecedor_times_on",
+                          "refrigerador_times_on") + CAMPOS_SEGUNDOS_LIGADO
+# Só os campos dos gráficos: telemetria e estatísticas da janela ficam de fora dos pontos raw
+PROJECAO_HISTORICO_RAW = dict({"_id": 0, "timestamp": 1, "luminosidade": 1, "umidade": 1, "temperatura": 1},
+                              **dict.fromkeys(CAMPOS_ROLLUP_CONTADOR, 1))
+HISTORICO_PONTOS_MAXIMO = int(os.getenv("HISTORICO_PONTOS_MAXIMO", 500))
+INTERVALO_SNAPSHOT = datetime.timedelta(minutes=5)  # período de envio dos snapshots da borda
+
+colecao_rollup = db["LeiturasRollup"] if client else None
+
+
+def para_utc_ingenuo(dt):
+    # O pymongo devolve datetimes UTC sem tzinfo; normaliza para comparar e agrupar
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def inicio_do_intervalo(dt, resolucao):
+    # dt em UTC (para_utc_ingenuo)
+    if resolucao == "hora":
+        return dt.replace(minute=0, second=0, microsecond=0)
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def criar_indices_rollup():
+    try:
+        colecao_rollup.create_index(
+            [("device_id", ASCENDING), ("resolucao", ASCENDING), ("inicio", ASCENDING)],
+            name="rollup_por_intervalo", unique=True)
+    except Exception as e:
+        app.logger.error(f"Erro ao criar índices de 'LeiturasRollup': {e}")
+
+
+def atualizar_rollups(docs):
+    # Pré-agrega o lote em memória para fazer um único upsert por intervalo
+    parciais = {}
+    for doc in docs:
+        ts = para_utc_ingenuo(doc["timestamp"])
+        for resolucao in RESOLUCOES_ROLLUP:
+            chave = (doc.get("device_id"), resolucao, inicio_do_intervalo(ts, resolucao))
+            p = parciais.setdefault(chave, {"min": {}, "max": {}, "inc": {"contagem": 0}})
+            p["inc"]["contagem"] += 1
+            for campo in CAMPOS_ROLLUP_ESTATISTICA:
+                janela = doc.get("estatisticas", {}).get(campo)
+                if janela:
+                    minimo, maximo, n = janela["min"], janela["max"], janela["n"]
+                    soma = janela["media"] * n
+                elif doc.get(campo) is not None:
+                    minimo = maximo = soma = doc[campo]
+                    n = 1
+                else:
+                    continue
+                p["min"][f"{campo}_min"] = min(minimo, p["min"].get(f"{campo}_min", minimo))
+                p["max"][f"{campo}_max"] = max(maximo, p["max"].get(f"{campo}_max", maximo))
+                p["inc"][f"{campo}_soma"] = p["inc"].get(f"{campo}_soma", 0) + soma
+                p["inc"][f"{campo}_contagem"] = p["inc"].get(f"{campo}_contagem", 0) + n
+            for campo in CAMPOS_ROLLUP_CONTADOR:
+                p["inc"][campo] = p["inc"].get(campo, 0) + doc.get(campo, 0)
+
+    operacoes = []
+    for (device_id, resolucao, inicio), p in parciais.items():
+        atualizacao = {"$inc": p["inc"]}
+        if p["min"]:
+            atualizacao["$min"] = p["min"]
+            atualizacao["$max"] = p["max"]
+        operacoes.append(UpdateOne(
+            {"device_id": device_id, "resolucao": resolucao, "inicio": inicio},
+            atualizacao, upsert=True))
+    if operacoes:
+        colecao_rollup.bulk_write(operacoes, ordered=False)
+
+
+def formatar_ponto_rollup(r):
+    ponto = {"inicio": r["inicio"].isoformat(), "contagem": r.get("contagem", 0)}
+    for campo in CAMPOS_ROLLUP_ESTATISTICA:
+        contagem = r.get(f"{campo}_contagem", 0)
+        ponto[campo] = {
+            "min": r.get(f"{campo}_min"),
+            "max": r.get(f"{campo}_max"),
+            "media": r.get(f"{campo}_soma", 0) / contagem if contagem else None
+        }
+    for campo in CAMPOS_ROLLUP_CONTADOR:
+        ponto[campo] = r.get(campo, 0)
+    return ponto
+
+
+def escolher_resolucao(inicio, fim):
+    # Usa a resolução mais fina cujo número de pontos cabe em HISTORICO_PONTOS_MAXIMO
+    duracao = fim - inicio
+    if duracao / INTERVALO_SNAPSHOT <= HISTORICO_PONTOS_MAXIMO:
+        return "raw"
+    if duracao / RESOLUCOES_ROLLUP["hora"] <= HISTORICO_PONTOS_MAXIMO:
+        return "hora"
+    return "dia"
+
+
+# --- Ingestão em lote das leituras (write-behind) ---
+# As leituras validadas vão para um buffer em memória e uma thread grava em lote
+# com insert_many quando o lote atinge INGESTAO_LOTE_MAXIMO ou fica mais velho
+# que INGESTAO_IDADE_MAXIMA. Com o buffer cheio a API responde 503 (backpressure).
+INGESTAO_LOTE_MAXIMO = int(os.getenv("INGESTAO_LOTE_MAXIMO", 500))
+INGESTAO_IDADE_MAXIMA = float(os.getenv("INGESTAO_IDADE_MAXIMA", 1.0))
+INGESTAO_BUFFER_MAXIMO = int(os.getenv("INGESTAO_BUFFER_MAXIMO", 10000))
+
+
+class IngestaoLeituras:
+    def __init__(self, colecao, lote_maximo=INGESTAO_LOTE_MAXIMO,
+                 idade_maxima=INGESTAO_IDADE_MAXIMA, buffer_maximo=INGESTAO_BUFFER_MAXIMO, ao_gravar=None):
+        self.colecao = colecao
+        self.ao_gravar = ao_gravar  # chamado com os documentos efetivamente gravados
+        self.lote_maximo = lote_maximo
+        self.idade_maxima = idade_maxima
+        self.buffer_maximo = buffer_maximo
+        self._buffer = []
+        self._primeiro_em = None  # monotonic do documento mais antigo no buffer
+        self._condicao = threading.Condition()
+        self._thread = None
+        self._encerrando = False
+
+    def _iniciar_thread(self):
+        # Iniciada sob demanda para não criar a thread antes de um fork (gunicorn)
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="ingestao-leituras", daemon=True)
+            self._thread.start()
+
+    def enfileirar(self, docs):
+        # Retorna False se não houver espaço para o lote inteiro
+        with self._condicao:
+            if self._encerrando or len(self._buffer) + len(docs) > self.buffer_maximo:
+                return False
+            if not self._buffer:
+                self._primeiro_em = time.monotonic()
+            self._buffer.extend(docs)
+            self._iniciar_thread()
+            if len(self._buffer) >= self.lote_maximo:
+                self._condicao.notify()
+            return True
+
+    def tamanho(self):
+        with self._condicao:
+            return len(self._buffer)
+
+    def _retirar_lote(self):
+        lote = self._buffer[:self.lote_maximo]
+        del self._buffer[:self.lote_maximo]
+        self._primeiro_em = time.monotonic() if self._buffer else None
+        return lote
+
+    def _loop(self):
+        while True:
+            with self._condicao:
+                while not self._encerrando:
+                    if len(self._buffer) >= self.lote_maximo:
+                        break
+                    if self._buffer:
+                        restante = self.idade_maxima - (time.monotonic() - self._primeiro_em)
+                        if restante <= 0:
+                            break
+                        self._condicao.wait(restante)
+                    else:
+                        self._condicao.wait()
+                if self._encerrando and not self._buffer:
+                    return
+                lote = self._retirar_lote()
+            if not self._gravar(lote):
+                time.sleep(1)  # Banco indisponível; espera antes de tentar de novo
+
+    def _gravar(self, lote):
+        try:
+            self.colecao.insert_many(lote, ordered=False)
+            self._notificar_gravados(lote)
+            return True
+        except BulkWriteError as e:
+            # Com ordered=False os documentos válidos já foram gravados
+            erros = e.details.get('writeErrors', [])
+            app.logger.error(f"Erro parcial ao gravar lote de leituras: {erros[:3]}")
+            indices_com_erro = {erro.get('index') for erro in erros}
+            self._notificar_gravados([doc for i, doc in enumerate(lote) if i not in indices_com_erro])
+            return True
+        except Exception as e:
+            app.logger.error(f"Erro ao gravar lote de {len(lote)} leituras: {e}")
+            with self._condicao:
+                # Devolve o lote para o início do buffer, respeitando o limite
+                espaco = self.buffer_maximo - len(self._buffer)
+                if espaco > 0:
+                    self._buffer[:0] = lote[:espaco]
+                    self._primeiro_em = time.monotonic()
+                if espaco < len(lote):
+                    app.logger.error(f"{len(lote) - max(espaco, 0)} leituras descartadas (buffer cheio).")
+            return False
+
+    def _notificar_gravados(self, docs):
+        if not self.ao_gravar or not docs:
+            return
+        try:
+            self.ao_gravar(docs)
+        except Exception as e:
+            app.logger.error(f"Erro no pós-processamento do lote de leituras: {e}")
+
+    def encerrar(self, timeout=10):
+        # Grava o que restou no buffer antes de o processo terminar
+        with self._condicao:
+            self._encerrando = True
+            self._condicao.notify_all()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout)
+        else:
+            with self._condicao:
+                while self._buffer:
+                    lote = self._retirar_lote()
+                    if not self._gravar(lote):
+                        break
+
+
+if client:
+    criar_indices_rollup()
+
+ingestao_leituras = IngestaoLeituras(colecao_leituras, ao_gravar=atualizar_rollups) if client else None
+if ingestao_leituras:
+    atexit.register(ingestao_leituras.encerrar)
+
+
+# --- Notificação de comandos para o long-poll da borda ---
+# Cada device_id tem um contador de versão; quem enfileira um comando incrementa
+# e acorda as conexões de /api/comandos/aguardar daquele dispositivo, que só então
+# consultam o Mongo de novo.
+COMANDOS_LONGPOLL_MAXIMO = float(os.getenv("COMANDOS_LONGPOLL_MAXIMO", 30))
+
+
+class NotificadorComandos:
+    def __init__(self):
+        self._condicao = threading.Condition()
+        self._versoes = {}
+        self._ouvintes = {}  # device_id -> callbacks (usado pelo long-poll assíncrono)
+
+    def versao(self, device_id):
+        with self._condicao:
+            return self._versoes.get(device_id, 0)
+
+    def notificar(self, device_id):
+        with self._condicao:
+            self._versoes[device_id] = self._versoes.get(device_id, 0) + 1
+            self._condicao.notify_all()
+            ouvintes = list(self._ouvintes.get(device_id, ()))
+        for callback in ouvintes:
+            callback()
+
+    def ouvir(self, device_id, callback):
+        with self._condicao:
+            self._ouvintes.setdefault(device_id, set()).add(callback)
+
+    def deixar_de_ouvir(self, device_id, callback):
+        with self._condicao:
+            ouvintes = self._ouvintes.get(device_id)
+            if ouvintes:
+                ouvintes.discard(callback)
+                if not ouvintes:
+                    del self._ouvintes[device_id]
+
+    def aguardar(self, device_id, versao, timeout):
+        # Retorna True se chegou comando novo para o device_id antes do timeout
+        with self._condicao:
+            return self._condicao.wait_for(lambda: self._versoes.get(device_id, 0) != versao, timeout)
+
+
+notificador_comandos = NotificadorComandos()
+
+
+# --- Backend de estado e pub/sub ---
+# O último estado de cada device_id e os eventos (live updates e avisos de comando novo)
+# passam por um backend plugável, escolhido por ESTADO_BACKEND:
+#  - "local": tudo em memória do processo (um único worker)
+#  - "redis": estado em um hash no Redis e eventos por PUBLISH/SUBSCRIBE, para que
+#    todos os workers/containers vejam o mesmo estado e recebam todos os eventos
+# Quem publica não entrega direto aos assinantes locais: o evento volta pelo backend,
+# então cada worker o recebe exatamente uma vez.
+ESTADO_BACKEND = os.getenv("ESTADO_BACKEND", "local").lower()
+DISPOSITIVO_INATIVO_SEGUNDOS = float(os.getenv("DISPOSITIVO_INATIVO_SEGUNDOS", 24 * 3600))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+CANAIS_BACKEND = ("live", "comandos")
+
+
+def estado_ativo(estado, inativo_segundos):
+    # As leituras também filtram os inativos, então /api/estado_atual e o snapshot do /stream
+    # não servem um dispositivo parado mesmo antes de remover_inativos rodar
+    return estado is not None and estado.get("visto_em", 0) >= time.time() - inativo_segundos
+
+
+class BackendLocal:
+    # Copy-on-write: cada estado é um dict novo e o mapa inteiro é trocado a cada escrita,
+    # então leitores pegam a referência atual sem lock e nunca veem um estado pela metade.
+    def __init__(self, inativo_segundos=DISPOSITIVO_INATIVO_SEGUNDOS):
+        self.inativo_segundos = inativo_segundos
+        self._lock = threading.Lock()  # serializa apenas os escritores
+        self._estados = {}
+        self._ultimo_device = None
+        self._handlers = {}
+
+    def salvar_estado(self, estado):
+        with self._lock:
+            novos = dict(self._estados)
+            novos[estado.get("device_id")] = dict(estado)
+            self._estados = novos
+            self._ultimo_device = estado.get("device_id")
+
+    def obter_estado(self, device_id=None):
+        # Sem device_id devolve o estado do dispositivo que atualizou por último
+        if device_id is None:
+            device_id = self._ultimo_device
+        estado = self._estados.get(device_id)
+        return estado if estado_ativo(estado, self.inativo_segundos) else None
+
+    def listar_estados(self):
+        return [e for e in self._estados.values() if estado_ativo(e, self.inativo_segundos)]
+
+    def remover_inativos(self, visto_antes_de):
+        with self._lock:
+            inativos = [d for d, e in self._estados.items() if e.get("visto_em", 0) < visto_antes_de]
+            if inativos:
+                self._estados = {d: e for d, e in self._estados.items() if d not in inativos}
+                if self._ultimo_device in inativos:
+                    self._ultimo_device = None
+        return inativos
+
+    def inscrever(self, canal, handler):
+        self._handlers.setdefault(canal, []).append(handler)
+
+    def iniciar(self):
+        pass  # sem thread de fundo
+
+    def publicar(self, canal, mensagem):
+        for handler in self._handlers.get(canal, ()):
+            handler(mensagem)
+
+
+class BackendRedis:
+    PREFIXO = "estufa"
+
+    def __init__(self, url=REDIS_URL, cliente=None, inativo_segundos=DISPOSITIVO_INATIVO_SEGUNDOS):
+        self.inativo_segundos = inativo_segundos
+        if cliente is None:
+            import redis  # dependência só necessária com ESTADO_BACKEND=redis
+            cliente = redis.Redis.from_url(url)
+        self.redis = cliente  # injetável (ex.: fakeredis nos testes)
+        self._handlers = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def salvar_estado(self, estado):
+        # Cada estado é gravado inteiro com um HSET, então leitores nunca veem metade dele
+        device_id = str(estado.get("device_id"))
+        pipe = self.redis.pipeline()
+        pipe.hset(f"{self.PREFIXO}:estado", device_id, json.dumps(estado))
+        pipe.zadd(f"{self.PREFIXO}:visto", {device_id: estado.get("visto_em", 0)})
+        pipe.set(f"{self.PREFIXO}:estado:ultimo", device_id)
+        pipe.execute()
+
+    def listar_estados(self):
+        estados = (json.loads(dados) for dados in self.redis.hvals(f"{self.PREFIXO}:estado"))
+        return [e for e in estados if estado_ativo(e, self.inativo_segundos)]
+
+    def remover_inativos(self, visto_antes_de):
+        inativos = self.redis.zrangebyscore(f"{self.PREFIXO}:visto", "-inf", f"({visto_antes_de}")
+        if inativos:
+            pipe = self.redis.pipeline()
+            pipe.hdel(f"{self.PREFIXO}:estado", *inativos)
+            pipe.zrem(f"{self.PREFIXO}:visto", *inativos)
+            pipe.execute()
+        return [d.decode() if isinstance(d, bytes) else d for d in inativos]
+
+    def obter_estado(self, device_id=None):
+        if device_id is None:
+            device_id = self.redis.get(f"{self.PREFIXO}:estado:ultimo")
+            if device_id is None:
+                return None
+        dados = self.redis.hget(f"{self.PREFIXO}:estado", device_id)
+        estado = json.loads(dados) if dados else None
+        return estado if estado_ativo(estado, self.inativo_segundos) else None
+
+    def inscrever(self, canal, handler):
+        self._handlers.setdefault(canal, []).append(handler)
+
+    def iniciar(self):
+        # Iniciada sob demanda para não criar a thread antes de um fork (gunicorn --preload)
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._ouvir, name="backend-redis", daemon=True)
+                self._thread.start()
+
+    def publicar(self, canal, mensagem):
+        self.redis.publish(f"{self.PREFIXO}:{canal}", json.dumps(mensagem))
+
+    def _ouvir(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(*[f"{self.PREFIXO}:{canal}" for canal in CANAIS_BACKEND])
+                for mensagem in pubsub.listen():
+                    if mensagem.get("type") != "message":
+                        continue
+                    canal = mensagem["channel"]
+                    canal = canal.decode() if isinstance(canal, bytes) else canal
+                    dados = json.loads(mensagem["data"])
+                    for handler in self._handlers.get(canal.split(":", 1)[1], ()):
+                        handler(dados)
+            except Exception as e:
+                app.logger.error(f"Erro na assinatura do Redis, reconectando: {e}")
+                time.sleep(1)
+
+
+def criar_backend_estado():
+    if ESTADO_BACKEND == "redis":
+        return BackendRedis()
+    return BackendLocal()
+
+
+backend_estado = criar_backend_estado()
+backend_estado.inscrever("live", live_broadcaster.publicar)
+backend_estado.inscrever("comandos", notificador_comandos.notificar)
+
+
+# Threads de fundo que atendem o processo inteiro. Nunca no import: com gunicorn --preload o
+# import roda no master e as threads não sobrevivem ao fork. Cada worker as inicia na
+# primeira requisição (ou no lifespan do modo ASGI).
+def iniciar_servicos():
+    backend_estado.iniciar()
+    if fila_relatorios:
+        fila_relatorios.iniciar_workers()
+
+
+@app.before_request
+def garantir_servicos():
+    iniciar_servicos()
+
+
+def remover_dispositivos_inativos():
+    inativos = backend_estado.remover_inativos(time.time() - DISPOSITIVO_INATIVO_SEGUNDOS)
+    if inativos:
+        app.logger.info(f"Dispositivos removidos do cache por inatividade: {inativos}")
+
+
+def avisar_comando_novo(device_id):
+    # Acorda os long-polls do device_id em todos os workers
+    backend_estado.publicar("comandos", device_id)
+
 
 # --- Endpoints para o Cliente ---
 # --- ROTA PARA SERVIR A INTERFACE DO CLIENTE ---
@@ -66,28 +840,102 @@ def home():
 
 
 # --- Endpoints para o Servidor de Borda ---
+CAMPOS_ESTATISTICA_JANELA = ("luminosidade", "umidade", "temperatura")
+
+
+def montar_estatisticas_janela(estatisticas):
+    # Valida o resumo da janela enviado pela borda: {sensor: {n, min, max, media, variancia, ultimo}}
+    resultado = {}
+    for campo in CAMPOS_ESTATISTICA_JANELA:
+        e = estatisticas.get(campo)
+        if e is None:
+            continue
+        n = int(e["n"])
+        if n < 1:
+            raise ValueError(f"estatisticas.{campo}.n deve ser positivo")
+        resultado[campo] = {"n": n, "min": float(e["min"]), "max": float(e["max"]),
+                            "media": float(e["media"]), "variancia": float(e.get("variancia", 0.0)),
+                            "ultimo": float(e["ultimo"])}
+    return resultado
+
+
+def montar_documento_leitura(data):
+    # Valida e converte uma leitura recebida da borda. Lança exceção se inválida.
+    doc = {
+        "device_id": str(data.get("device_id") or "desconhecido"),
+        "timestamp": datetime.datetime.fromisoformat(data["timestamp"]),
+        "luminosidade": float(data["luminosidade"]),
+        "umidade": int(data["umidade"]),
+        "temperatura": float(data["temperatura"]),
+        "irrigador_times_on": int(data.get("irrigador_times_on", 0)),
+        "lampada_times_on": int(data.get("lampada_times_on", 0)),
+        "aquecedor_times_on": int(data.get("aquecedor_times_on", 0)),
+        "refrigerador_times_on": int(data.get("refrigerador_times_on", 0)),
+        "received_at": datetime.datetime.utcnow()
+    }
+    # Snapshots agregados: estatísticas da janela e tempo ligado de cada atuador
+    if data.get("estatisticas"):
+        doc["estatisticas"] = montar_estatisticas_janela(data["estatisticas"])
+        doc["janela_segundos"] = float(data.get("janela_segundos", 0))
+    for campo in CAMPOS_SEGUNDOS_LIGADO:
+        if campo in data:
+            doc[campo] = float(data[campo])
+    # Resumo de saúde da borda (threads, filas, erros HTTP) enviado junto com o snapshot
+    if isinstance(data.get("telemetria"), dict):
+        doc["telemetria"] = data["telemetria"]
+    return doc
+
+
+def resposta_buffer_cheio():
+    metricas.incrementar("estufa_ingestao_rejeitadas_total")
+    resposta = jsonify({"error": "Buffer de ingestão cheio. Tente novamente em instantes."})
+    resposta.headers["Retry-After"] = "1"
+    return resposta, 503
+
+
 @app.route('/api/leituras', methods=['POST','GET'])
 def receber_leituras():
     if not client:  # Verifica se a conexão com o DB está ativa
         return jsonify({"error": "Conexão com o banco de dados indisponível"}), 500
     data = request.json
     try:
-        doc = {
-            "timestamp": datetime.datetime.fromisoformat(data["timestamp"]),
-            "luminosidade": float(data["luminosidade"]),
-            "umidade": int(data["umidade"]),
-            "temperatura": float(data["temperatura"]),
-            "irrigador_times_on": int(data.get("irrigador_times_on", 0)),
-            "lampada_times_on": int(data.get("lampada_times_on", 0)),
-            "aquecedor_times_on": int(data.get("aquecedor_times_on", 0)),
-            "refrigerador_times_on": int(data.get("refrigerador_times_on", 0)),
-            "received_at": datetime.datetime.utcnow()
-        }
-        colecao_leituras.insert_one(doc)
-        return jsonify({"message": "Leitura recebida com sucesso"}), 201
+        doc = montar_documento_leitura(data)
     except Exception as e:
         app.logger.error(f"Erro ao processar leitura: {e}")
         return jsonify({"error": str(e)}), 400
+    if not ingestao_leituras.enfileirar([doc]):
+        return resposta_buffer_cheio()
+    return jsonify({"message": "Leitura recebida com sucesso"}), 202
+
+
+# Recebe várias leituras em um único POST (lista JSON ou {"leituras": [...]})
+@app.route('/api/leituras/batch', methods=['POST'])
+def receber_leituras_lote():
+    if not client:
+        return jsonify({"error": "Conexão com o banco de dados indisponível"}), 500
+    data = request.json
+    if isinstance(data, dict):
+        data = data.get("leituras")
+    if not isinstance(data, list) or not data:
+        return jsonify({"error": "Envie uma lista não vazia de leituras"}), 400
+    if len(data) > INGESTAO_BUFFER_MAXIMO:
+        return jsonify({"error": f"Lote maior que o limite de {INGESTAO_BUFFER_MAXIMO} leituras"}), 413
+
+    docs = []
+    rejeitadas = []
+    for indice, item in enumerate(data):
+        try:
+            docs.append(montar_documento_leitura(item))
+        except Exception as e:
+            rejeitadas.append({"indice": indice, "error": str(e)})
+    if not docs:
+        return jsonify({"error": "Nenhuma leitura válida no lote", "rejeitadas": rejeitadas}), 400
+    if rejeitadas:
+        app.logger.warning(f"{len(rejeitadas)} leituras rejeitadas no lote de {len(data)}")
+    if not ingestao_leituras.enfileirar(docs):
+        return resposta_buffer_cheio()
+    return jsonify({"message": f"{len(docs)} leituras recebidas", "aceitas": len(docs),
+                    "rejeitadas": rejeitadas}), 202
 
 #Rota que atualiza os limites na borda para o piloto automatico. Eles são salvos no banco também
 
@@ -118,6 +966,7 @@ def atualizar_limites():
             {"device_id": device_id, "comando": f"set_limiteTemp_{limite_temp}", "status": "pendente", "created_at": datetime.datetime.utcnow()},
             {"device_id": device_id, "comando": f"set_limiteLuz_{limite_luz}", "status": "pendente", "created_at": datetime.datetime.utcnow()}
         ])
+        avisar_comando_novo(device_id)
 
         return jsonify({"message": "Limites atualizados e comandos enviados para a borda."}), 200
     except Exception as e:
@@ -145,21 +994,26 @@ def limites_atuais():
 
 
 # ATUALIZAÇÕES AO VIVO da borda. ELE NAO MANDA PRO MONGO, SÓ PRO CLIENTE
+def registrar_live_update(data):
+    live_data_payload = {
+        "device_id": data.get("device_id"),
+        "timestamp": data.get("timestamp"),
+        "luminosidade": data.get("luminosidade"),
+        "umidade": data.get("umidade"),
+        "temperatura": data.get("temperatura"),
+        "estado_atuadores": data.get("estado_atuadores", {})
+    }
+    backend_estado.salvar_estado(dict(live_data_payload, visto_em=time.time()))
+    backend_estado.publicar("live", live_data_payload)
+    metricas.incrementar("estufa_live_eventos_total")
+    return live_data_payload
+
+
 @app.route('/api/live_update', methods=['POST'])
 def receber_live_update():
-    global cache_ultimo_estado
     data = request.json
     try:
-        live_data_payload = {
-            "device_id": data.get("device_id"),
-            "timestamp": data.get("timestamp"),
-            "luminosidade": data.get("luminosidade"),
-            "umidade": data.get("umidade"),
-            "temperatura": data.get("temperatura"),
-            "estado_atuadores": data.get("estado_atuadores", {})
-        }
-        cache_ultimo_estado = live_data_payload  
-        live_update_queue.put(live_data_payload)
+        registrar_live_update(data)
         return jsonify({"message": "Live update recebido"}), 200
     except Exception as e:
         app.logger.error(f"Erro ao processar live update: {e}")
@@ -167,38 +1021,241 @@ def receber_live_update():
 
 
 # ROTA PRO CLIENTE QUE ENTROU AGORA NO APLICATIVO SABER O QUE ESTÁ LIGADO
+# Com ?device_id= devolve o estado daquele dispositivo; sem, o do último que atualizou
 @app.route('/api/estado_atual', methods=['GET'])
 def fornecer_estado_atual():
-    if cache_ultimo_estado:
-        return jsonify(cache_ultimo_estado), 200
+    estado = backend_estado.obter_estado(request.args.get('device_id'))
+    if estado:
+        return jsonify(estado), 200
     else:
         return jsonify({"error": "Nenhum estado disponível ainda."}), 404
 
+
+# Estado mais recente de todos os dispositivos conhecidos
+@app.route('/api/dispositivos', methods=['GET'])
+def listar_dispositivos():
+    remover_dispositivos_inativos()
+    agora = time.time()
+    # Monta dicts novos: os estados do backend local são compartilhados (copy-on-write)
+    dispositivos = sorted((dict(estado, visto_ha_segundos=round(agora - estado.get("visto_em", agora), 1))
+                           for estado in backend_estado.listar_estados()),
+                          key=lambda e: str(e.get("device_id")))
+    return jsonify(dispositivos), 200
+
+
+def dispositivos_do_filtro(valor):
+    # "?device_id=a,b" -> {"a", "b"}; ausente -> None (todos)
+    if not valor:
+        return None
+    return {d.strip() for d in valor.split(",") if d.strip()} or None
+
+
+# Formata como um evento SSE
+# O cliente JS vai escutar por eventos do tipo 'live_leitura'
+def formatar_evento_sse(data_to_send):
+    return f"event: live_leitura\ndata: {json.dumps(data_to_send)}\n\n"
+
+
+# --- Protocolo delta do /stream (?protocolo=delta) ---
+# O cliente recebe primeiro um evento 'snapshot' com o estado completo dos dispositivos e
+# depois eventos 'delta' só com os campos que mudaram. Eventos que chegam dentro de
+# SSE_COALESCER_SEGUNDOS viram um único quadro. Cada quadro leva 'seq' (também no id: do
+# SSE) e toda conexão (inclusive a reconexão automática com Last-Event-ID) começa com um
+# snapshot novo.
+# Cada dispositivo tem uma 'versao' que cresce a cada delta; o delta diz sobre qual versão
+# foi calculado ('base') e o cliente que não tiver essa versão reconecta para receber um
+# snapshot. Campos removidos vão na lista 'removidos' (caminhos como
+# "estado_atuadores.estadoLampada"), então null continua sendo um valor válido.
+# Um dispositivo que aparece depois do snapshot chega completo em 'dispositivos'.
+CAMPOS_FORA_DO_DELTA = ("visto_em",)
+
+
+def diferenca_estado(anterior, novo):
+    # Retorna (campos alterados, caminhos removidos)
+    diff = {}
+    removidos = []
+    for chave, valor in novo.items():
+        if chave in CAMPOS_FORA_DO_DELTA:
+            continue
+        valor_anterior = anterior.get(chave)
+        if isinstance(valor, dict) and isinstance(valor_anterior, dict):
+            sub = {k: v for k, v in valor.items() if k not in valor_anterior or valor_anterior[k] != v}
+            removidos.extend(f"{chave}.{k}" for k in valor_anterior if k not in valor)
+            if sub:
+                diff[chave] = sub
+        elif chave not in anterior or valor_anterior != valor:
+            diff[chave] = valor
+    removidos.extend(chave for chave in anterior if chave not in novo and chave not in CAMPOS_FORA_DO_DELTA)
+    return diff, removidos
+
+
+class CodificadorDeltaSSE:
+    def __init__(self):
+        self.seq = 0
+        self.estados = {}  # device_id -> último estado completo enviado a este cliente
+        self.versoes = {}  # device_id -> versão desse estado
+
+    def _quadro(self, tipo, dados):
+        self.seq += 1
+        dados["seq"] = self.seq
+        return f"id: {self.seq}\nevent: {tipo}\ndata: {json.dumps(dados)}\n\n"
+
+    def _registrar(self, estado):
+        device_id = estado.get("device_id")
+        self.estados[device_id] = {k: v for k, v in estado.items() if k not in CAMPOS_FORA_DO_DELTA}
+        self.versoes[device_id] = self.versoes.get(device_id, 0) + 1
+        return dict(self.estados[device_id], versao=self.versoes[device_id])
+
+    def snapshot(self, estados, resync=False):
+        self.estados = {}
+        self.versoes = {}
+        dispositivos = [self._registrar(estado) for estado in estados]
+        return self._quadro("snapshot", {"dispositivos": dispositivos, "resync": resync})
+
+    def delta(self, eventos):
+        # Só o último evento de cada dispositivo importa; retorna None se nada mudou
+        ultimos = {}
+        for evento in eventos:
+            ultimos[evento.get("device_id")] = evento
+        deltas = []
+        novos = []
+        for device_id, novo in ultimos.items():
+            if device_id not in self.estados:
+                novos.append(self._registrar(novo))
+                continue
+            diff, removidos = diferenca_estado(self.estados[device_id], novo)
+            if not diff and not removidos:
+                continue
+            base = self.versoes[device_id]
+            self._registrar(novo)
+            diff.update(device_id=device_id, base=base, versao=self.versoes[device_id])
+            if removidos:
+                diff["removidos"] = removidos
+            deltas.append(diff)
+        if not deltas and not novos:
+            return None
+        quadro = {"deltas": deltas}
+        if novos:
+            quadro["dispositivos"] = novos
+        return self._quadro("delta", quadro)
+
+
+def estados_iniciais(dispositivos):
+    if dispositivos is None:
+        return backend_estado.listar_estados()
+    return [e for e in (backend_estado.obter_estado(d) for d in sorted(dispositivos)) if e]
+
+
 # Rota para o STREAM de Server-Sent Events (SSE)
 @app.route('/stream')
 def stream():
+    dispositivos = dispositivos_do_filtro(request.args.get('device_id'))
+    assinante = live_broadcaster.assinar(dispositivos)
+    codificador = None
+    if request.args.get('protocolo') == 'delta':
+        codificador = CodificadorDeltaSSE()
+        quadro_inicial = codificador.snapshot(estados_iniciais(dispositivos),
+                                              resync=bool(request.headers.get('Last-Event-ID')))
+
     def event_stream():
         try:
+            if codificador:
+                yield quadro_inicial
+            else:
+                # O werkzeug só envia os cabeçalhos junto com o primeiro trecho; sem isto o
+                # cliente fica sem resposta até o primeiro evento ou keep-alive
+                yield ": conectado\n\n"
             while True:
-                # Espera por um novo item na fila (bloqueante com timeout)
-                try:
-                    data_to_send = live_update_queue.get(timeout=1) # Espera 1s
-                    # Formata como um evento SSE
-                    # O cliente JS vai escutar por eventos do tipo 'live_leitura'
-                    sse_event = f"event: live_leitura\ndata: {json.dumps(data_to_send)}\n\n"
-                    yield sse_event
-                    live_update_queue.task_done() # Indica que o item foi processado
-                except queue.Empty:
+                # Espera por um novo evento no buffer deste cliente (bloqueante com timeout)
+                data_to_send = assinante.obter(timeout=SSE_KEEPALIVE_SEGUNDOS)
+                if data_to_send is None:
                     # Se timeout, envia um comentário para manter a conexão viva
                     yield ": keep-alive\n\n" # Comentário SSE
-                time.sleep(0.1) # Pequeno delay para não sobrecarregar
+                    continue
+                if not codificador:
+                    yield formatar_evento_sse(data_to_send)
+                    continue
+                # Junta a rajada que chegar dentro da janela em um único quadro
+                time.sleep(SSE_COALESCER_SEGUNDOS)
+                quadro = codificador.delta([data_to_send] + assinante.drenar())
+                if quadro:
+                    yield quadro
         except GeneratorExit: # Cliente desconectou
             app.logger.info("Cliente SSE desconectado.")
         except Exception as e:
             app.logger.error(f"Erro no stream SSE: {e}")
+        finally:
+            live_broadcaster.cancelar(assinante)
 
     return Response(event_stream(), mimetype="text/event-stream")
 
+# Reivindica até COMANDOS_POR_ENTREGA comandos do device_id, um por vez e atomicamente,
+# para que duas consultas simultâneas nunca recebam o mesmo comando.
+# Com lease=True também reentrega comandos enviados cujo lease expirou sem confirmação.
+def montar_reivindicacao(device_id, lease):
+    # Retorna (filtro, atualização) do find_one_and_update usado para reivindicar
+    agora = datetime.datetime.utcnow()
+    filtro = {"device_id": device_id, "status": "pendente"}
+    if lease:
+        filtro = {"device_id": device_id, "$or": [
+            {"status": "pendente"},
+            {"status": "enviado", "lease_ate": {"$lt": agora}, "entregas": {"$lt": COMANDOS_ENTREGAS_MAXIMAS}}
+        ]}
+    atualizacao = {"$set": {"status": "enviado", "sent_at": agora}, "$inc": {"entregas": 1}}
+    if lease:
+        atualizacao["$set"]["lease_ate"] = agora + datetime.timedelta(seconds=COMANDOS_LEASE_SEGUNDOS)
+    else:
+        # Sem confirmação da borda o comando já é considerado concluído
+        atualizacao["$set"]["concluido_em"] = agora
+    return filtro, atualizacao
+
+
+def montar_desistencia(device_id):
+    # (filtro, atualização) do update_many que encerra como 'falhou' os comandos que
+    # esgotaram as entregas e cujo último lease venceu sem confirmação
+    agora = datetime.datetime.utcnow()
+    filtro = {"device_id": device_id, "status": "enviado", "lease_ate": {"$lt": agora},
+              "entregas": {"$gte": COMANDOS_ENTREGAS_MAXIMAS}}
+    return filtro, {"$set": {"status": "falhou", "concluido_em": agora}, "$unset": {"lease_ate": ""}}
+
+
+def registrar_desistencia(device_id, quantidade):
+    if quantidade:
+        metricas.incrementar("estufa_comandos_falhos_total", quantidade)
+        app.logger.warning(f"{quantidade} comando(s) de {device_id} sem confirmação após "
+                           f"{COMANDOS_ENTREGAS_MAXIMAS} entregas marcados como falhou")
+
+
+def formatar_comandos_reivindicados(device_id, comandos_reivindicados, lease):
+    if comandos_reivindicados:
+        app.logger.info(f"Enviando comandos {[c['comando'] for c in comandos_reivindicados]} para {device_id}")
+    if lease:
+        return [{"id": str(c["_id"]), "comando": c["comando"]} for c in comandos_reivindicados]
+    return [c["comando"] for c in comandos_reivindicados]
+
+
+def reivindicar_comandos(device_id, lease=False):
+    if lease:
+        resultado = colecao_comandos.update_many(*montar_desistencia(device_id))
+        registrar_desistencia(device_id, resultado.modified_count)
+    filtro, atualizacao = montar_reivindicacao(device_id, lease)
+    comandos_reivindicados = []
+    for _ in range(COMANDOS_POR_ENTREGA):
+        cmd_doc = colecao_comandos.find_one_and_update(
+            filtro, atualizacao,
+            sort=[("created_at", ASCENDING)],  # mais antigo primeiro
+            return_document=ReturnDocument.AFTER)
+        if not cmd_doc:
+            break
+        if 'comando' in cmd_doc:
+            comandos_reivindicados.append(cmd_doc)
+    return formatar_comandos_reivindicados(device_id, comandos_reivindicados, lease)
+
+
+def pedido_com_ack():
+    return request.args.get('ack', '').lower() in ('1', 'true', 'sim')
+
+
 # Rota para os comandos
 @app.route('/api/comandos', methods=['GET'])
 def fornecer_comandos():
@@ -209,24 +1266,7 @@ def fornecer_comandos():
     comandos_para_enviar = []
     if client:
         try:
-            # Pega até 5 comandos pendentes mais antigos para o device_id
-            comandos_pendentes_cursor = colecao_comandos.find(
-                {"device_id": device_id, "status": "pendente"}
-            ).sort("created_at", 1).limit(5)  # 1 para ASCENDING (mais antigo primeiro)
-
-            ids_para_atualizar = []
-            for cmd_doc in comandos_pendentes_cursor:
-                if 'comando' in cmd_doc:
-                    comandos_para_enviar.append(cmd_doc['comando'])
-                ids_para_atualizar.append(cmd_doc['_id'])
-
-            if ids_para_atualizar:
-                colecao_comandos.update_many(
-                    {"_id": {"$in": ids_para_atualizar}},
-                    {"$set": {"status": "enviado", "sent_at": datetime.datetime.utcnow()}}
-                )
-            if comandos_para_enviar:
-                app.logger.info(f"Enviando comandos {comandos_para_enviar} para {device_id}")
+            comandos_para_enviar = reivindicar_comandos(device_id, lease=pedido_com_ack())
         except Exception as e:
             app.logger.error(f"Erro ao buscar comandos no MongoDB: {e}")
             return jsonify({"error": "Erro ao buscar comandos"}), 500
@@ -234,13 +1274,74 @@ def fornecer_comandos():
     return jsonify(comandos_para_enviar)  # Retorna a lista de strings de comando
 
 
+# Long-poll: segura a conexão da borda até chegar um comando ou o timeout expirar
+@app.route('/api/comandos/aguardar', methods=['GET'])
+def aguardar_comandos():
+    device_id = request.args.get('device_id')
+    if not device_id:
+        return jsonify({"error": "device_id é obrigatório"}), 400
+    if not client:
+        return jsonify({"error": "Conexão com o banco de dados indisponível"}), 500
+
+    try:
+        timeout = min(max(float(request.args.get('timeout', 25)), 0), COMANDOS_LONGPOLL_MAXIMO)
+    except ValueError:
+        return jsonify({"error": "timeout inválido"}), 400
+
+    lease = pedido_com_ack()
+    try:
+        # A versão é lida antes da consulta para não perder um comando enfileirado entre as duas
+        versao = notificador_comandos.versao(device_id)
+        comandos_para_enviar = reivindicar_comandos(device_id, lease=lease)
+        fim = time.monotonic() + timeout
+        while not comandos_para_enviar:
+            restante = fim - time.monotonic()
+            if restante <= 0 or not notificador_comandos.aguardar(device_id, versao, restante):
+                break
+            versao = notificador_comandos.versao(device_id)
+            comandos_para_enviar = reivindicar_comandos(device_id, lease=lease)
+    except Exception as e:
+        app.logger.error(f"Erro ao aguardar comandos no MongoDB: {e}")
+        return jsonify({"error": "Erro ao buscar comandos"}), 500
+
+    return jsonify(comandos_para_enviar)
+
+
+# Confirmação da borda para comandos entregues com ack=1
+@app.route('/api/comandos/ack', methods=['POST'])
+def confirmar_comandos():
+    if not client:
+        return jsonify({"error": "Conexão com o banco de dados indisponível"}), 500
+    data = request.json or {}
+    device_id = data.get('device_id')
+    ids = data.get('ids')
+    if not device_id or not isinstance(ids, list):
+        return jsonify({"error": "device_id e ids são obrigatórios"}), 400
+    try:
+        object_ids = [ObjectId(i) for i in ids]
+    except Exception:
+        return jsonify({"error": "ids inválidos"}), 400
+    try:
+        agora = datetime.datetime.utcnow()
+        resultado = colecao_comandos.update_many(
+            {"_id": {"$in": object_ids}, "device_id": device_id, "status": "enviado"},
+            {"$set": {"status": "confirmado", "acked_at": agora, "concluido_em": agora}, "$unset": {"lease_ate": ""}}
+        )
+        return jsonify({"confirmados": resultado.modified_count}), 200
+    except Exception as e:
+        app.logger.error(f"Erro ao confirmar comandos no MongoDB: {e}")
+        return jsonify({"error": "Erro ao confirmar comandos"}), 500
+
+
 # --- Endpoint para o Cliente Flask ---
 @app.route('/api/dados_recentes', methods=['GET'])
 def obter_dados_recentes():
     if not client:
         return jsonify({"error": "Conexão com o banco de dados indisponível"}), 500
     try:
-        registros = list(colecao_leituras.find().sort("timestamp", DESCENDING).limit(20))
+        device_id = request.args.get('device_id')
+        filtro = {"device_id": device_id} if device_id else {}
+        registros = list(colecao_leituras.find(filtro).sort("timestamp", DESCENDING).limit(20))
         for r in registros:
             r["_id"] = str(r["_id"])
             r["timestamp"] = r["timestamp"].isoformat()
@@ -252,11 +1353,76 @@ def obter_dados_recentes():
         return jsonify({"error": str(e)}), 500
 
 
+# Histórico para gráficos: escolhe entre leituras brutas e os rollups por hora/dia.
+# from/to sem fuso são tratados como UTC e os buckets de hora/dia são UTC. Leituras brutas
+# param em HISTORICO_PONTOS_MAXIMO * 10 pontos; quando o intervalo tem mais, a resposta
+# vem com "truncado": true (peça resolution=hour ou auto para cobrir o intervalo todo).
+RESOLUCOES_HISTORICO = {"raw": "raw", "hour": "hora", "hora": "hora", "day": "dia", "dia": "dia"}
+
+
+@app.route('/api/historico', methods=['GET'])
+def obter_historico():
+    if not client:
+        return jsonify({"error": "Conexão com o banco de dados indisponível"}), 500
+    device_id = request.args.get('device_id')
+    if not device_id:
+        return jsonify({"error": "device_id é obrigatório"}), 400
+    try:
+        fim = para_utc_ingenuo(datetime.datetime.fromisoformat(request.args['to'])) \
+            if request.args.get('to') else datetime.datetime.utcnow()
+        inicio = para_utc_ingenuo(datetime.datetime.fromisoformat(request.args['from'])) \
+            if request.args.get('from') else fim - datetime.timedelta(days=1)
+    except ValueError:
+        return jsonify({"error": "from/to devem estar em formato ISO 8601"}), 400
+    if inicio >= fim:
+        return jsonify({"error": "from deve ser anterior a to"}), 400
+
+    resolucao_pedida = request.args.get('resolution', 'auto')
+    if resolucao_pedida == 'auto':
+        resolucao = escolher_resolucao(inicio, fim)
+    elif resolucao_pedida in RESOLUCOES_HISTORICO:
+        resolucao = RESOLUCOES_HISTORICO[resolucao_pedida]
+    else:
+        return jsonify({"error": "resolution deve ser auto, raw, hour ou day"}), 400
+
+    try:
+        if resolucao == "raw":
+            limite = HISTORICO_PONTOS_MAXIMO * 10
+            # Um ponto a mais só para saber se o intervalo foi cortado
+            cursor = colecao_leituras.find(
+                {"device_id": device_id, "timestamp": {"$gte": inicio, "$lt": fim}},
+                PROJECAO_HISTORICO_RAW
+            ).sort("timestamp", ASCENDING).limit(limite + 1)
+            pontos = []
+            for r in cursor:
+                r["timestamp"] = r["timestamp"].isoformat()
+                pontos.append(r)
+            truncado = len(pontos) > limite
+            del pontos[limite:]
+        else:
+            cursor = colecao_rollup.find({
+                "device_id": device_id,
+                "resolucao": resolucao,
+                "inicio": {"$gte": inicio_do_intervalo(inicio, resolucao), "$lt": fim}
+            }).sort("inicio", ASCENDING)
+            pontos = [formatar_ponto_rollup(r) for r in cursor]
+            truncado = False
+        return jsonify({
+            "device_id": device_id,
+            "from": inicio.isoformat(),
+            "to": fim.isoformat(),
+            "resolution": resolucao,
+            "truncado": truncado,
+            "pontos": pontos
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Erro ao buscar histórico: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 # Manda ligar um atuador
 @app.route('/api/enviar_comando_atuador', methods=['POST'])
 def enviar_comando_atuador_cliente():
-    global cache_ultimo_estado
-
     if not client:
         return jsonify({"error": "Conexão com o banco de dados indisponível"}), 500
 
@@ -275,9 +1441,11 @@ def enviar_comando_atuador_cliente():
             "status": "pendente",
             "created_at": datetime.datetime.utcnow()
         })
+        avisar_comando_novo(device_id)
 
         # ATUALIZA O CACHE IMEDIATAMENTE baseado no comando enviado
-        if cache_ultimo_estado and isinstance(comando, str):
+        estado_atual = backend_estado.obter_estado(device_id)
+        if estado_atual and isinstance(comando, str):
             # Identifica qual atuador e qual ação
             atuador_mapeamento = {
                 'Irrigador': 'estadoIrrigador',
@@ -288,19 +1456,22 @@ def enviar_comando_atuador_cliente():
 
             for atuador, estado_key in atuador_mapeamento.items():
                 if atuador in comando:
+                    # Trabalha sobre uma cópia; o estado salvo nunca é alterado no lugar
+                    estado_atuadores = dict(estado_atual.get('estado_atuadores') or {})
                     if "_ON" in comando or comando == f"toggle{atuador}_ON":
-                        cache_ultimo_estado['estado_atuadores'][estado_key] = "ON"
+                        estado_atuadores[estado_key] = "ON"
                     elif "_OFF" in comando or comando == f"toggle{atuador}_OFF":
-                        cache_ultimo_estado['estado_atuadores'][estado_key] = "OFF"
+                        estado_atuadores[estado_key] = "OFF"
+                    backend_estado.salvar_estado(dict(estado_atual, estado_atuadores=estado_atuadores))
 
                     # ENVIA ATUALIZAÇÃO IMEDIATA VIA SSE
-                    live_update_queue.put({
+                    backend_estado.publicar("live", {
                         "device_id": device_id,
                         "timestamp": datetime.datetime.utcnow().isoformat(),
-                        "luminosidade": cache_ultimo_estado.get('luminosidade', 0),
-                        "umidade": cache_ultimo_estado.get('umidade', 0),
-                        "temperatura": cache_ultimo_estado.get('temperatura', 0),
-                        "estado_atuadores": cache_ultimo_estado['estado_atuadores'],
+                        "luminosidade": estado_atual.get('luminosidade', 0),
+                        "umidade": estado_atual.get('umidade', 0),
+                        "temperatura": estado_atual.get('temperatura', 0),
+                        "estado_atuadores": estado_atuadores,
                         "fonte": "comando_manual"  # Indica que veio de comando manual
                     })
                     break
@@ -314,28 +1485,92 @@ def enviar_comando_atuador_cliente():
 
 
 # --- Relatório ---
-def criar_relatorio_nuvem_completo():  
+# As estatísticas são calculadas no MongoDB em um único pipeline $match/$group, então
+# só o resumo trafega até o Flask, qualquer que seja o tamanho da janela.
+# Janelas aceitas: "ultimos_N" (últimos N registros), "Nh" (últimas N horas), "Nd" (últimos N dias).
+RELATORIO_JANELA_PADRAO = os.getenv("RELATORIO_JANELA_PADRAO", "ultimos_10")
+RELATORIO_PERCENTIS = [0.5, 0.95]
+percentis_suportados = True  # desligado se o servidor não conhecer $percentile (exige MongoDB 7.0+)
+# "unknown group operator" e "Unrecognized expression" dos MongoDB anteriores ao 7.0
+CODIGOS_OPERADOR_DESCONHECIDO = {15952, 168}
+
+
+def interpretar_janela(janela):
+    # Retorna (ultimos, desde, descrição) ou lança ValueError
+    janela = str(janela or RELATORIO_JANELA_PADRAO).strip().lower()
+    if janela.startswith("ultimos_") or janela.isdigit():
+        ultimos = int(janela.split("_")[-1])
+        if ultimos <= 0:
+            raise ValueError("A quantidade de registros deve ser positiva")
+        return ultimos, None, f"últimos {ultimos} registros"
+    unidades = {"h": ("hours", "horas"), "d": ("days", "dias")}
+    if janela[-1:] in unidades and janela[:-1].isdigit() and int(janela[:-1]) > 0:
+        quantidade = int(janela[:-1])
+        argumento, nome = unidades[janela[-1]]
+        desde = datetime.datetime.utcnow() - datetime.timedelta(**{argumento: quantidade})
+        return None, desde, f"últimas {quantidade} {nome}" if nome == "horas" else f"últimos {quantidade} {nome}"
+    raise ValueError(f"Janela inválida: '{janela}'. Use ultimos_N, Nh ou Nd.")
+
+
+def calcular_estatisticas_relatorio(ultimos=None, desde=None, device_id=None):
+    global percentis_suportados
+    filtro = {}
+    if device_id:
+        filtro["device_id"] = device_id
+    if desde:
+        filtro["timestamp"] = {"$gte": desde}
+
+    pipeline = [{"$match": filtro}, {"$sort": {"timestamp": -1}}]
+    if ultimos:
+        pipeline.append({"$limit": ultimos})
+    grupo = {
+        "_id": None,
+        "total": {"$sum": 1},
+        "mais_recente": {"$first": "$timestamp"},
+        "mais_antigo": {"$last": "$timestamp"},
+        "recente_luminosidade": {"$first": "$luminosidade"},
+        "recente_umidade": {"$first": "$umidade"},
+        "recente_temperatura": {"$first": "$temperatura"},
+        "temp_max": {"$max": "$temperatura"},
+        "temp_min": {"$min": "$temperatura"},
+        "temp_media": {"$avg": "$temperatura"},
+        "temp_contagem": {"$sum": {"$cond": [{"$isNumber": "$temperatura"}, 1, 0]}},
+        "lum_max": {"$max": "$luminosidade"},
+        "lum_min": {"$min": "$luminosidade"},
+        "lum_media": {"$avg": "$luminosidade"},
+        "lum_contagem": {"$sum": {"$cond": [{"$isNumber": "$luminosidade"}, 1, 0]}},
+    }
+    for campo in CAMPOS_ROLLUP_CONTADOR:
+        grupo[campo] = {"$sum": {"$ifNull": [f"${campo}", 0]}}
+
+    if percentis_suportados:
+        grupo_com_percentis = dict(grupo)
+        for chave, campo in (("temp_percentis", "$temperatura"), ("lum_percentis", "$luminosidade")):
+            grupo_com_percentis[chave] = {"$percentile": {"input": campo, "p": RELATORIO_PERCENTIS,
+                                                          "method": "approximate"}}
+        try:
+            return next(colecao_leituras.aggregate(pipeline + [{"$group": grupo_com_percentis}]), None)
+        except OperationFailure as e:
+            if e.code in CODIGOS_OPERADOR_DESCONHECIDO:
+                app.logger.warning(f"Percentis indisponíveis neste MongoDB, relatório seguirá sem eles: {e}")
+                percentis_suportados = False
+            else:
+                # Falha de autenticação, transitória etc.: só este relatório sai sem percentis
+                app.logger.error(f"Erro ao calcular percentis do relatório (code={e.code}): {e}")
+    return next(colecao_leituras.aggregate(pipeline + [{"$group": grupo}]), None)
+
+
+def criar_relatorio_nuvem_completo(janela=None, device_id=None):  
     if not client:
         return "<strong>Conexão com o banco de dados indisponível para gerar relatório.</strong>", "Relatório Indisponível"
 
-    if colecao_leituras.count_documents({}) == 0:
-        return "<strong>Nenhum dado encontrado na coleção para gerar relatório.</strong>", "Relatório Vazio"
-
-    registros = list(colecao_leituras.find().sort("timestamp", DESCENDING).limit(10))
+    ultimos, desde, descricao_janela = interpretar_janela(janela)
+    resumo = calcular_estatisticas_relatorio(ultimos, desde, device_id)
 
-    if not registros:
+    if not resumo or not resumo.get("total"):
         return "<strong>Nenhum dado encontrado na coleção para gerar relatório.</strong>", "Relatório Vazio"
 
-    temperaturas = [r["temperatura"] for r in registros if "temperatura" in r and r["temperatura"] is not None]
-    luminosidades = [r["luminosidade"] for r in registros if "luminosidade" in r and r["luminosidade"] is not None]
-
-    # Calcular todas as ativações
-    ativacoes_irrigador = sum(r.get("irrigador_times_on", 0) for r in registros)
-    ativacoes_lampada = sum(r.get("lampada_times_on", 0) for r in registros) 
-    ativacoes_aquecedor = sum(r.get("aquecedor_times_on", 0) for r in registros)  
-    ativacoes_refrigerador = sum(r.get("refrigerador_times_on", 0) for r in registros)  
-
-    umidadebool = registros[0].get("umidade")  
+    umidadebool = resumo.get("recente_umidade")  
     umidadetexto = 'N/A'
     if umidadebool == 0:
         umidadetexto = 'Molhado'
@@ -343,55 +1578,273 @@ def criar_relatorio_nuvem_completo():
         umidadetexto = 'Seco'
 
     try:
-        mais_recente_dt = registros[0]["timestamp"]
-        mais_antigo_dt = registros[-1]["timestamp"]
+        mais_recente_dt = resumo["mais_recente"]
+        mais_antigo_dt = resumo["mais_antigo"]
         mais_recente = mais_recente_dt.strftime('%Y-%m-%d %H:%M:%S UTC')
         mais_antigo = mais_antigo_dt.strftime('%Y-%m-%d %H:%M:%S UTC')
+        hora_recente = mais_recente_dt.strftime("%H:%M:%S UTC")
     except Exception as e:
         app.logger.error(f"Erro ao formatar timestamp no relatório: {e}")
         mais_recente = "N/A"
         mais_antigo = "N/A"
+        hora_recente = ""
 
-    assunto_relatorio = f"Relatório Estufa Cloud | {mais_antigo} → {mais_recente}"
+    escopo = f" | {device_id}" if device_id else ""
+    assunto_relatorio = f"Relatório Estufa Cloud{escopo} | {mais_antigo} → {mais_recente}"
     
     #Formato do email:
 
     report_html = f"""
-        <h2>Relatório das Últimas Leituras (Nuvem)</h2>
-        <p><strong>Total de registros analisados:</strong> {len(registros)}</p>
+        <h2>Relatório das Leituras (Nuvem) - {descricao_janela}{escopo}</h2>
+        <p><strong>Total de registros analisados:</strong> {resumo["total"]}</p>
         <p><strong>Mais recente:</strong> {mais_recente}<br>
            <strong>Mais antigo:</strong> {mais_antigo}</p>
-        <h3>Dados da Leitura Recente ({registros[0]["timestamp"].strftime("%H:%M:%S UTC") if registros else ''})</h3>
+        <h3>Dados da Leitura Recente ({hora_recente})</h3>
         <ul>
-            <li><strong>Luminosidade:</strong> {registros[0].get("luminosidade", "N/A")}</li>
+            <li><strong>Luminosidade:</strong> {resumo.get("recente_luminosidade", "N/A")}</li>
             <li><strong>Umidade:</strong> {umidadetexto}</li>
-            <li><strong>Temperatura:</strong> {registros[0].get("temperatura", "N/A")} °C</li>
+            <li><strong>Temperatura:</strong> {resumo.get("recente_temperatura", "N/A")} °C</li>
         </ul>"""
-    if temperaturas:
+    if resumo.get("temp_contagem"):
         report_html += f"""
-        <h3>🌡️ Temperatura (Últimos {len(temperaturas)} registros com temperatura)</h3>
+        <h3>🌡️ Temperatura ({resumo["temp_contagem"]} registros com temperatura)</h3>
         <ul>
-            <li><strong>Maior:</strong> {max(temperaturas):.2f} °C</li>
-            <li><strong>Menor:</strong> {min(temperaturas):.2f} °C</li>
-            <li><strong>Média:</strong> {sum(temperaturas) / len(temperaturas):.2f} °C</li>
+            <li><strong>Maior:</strong> {resumo["temp_max"]:.2f} °C</li>
+            <li><strong>Menor:</strong> {resumo["temp_min"]:.2f} °C</li>
+            <li><strong>Média:</strong> {resumo["temp_media"]:.2f} °C</li>"""
+        if resumo.get("temp_percentis"):
+            report_html += f"""
+            <li><strong>Mediana:</strong> {resumo["temp_percentis"][0]:.2f} °C</li>
+            <li><strong>Percentil 95:</strong> {resumo["temp_percentis"][1]:.2f} °C</li>"""
+        report_html += """
         </ul>"""
-    if luminosidades:
+    if resumo.get("lum_contagem"):
         report_html += f"""
-        <h3>💡 Luminosidade (Últimos {len(luminosidades)} registros com luminosidade)</h3>
-        <p><strong>Média:</strong> {sum(luminosidades) / len(luminosidades):.2f}</p>"""
+        <h3>💡 Luminosidade ({resumo["lum_contagem"]} registros com luminosidade)</h3>
+        <p><strong>Média:</strong> {resumo["lum_media"]:.2f}<br>
+           <strong>Maior:</strong> {resumo["lum_max"]:.2f}<br>
+           <strong>Menor:</strong> {resumo["lum_min"]:.2f}</p>"""
+        if resumo.get("lum_percentis"):
+            report_html += f"""
+        <p><strong>Mediana:</strong> {resumo["lum_percentis"][0]:.2f}<br>
+           <strong>Percentil 95:</strong> {resumo["lum_percentis"][1]:.2f}</p>"""
 
     report_html += f"""
-        <h3>⚙ Atuadores acionados (soma dos últimos {len(registros)} snapshots)</h3>
+        <h3>⚙ Atuadores acionados (soma dos {resumo["total"]} snapshots)</h3>
         <ul>
-            <li>Irrigador: {ativacoes_irrigador} vezes</li>
-            <li>Lâmpada: {ativacoes_lampada} vezes</li>
-            <li>Aquecedor: {ativacoes_aquecedor} vezes</li>
-            <li>Refrigerador: {ativacoes_refrigerador} vezes</li>
+            <li>Irrigador: {resumo["irrigador_times_on"]} vezes</li>
+            <li>Lâmpada: {resumo["lampada_times_on"]} vezes</li>
+            <li>Aquecedor: {resumo["aquecedor_times_on"]} vezes</li>
+            <li>Refrigerador: {resumo["refrigerador_times_on"]} vezes</li>
         </ul>
         """
     return report_html.strip(), assunto_relatorio
 
-#Rota que gera e envia o relatorio
+# --- Envio de e-mail ---
+# O transporte é escolhido por EMAIL_TRANSPORTE: "sendgrid" (padrão) ou "local", que só
+# registra as mensagens em memória e no log (útil para testes e desenvolvimento).
+EMAIL_TRANSPORTE = os.getenv("EMAIL_TRANSPORTE", "sendgrid").lower()
+
+
+class TransporteSendGrid:
+    def __init__(self, api_key, from_email):
+        self.from_email = from_email
+        self._cliente = SendGridAPIClient(api_key)  # reaproveitado entre envios
+
+    def configurado(self):
+        return bool(self.from_email)
+
+    def enviar(self, destinatario, assunto, html):
+        message = Mail(
+            from_email=self.from_email,
+            to_emails=destinatario,
+            subject=assunto,
+            html_content=html)
+        with metricas.cronometrar("estufa_servico_externo_segundos", servico="sendgrid", operacao="enviar"):
+            response = self._cliente.send(message)
+        return response.status_code
+
+
+class TransporteLocal:
+    def __init__(self):
+        self.enviados = []
+
+    def configurado(self):
+        return True
+
+    def enviar(self, destinatario, assunto, html):
+        self.enviados.append({"para": destinatario, "assunto": assunto, "html": html})
+        app.logger.info(f"[e-mail local] Para: {destinatario} | Assunto: {assunto}")
+        return 202
+
+
+def criar_transporte_email():
+    if EMAIL_TRANSPORTE == "local":
+        return TransporteLocal()
+    if not SENDGRID_API_KEY:
+        return None
+    return TransporteSendGrid(SENDGRID_API_KEY, FROM_EMAIL)
+
+
+transporte_email = criar_transporte_email()
+
+
+# --- Fila de jobs de relatório ---
+# A rota só valida e grava o job em RelatoriosTable; RELATORIO_WORKERS threads por processo
+# reivindicam os jobs atomicamente (find_one_and_update, como a fila de comandos) e geram e
+# enviam o relatório com até RELATORIO_TENTATIVAS tentativas. Como o job está no MongoDB,
+# qualquer worker do gunicorn responde /api/relatorios/<id> e um job interrompido por um
+# restart volta para a fila quando o lease vence. Pedidos idênticos (mesmo e-mail, janela e
+# device_id) em andamento ou concluídos há menos de RELATORIO_DEDUP_SEGUNDOS reaproveitam
+# o mesmo job: esses jobs guardam a 'chave_dedup' do pedido, que tem índice único, então dois
+# pedidos simultâneos nunca criam dois jobs. Jobs concluídos saem pelo índice TTL após
+# RELATORIO_RETENCAO_SEGUNDOS.
+RELATORIO_WORKERS = int(os.getenv("RELATORIO_WORKERS", 2))
+RELATORIO_TENTATIVAS = int(os.getenv("RELATORIO_TENTATIVAS", 3))
+RELATORIO_DEDUP_SEGUNDOS = int(os.getenv("RELATORIO_DEDUP_SEGUNDOS", 60))
+RELATORIO_RETENCAO_SEGUNDOS = int(os.getenv("RELATORIO_RETENCAO_SEGUNDOS", 3600))
+RELATORIO_LEASE_SEGUNDOS = int(os.getenv("RELATORIO_LEASE_SEGUNDOS", 600))
+RELATORIO_POLL_SEGUNDOS = float(os.getenv("RELATORIO_POLL_SEGUNDOS", 5))
+
+
+class FilaRelatorios:
+    def __init__(self, colecao, transporte, workers=RELATORIO_WORKERS):
+        self.colecao = colecao
+        self.transporte = transporte
+        self.workers = workers
+        self._sinal = queue.Queue()  # acorda os workers deste processo sem esperar o poll
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def criar_indices(self):
+        try:
+            self.colecao.create_index([("status", ASCENDING), ("criado_em", ASCENDING)], name="fila_por_status")
+            self.colecao.create_index("chave_dedup", name="dedup_por_pedido", unique=True,
+                                      partialFilterExpression={"chave_dedup": {"$exists": True}})
+            self.colecao.create_index("concluido_em", name="ttl_concluidos",
+                                      expireAfterSeconds=RELATORIO_RETENCAO_SEGUNDOS)
+        except Exception as e:
+            app.logger.error(f"Erro ao criar índices de 'RelatoriosTable': {e}")
+
+    def iniciar_workers(self):
+        # Chamado por iniciar_servicos em cada worker do gunicorn, não no import
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._loop, name=f"relatorios-{len(self._threads)}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    @staticmethod
+    def _filtro_dedup(chave, agora):
+        # Jobs que ainda respondem por um pedido: em andamento ou enviados há pouco
+        return {"chave_dedup": chave,
+                "$or": [{"status": {"$in": ["pendente", "processando"]}},
+                        {"status": "enviado",
+                         "concluido_em": {"$gte": agora - datetime.timedelta(seconds=RELATORIO_DEDUP_SEGUNDOS)}}]}
+
+    def enfileirar(self, email, janela, device_id):
+        # Retorna (job, novo)
+        agora = datetime.datetime.utcnow()
+        chave = json.dumps([email, janela, device_id])
+        existente = self.colecao.find_one(self._filtro_dedup(chave, agora))
+        if existente:
+            return existente, False
+        # Libera a chave de um job enviado fora da janela de dedup (os que falham já a liberam)
+        self.colecao.update_many(
+            {"chave_dedup": chave, "status": "enviado",
+             "concluido_em": {"$lt": agora - datetime.timedelta(seconds=RELATORIO_DEDUP_SEGUNDOS)}},
+            {"$unset": {"chave_dedup": ""}})
+        job = {"_id": uuid.uuid4().hex, "status": "pendente", "email": email, "janela": janela,
+               "device_id": device_id, "chave_dedup": chave, "tentativas": 0, "erro": None,
+               "criado_em": agora, "concluido_em": None}
+        try:
+            self.colecao.insert_one(job)
+        except DuplicateKeyError:
+            # Outro pedido idêntico gravou o job entre a busca e a inserção
+            existente = self.colecao.find_one({"chave_dedup": chave})
+            if existente:
+                return existente, False
+            raise
+        self._sinal.put(job["_id"])
+        return job, True
+
+    def obter(self, job_id):
+        return self.colecao.find_one({"_id": job_id})
+
+    def pendentes(self):
+        return self.colecao.count_documents({"status": "pendente"})
+
+    def _atualizar(self, job_id, **campos):
+        self.colecao.update_one({"_id": job_id}, {"$set": campos})
+
+    def _reivindicar(self):
+        agora = datetime.datetime.utcnow()
+        return self.colecao.find_one_and_update(
+            {"$or": [{"status": "pendente"},
+                     {"status": "processando", "lease_ate": {"$lt": agora}}]},
+            {"$set": {"status": "processando",
+                      "lease_ate": agora + datetime.timedelta(seconds=RELATORIO_LEASE_SEGUNDOS)}},
+            sort=[("criado_em", ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def _loop(self):
+        while True:
+            try:
+                job = self._reivindicar()
+            except Exception as e:
+                app.logger.error(f"Erro ao buscar jobs de relatório no MongoDB: {e}")
+                job = None
+            if job:
+                self._processar(job)
+                continue
+            try:
+                self._sinal.get(timeout=RELATORIO_POLL_SEGUNDOS)
+            except queue.Empty:
+                pass  # também procura jobs gravados por outros processos
+
+    def _processar(self, job):
+        # Um job retomado depois de um restart continua a contagem de tentativas
+        for tentativa in range(job["tentativas"] + 1, RELATORIO_TENTATIVAS + 1):
+            self._atualizar(job["_id"], status="processando", tentativas=tentativa,
+                            lease_ate=datetime.datetime.utcnow() + datetime.timedelta(seconds=RELATORIO_LEASE_SEGUNDOS))
+            try:
+                html_content, assunto_email = criar_relatorio_nuvem_completo(job["janela"], job["device_id"])
+                status_code = self.transporte.enviar(job["email"], assunto_email, html_content)
+                app.logger.info(f"Relatório {job['_id']} enviado para {job['email']}: {status_code}")
+                self._atualizar(job["_id"], status="enviado", erro=None, concluido_em=datetime.datetime.utcnow())
+                return
+            except Exception as e:
+                app.logger.error(f"Erro ao enviar relatório {job['_id']} para {job['email']} "
+                                 f"(tentativa {tentativa}/{RELATORIO_TENTATIVAS}): {e}")
+                self._atualizar(job["_id"], erro=str(e))
+                if tentativa < RELATORIO_TENTATIVAS:
+                    time.sleep(2 ** tentativa)
+        self.colecao.update_one({"_id": job["_id"]},
+                                {"$set": {"status": "falhou", "concluido_em": datetime.datetime.utcnow()},
+                                 "$unset": {"chave_dedup": ""}})
+
+
+fila_relatorios = FilaRelatorios(db["RelatoriosTable"], transporte_email) if client and transporte_email else None
+if fila_relatorios:
+    fila_relatorios.criar_indices()
+
+
+def formatar_job_relatorio(job):
+    return {
+        "job_id": job["_id"],
+        "status": job["status"],
+        "email": job["email"],
+        "janela": job["janela"],
+        "device_id": job["device_id"],
+        "tentativas": job["tentativas"],
+        "erro": job["erro"],
+        "criado_em": job["criado_em"].isoformat(),
+        "concluido_em": job["concluido_em"].isoformat() if job["concluido_em"] else None
+    }
+
+
+#Rota que enfileira a geração e o envio do relatorio
 @app.route('/api/gerar_e_enviar_relatorio', methods=['POST'])
 def rota_enviar_relatorio():
     data = request.json
@@ -403,72 +1856,293 @@ def rota_enviar_relatorio():
     if not email_destinatario:  # Se ainda não tem email, retorna erro
         return jsonify({"error": "E-mail do destinatário não fornecido e não configurado como default."}), 400
 
-    if not SENDGRID_API_KEY or not FROM_EMAIL:
+    if not client:
+        return jsonify({"error": "Conexão com o banco de dados indisponível"}), 500
+    if not fila_relatorios or not transporte_email.configurado():
         return jsonify({"error": "Configuração de SendGrid (API Key ou From Email) incompleta"}), 500
 
-    html_content, assunto_email = criar_relatorio_nuvem_completo()
-
-    message = Mail(
-        from_email=FROM_EMAIL,
-        to_emails=email_destinatario,  # USA O E-MAIL RECEBIDO OU DEFAULT
-        subject=assunto_email,
-        html_content=html_content)
+    janela = str(data.get('janela') or RELATORIO_JANELA_PADRAO).strip().lower() if data else RELATORIO_JANELA_PADRAO
+    device_id = data.get('device_id') if data else None
     try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message)
-        app.logger.info(f"Relatório enviado para {email_destinatario} via SendGrid: {response.status_code}")
-        return jsonify({"message": f"Relatório enviado com sucesso para {email_destinatario}."}), 200
-    except Exception as e:
-        app.logger.error(f"Erro ao enviar relatório para {email_destinatario} via SendGrid: {e}")
-        return jsonify({"error": str(e)}), 500
-    
+        interpretar_janela(janela)  # valida antes de enfileirar
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-# Transmissão twitch
-@app.route('/api/twitch_status')
-def get_twitch_status():
-    client_id = os.getenv("TWITCH_CLIENT_ID")
-    client_secret = os.getenv("TWITCH_CLIENT_SECRET")
-    user_login = os.getenv("TWITCH_USERNAME")
+    job, novo = fila_relatorios.enfileirar(email_destinatario, janela, device_id)
+    mensagem = "Relatório enfileirado" if novo else "Relatório idêntico já solicitado"
+    return jsonify(dict(formatar_job_relatorio(job), message=f"{mensagem} para {email_destinatario}.")), 202
 
-    if not all([client_id, client_secret, user_login]):
-        return jsonify({"is_live": False, "error": "Twitch credentials not configured."}), 500
 
+@app.route('/api/relatorios/<job_id>', methods=['GET'])
+def status_relatorio(job_id):
+    if not fila_relatorios:
+        return jsonify({"error": "Fila de relatórios indisponível"}), 500
     try:
-        token_url = 'https://id.twitch.tv/oauth2/token'
+        job = fila_relatorios.obter(job_id)
+    except Exception as e:
+        app.logger.error(f"Erro ao consultar job de relatório no MongoDB: {e}")
+        return jsonify({"error": "Erro ao consultar o job de relatório"}), 500
+    if not job:
+        return jsonify({"error": "Job de relatório não encontrado"}), 404
+    return jsonify(formatar_job_relatorio(job)), 200
+
+
+# Transmissão twitch
+# O token OAuth fica em cache até expirar e o status ao vivo por TWITCH_TTL_SEGUNDOS.
+# Requisições simultâneas compartilham uma única chamada à Twitch (single-flight) e,
+# com o cache vencido, recebem o valor antigo enquanto uma thread atualiza em segundo
+# plano. As URLs e a sessão HTTP são injetáveis para testes com um servidor falso.
+TWITCH_TTL_SEGUNDOS = float(os.getenv("TWITCH_TTL_SEGUNDOS", 60))
+TWITCH_TTL_ERRO_SEGUNDOS = float(os.getenv("TWITCH_TTL_ERRO_SEGUNDOS", 10))
+TWITCH_TOKEN_URL = os.getenv("TWITCH_TOKEN_URL", 'https://id.twitch.tv/oauth2/token')
+TWITCH_API_URL = os.getenv("TWITCH_API_URL", 'https://api.twitch.tv/helix')
+
+
+class ClienteTwitch:
+    def __init__(self, client_id, client_secret, user_login, sessao=None,
+                 token_url=TWITCH_TOKEN_URL, api_url=TWITCH_API_URL, timeout=10):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.user_login = user_login
+        self.sessao = sessao or requests.Session()
+        self.token_url = token_url
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self._token = None
+        self._token_expira_em = 0
+
+    def _obter_token(self):
+        if self._token and time.monotonic() < self._token_expira_em:
+            return self._token
         token_params = {
-            'client_id': client_id,
-            'client_secret': client_secret,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
             'grant_type': 'client_credentials'
         }
-        token_res = requests.post(token_url, params=token_params, timeout=10)
+        with metricas.cronometrar("estufa_servico_externo_segundos", servico="twitch", operacao="token"):
+            token_res = self.sessao.post(self.token_url, params=token_params, timeout=self.timeout)
         token_res.raise_for_status()
-        access_token = token_res.json()['access_token']
+        dados = token_res.json()
+        self._token = dados['access_token']
+        # Renova um minuto antes do vencimento informado pela Twitch
+        self._token_expira_em = time.monotonic() + max(dados.get('expires_in', 3600) - 60, 0)
+        return self._token
 
+    def consultar_status(self):
         # --- Verificar se o canal está ao vivo ---
-        stream_url = f'https://api.twitch.tv/helix/streams?user_login={user_login}'
-        headers = {
-            'Client-ID': client_id,
-            'Authorization': f'Bearer {access_token}'
-        }
-        stream_res = requests.get(stream_url, headers=headers, timeout=10)
-        stream_res.raise_for_status()
-        stream_data = stream_res.json()
+        for tentativa in range(2):
+            headers = {
+                'Client-ID': self.client_id,
+                'Authorization': f'Bearer {self._obter_token()}'
+            }
+            with metricas.cronometrar("estufa_servico_externo_segundos", servico="twitch", operacao="streams"):
+                stream_res = self.sessao.get(f'{self.api_url}/streams', params={'user_login': self.user_login},
+                                             headers=headers, timeout=self.timeout)
+            if stream_res.status_code == 401 and tentativa == 0:
+                self._token = None  # token revogado ou expirado antes da hora
+                continue
+            stream_res.raise_for_status()
+            # Se a lista 'data' não estiver vazia, o canal está ao vivo
+            if stream_res.json().get('data'):
+                return {"is_live": True, "user_name": self.user_login}
+            return {"is_live": False}
+
+
+class CacheTwitch:
+    def __init__(self, cliente, ttl=TWITCH_TTL_SEGUNDOS, ttl_erro=TWITCH_TTL_ERRO_SEGUNDOS):
+        self.cliente = cliente
+        self.ttl = ttl
+        self.ttl_erro = ttl_erro
+        self._condicao = threading.Condition()
+        self._resposta = None  # (corpo, status_http)
+        self._valido_ate = 0
+        self._atualizando = False
+
+    def obter(self):
+        with self._condicao:
+            if self._resposta and time.monotonic() < self._valido_ate:
+                return self._resposta
+            if self._resposta:
+                # Vencido: devolve o valor antigo e atualiza em segundo plano
+                if not self._atualizando:
+                    self._atualizando = True
+                    threading.Thread(target=self._atualizar, name="twitch-refresh", daemon=True).start()
+                return self._resposta
+            if self._atualizando:
+                # Outra requisição já está consultando a Twitch; espera o resultado dela
+                self._condicao.wait_for(lambda: not self._atualizando)
+                return self._resposta
+            self._atualizando = True
+        self._atualizar()
+        with self._condicao:
+            return self._resposta
+
+    def _atualizar(self):
+        try:
+            resposta, ttl = (self.cliente.consultar_status(), 200), self.ttl
+        except requests.exceptions.RequestException as e:
+            app.logger.error(f"Error calling Twitch API: {e}")
+            resposta, ttl = ({"is_live": False, "error": str(e)}, 503), self.ttl_erro
+        except Exception as e:
+            app.logger.error(f"An unexpected error occurred in get_twitch_status: {e}")
+            resposta, ttl = ({"is_live": False, "error": "An internal error occurred."}, 500), self.ttl_erro
+        with self._condicao:
+            # Em caso de erro, mantém o último status válido se houver
+            if resposta[1] == 200 or not self._resposta or self._resposta[1] != 200:
+                self._resposta = resposta
+            self._valido_ate = time.monotonic() + ttl
+            self._atualizando = False
+            self._condicao.notify_all()
+
+
+def criar_cache_twitch():
+    client_id = os.getenv("TWITCH_CLIENT_ID")
+    client_secret = os.getenv("TWITCH_CLIENT_SECRET")
+    user_login = os.getenv("TWITCH_USERNAME")
+    if not all([client_id, client_secret, user_login]):
+        return None
+    return CacheTwitch(ClienteTwitch(client_id, client_secret, user_login))
 
-        # Se a lista 'data' não estiver vazia, o canal está ao vivo
-        if stream_data.get('data'):
-            return jsonify({"is_live": True, "user_name": user_login})
-        else:
-            return jsonify({"is_live": False})
 
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error calling Twitch API: {e}")
-        return jsonify({"is_live": False, "error": str(e)}), 503
-    except Exception as e:
-        app.logger.error(f"An unexpected error occurred in get_twitch_status: {e}")
-        return jsonify({"is_live": False, "error": "An internal error occurred."}), 500
+cache_twitch = criar_cache_twitch()
 
 
+@app.route('/api/twitch_status')
+def get_twitch_status():
+    if not cache_twitch:
+        return jsonify({"is_live": False, "error": "Twitch credentials not configured."}), 500
+    corpo, status_http = cache_twitch.obter()
+    return jsonify(corpo), status_http
+
+
+# --- Gauges lidos a cada scrape de /metrics ---
+STATUS_COMANDOS_ATIVOS = ("pendente", "enviado")
+
+
+def contar_comandos_por_status():
+    # Só os comandos ativos: os confirmados ficam até o TTL e fariam o scrape crescer com o histórico
+    if not client:
+        return None
+    contagem = dict.fromkeys(STATUS_COMANDOS_ATIVOS, 0)
+    for grupo in colecao_comandos.aggregate([
+            {"$match": {"status": {"$in": list(STATUS_COMANDOS_ATIVOS)}}},
+            {"$group": {"_id": "$status", "total": {"$sum": 1}}}]):
+        contagem[grupo["_id"]] = grupo["total"]
+    return {(("status", status),): total for status, total in contagem.items()}
+
+
+def profundidade_buffers_live():
+    total, maior = live_broadcaster.profundidade_buffers()
+    return {(("agregado", "total"),): total, (("agregado", "maior"),): maior}
+
+
+metricas.gauge("estufa_sse_conexoes_ativas", "gauge", "Conexões abertas em /stream",
+               live_broadcaster.total_assinantes)
+metricas.gauge("estufa_live_descartados_total", "counter", "Eventos descartados por clientes SSE lentos",
+               live_broadcaster.total_descartados)
+metricas.gauge("estufa_ingestao_buffer_leituras", "gauge", "Leituras aguardando gravação em lote",
+               lambda: ingestao_leituras.tamanho() if ingestao_leituras else None)
+metricas.gauge("estufa_relatorios_fila", "gauge", "Jobs de relatório aguardando um worker",
+               lambda: fila_relatorios.pendentes() if fila_relatorios else None)
+metricas.gauge("estufa_live_buffer_eventos", "gauge", "Eventos aguardando entrega nos buffers dos clientes SSE",
+               profundidade_buffers_live)
+metricas.gauge("estufa_comandos", "gauge", "Comandos ativos (pendente/enviado) na ComandosTable por status",
+               contar_comandos_por_status)
+
+
+# --- Profiler por amostragem (opcional, PROFILER_HABILITADO=1) ---
+# Enquanto ativo, uma thread lê as pilhas de todas as threads a cada intervalo
+# (sys._current_frames) e conta as pilhas no formato "collapsed" (uma linha "f1;f2;f3 N"),
+# que os geradores de flame graph leem direto. Ligado/desligado por POST /metrics/profiler.
+PROFILER_HABILITADO = os.getenv("PROFILER_HABILITADO", "0") == "1"
+PROFILER_INTERVALO_SEGUNDOS = float(os.getenv("PROFILER_INTERVALO_SEGUNDOS", 0.01))
+PROFILER_PROFUNDIDADE = int(os.getenv("PROFILER_PROFUNDIDADE", 40))
+
+
+class ProfilerAmostragem:
+    def __init__(self, intervalo=PROFILER_INTERVALO_SEGUNDOS, profundidade=PROFILER_PROFUNDIDADE):
+        self.intervalo = intervalo
+        self.profundidade = profundidade
+        self._lock = threading.Lock()
+        self._contagens = Counter()
+        self._parar = threading.Event()
+        self._thread = None
+        self.amostras = 0
+
+    def ativo(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def iniciar(self):
+        with self._lock:
+            if self.ativo():
+                return
+            self._parar.clear()
+            self._thread = threading.Thread(target=self._loop, name="profiler", daemon=True)
+            self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+        self._thread = None
+
+    def limpar(self):
+        with self._lock:
+            self._contagens.clear()
+            self.amostras = 0
+
+    def relatorio(self):
+        with self._lock:
+            return "\n".join(f"{pilha} {total}" for pilha, total in self._contagens.most_common()) + "\n"
+
+    def _loop(self):
+        proprio = threading.get_ident()
+        while not self._parar.wait(self.intervalo):
+            quadros = sys._current_frames()
+            pilhas = []
+            for ident, quadro in quadros.items():
+                if ident == proprio:
+                    continue
+                pilha = []
+                while quadro is not None and len(pilha) < self.profundidade:
+                    codigo = quadro.f_code
+                    pilha.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+                    quadro = quadro.f_back
+                pilhas.append(";".join(reversed(pilha)))
+            with self._lock:
+                self._contagens.update(pilhas)
+                self.amostras += 1
+
+
+profiler = ProfilerAmostragem()
+metricas.gauge("estufa_profiler_ativo", "gauge", "1 se o profiler por amostragem está rodando",
+               lambda: int(profiler.ativo()))
+
+
+@app.route('/metrics')
+def exportar_metricas():
+    return Response(metricas.renderizar(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+# GET devolve as pilhas amostradas; POST {"ativo": true|false, "limpar": true} liga/desliga
+@app.route('/metrics/profiler', methods=['GET', 'POST'])
+def controlar_profiler():
+    if not PROFILER_HABILITADO:
+        return jsonify({"error": "Profiler desabilitado. Defina PROFILER_HABILITADO=1."}), 404
+    if request.method == 'GET':
+        return Response(profiler.relatorio(), mimetype="text/plain; charset=utf-8")
+    data = request.get_json(silent=True) or {}
+    if data.get("limpar"):
+        profiler.limpar()
+    if data.get("ativo") is True:
+        profiler.iniciar()
+    elif data.get("ativo") is False:
+        profiler.parar()
+    return jsonify({"ativo": profiler.ativo(), "amostras": profiler.amostras}), 200
+
+
+# Servidor de desenvolvimento. Em produção use o launcher assíncrono: python nuvem_asgi.py
 if __name__ == '__main__':
     port = int(os.getenv("PORT", 8080))
-    app.logger.info(f"Iniciando servidor Flask na porta {port}")
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    app.logger.info(f"Iniciando servidor Flask (desenvolvimento) na porta {port}")
+    app.run(host='0.0.0.0', port=port, debug=os.getenv("FLASK_DEBUG", "1") == "1", threaded=True)
\ No newline at end of file
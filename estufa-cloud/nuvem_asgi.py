@@ -0,0 +1,269 @@
+from asgiref.wsgi import WsgiToAsgi
+from pymongo import AsyncMongoClient, ASCENDING, ReturnDocument
+from urllib.parse import parse_qs
+from collections import deque
+import asyncio
+import json
+import os
+import time
+
+import nuvem
+
+
+# Modo de serviço assíncrono (ASGI) da nuvem.
+# /stream, /api/live_update e /api/comandos/aguardar são atendidos por corrotinas, então
+# cada dashboard conectado custa um buffer e uma task em vez de uma thread do Flask.
+# As demais rotas continuam no app Flask de nuvem.py, adaptado com WsgiToAsgi.
+# Em produção: python nuvem_asgi.py (ou uvicorn nuvem_asgi:app_asgi)
+
+
+class AssinanteAsync:
+    # Assinante do live_broadcaster que entrega os eventos no event loop.
+    # entregar() pode ser chamado de qualquer thread (rotas Flask) ou do próprio loop.
+    def __init__(self, loop, tamanho_buffer, dispositivos=None):
+        self.loop = loop
+        self.buffer = deque(maxlen=tamanho_buffer)
+        self.evento = asyncio.Event()
+        self.descartados = 0
+        self.dispositivos = dispositivos
+
+    def entregar(self, evento):
+        try:
+            self.loop.call_soon_threadsafe(self._entregar_no_loop, evento)
+        except RuntimeError:
+            pass  # loop já encerrado
+
+    def _entregar_no_loop(self, evento):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.descartados += 1
+        self.buffer.append(evento)
+        self.evento.set()
+
+    async def obter(self):
+        while not self.buffer:
+            self.evento.clear()
+            await self.evento.wait()
+        return self.buffer.popleft()
+
+    def drenar(self):
+        eventos = list(self.buffer)
+        self.buffer.clear()
+        return eventos
+
+
+async def ler_corpo(receive):
+    corpo = b""
+    while True:
+        mensagem = await receive()
+        if mensagem["type"] == "http.disconnect":
+            return None
+        corpo += mensagem.get("body", b"")
+        if not mensagem.get("more_body"):
+            return corpo
+
+
+async def responder_json(send, status, dados):
+    corpo = json.dumps(dados).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(corpo)).encode())]})
+    await send({"type": "http.response.body", "body": corpo})
+
+
+async def aguardar_desconexao(receive):
+    while True:
+        mensagem = await receive()
+        if mensagem["type"] == "http.disconnect":
+            return
+
+
+class AppAsgi:
+    def __init__(self, app_flask):
+        self.app_wsgi = WsgiToAsgi(app_flask)
+        self.cliente_mongo = None
+        self.colecao_comandos = None
+        self.rotas = {
+            ("GET", "/stream"): self.stream,
+            ("POST", "/api/live_update"): self.receber_live_update,
+            ("GET", "/api/comandos/aguardar"): self.aguardar_comandos,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        rota = self.rotas.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if rota:
+            await rota(scope, receive, self.medir(scope, send))
+        else:
+            await self.app_wsgi(scope, receive, send)
+
+    def medir(self, scope, send):
+        # Mesma métrica das rotas Flask: latência até o início da resposta
+        inicio = time.perf_counter()
+
+        async def send_medido(mensagem):
+            if mensagem["type"] == "http.response.start":
+                nuvem.metricas.observar("estufa_http_requisicao_segundos", time.perf_counter() - inicio,
+                                        metodo=scope["method"], rota=scope["path"], status=mensagem["status"])
+            await send(mensagem)
+        return send_medido
+
+    async def lifespan(self, receive, send):
+        while True:
+            mensagem = await receive()
+            if mensagem["type"] == "lifespan.startup":
+                nuvem.iniciar_servicos()
+                if nuvem.client:
+                    # Driver assíncrono do pymongo para as consultas feitas dentro do loop
+                    self.cliente_mongo = AsyncMongoClient(nuvem.MONGO_URI, event_listeners=[nuvem.monitor_mongo])
+                    self.colecao_comandos = self.cliente_mongo["EstufaBD"]["ComandosTable"]
+                await send({"type": "lifespan.startup.complete"})
+            elif mensagem["type"] == "lifespan.shutdown":
+                if nuvem.ingestao_leituras:
+                    await asyncio.to_thread(nuvem.ingestao_leituras.encerrar)
+                if self.cliente_mongo is not None:
+                    self.colecao_comandos = None
+                    await self.cliente_mongo.close()
+                    self.cliente_mongo = None
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # Rota para o STREAM de Server-Sent Events (SSE)
+    async def stream(self, scope, receive, send):
+        params = parse_qs(scope.get("query_string", b"").decode())
+        dispositivos = nuvem.dispositivos_do_filtro(params.get("device_id", [None])[0])
+        assinante = nuvem.live_broadcaster.registrar(
+            AssinanteAsync(asyncio.get_running_loop(), nuvem.live_broadcaster.tamanho_buffer, dispositivos))
+        codificador = None
+        if params.get("protocolo", [None])[0] == "delta":
+            codificador = nuvem.CodificadorDeltaSSE()
+        desconexao = asyncio.create_task(aguardar_desconexao(receive))
+        try:
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                                    (b"cache-control", b"no-cache"),
+                                    (b"x-accel-buffering", b"no")]})
+            if codificador:
+                # Com ESTADO_BACKEND=redis a leitura do estado bloqueia: roda fora do event loop
+                estados = await asyncio.to_thread(nuvem.estados_iniciais, dispositivos)
+                quadro_inicial = codificador.snapshot(
+                    estados, resync=b"last-event-id" in dict(scope.get("headers", [])))
+                await send({"type": "http.response.body", "body": quadro_inicial.encode("utf-8"), "more_body": True})
+            while not desconexao.done():
+                proximo = asyncio.create_task(assinante.obter())
+                await asyncio.wait({proximo, desconexao}, timeout=nuvem.SSE_KEEPALIVE_SEGUNDOS,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if proximo.done() and not codificador:
+                    trecho = nuvem.formatar_evento_sse(proximo.result())
+                elif proximo.done():
+                    # Junta a rajada que chegar dentro da janela em um único quadro
+                    await asyncio.sleep(nuvem.SSE_COALESCER_SEGUNDOS)
+                    trecho = codificador.delta([proximo.result()] + assinante.drenar())
+                    if not trecho:
+                        continue
+                else:
+                    proximo.cancel()
+                    if desconexao.done():
+                        break
+                    trecho = ": keep-alive\n\n"  # Comentário SSE para manter a conexão viva
+                await send({"type": "http.response.body", "body": trecho.encode("utf-8"), "more_body": True})
+        except OSError:
+            pass  # cliente desconectou durante o envio
+        finally:
+            desconexao.cancel()
+            nuvem.live_broadcaster.cancelar(assinante)
+            nuvem.app.logger.info("Cliente SSE (ASGI) desconectado.")
+
+    # ATUALIZAÇÕES AO VIVO da borda
+    async def receber_live_update(self, scope, receive, send):
+        corpo = await ler_corpo(receive)
+        if corpo is None:
+            return
+        try:
+            # GET/SET/PUBLISH no redis são bloqueantes: não podem travar os streams abertos
+            await asyncio.to_thread(nuvem.registrar_live_update, json.loads(corpo))
+        except Exception as e:
+            nuvem.app.logger.error(f"Erro ao processar live update: {e}")
+            await responder_json(send, 400, {"error": "Erro ao processar live update"})
+            return
+        await responder_json(send, 200, {"message": "Live update recebido"})
+
+    async def reivindicar_comandos(self, device_id, lease):
+        if lease:
+            resultado = await self.colecao_comandos.update_many(*nuvem.montar_desistencia(device_id))
+            nuvem.registrar_desistencia(device_id, resultado.modified_count)
+        filtro, atualizacao = nuvem.montar_reivindicacao(device_id, lease)
+        comandos_reivindicados = []
+        for _ in range(nuvem.COMANDOS_POR_ENTREGA):
+            cmd_doc = await self.colecao_comandos.find_one_and_update(
+                filtro, atualizacao,
+                sort=[("created_at", ASCENDING)],
+                return_document=ReturnDocument.AFTER)
+            if not cmd_doc:
+                break
+            if 'comando' in cmd_doc:
+                comandos_reivindicados.append(cmd_doc)
+        return nuvem.formatar_comandos_reivindicados(device_id, comandos_reivindicados, lease)
+
+    # Long-poll dos comandos da borda
+    async def aguardar_comandos(self, scope, receive, send):
+        params = parse_qs(scope.get("query_string", b"").decode())
+        device_id = params.get("device_id", [None])[0]
+        if not device_id:
+            await responder_json(send, 400, {"error": "device_id é obrigatório"})
+            return
+        if self.colecao_comandos is None:
+            await responder_json(send, 500, {"error": "Conexão com o banco de dados indisponível"})
+            return
+        try:
+            timeout = min(max(float(params.get("timeout", [25])[0]), 0), nuvem.COMANDOS_LONGPOLL_MAXIMO)
+        except ValueError:
+            await responder_json(send, 400, {"error": "timeout inválido"})
+            return
+        lease = params.get("ack", [""])[0].lower() in ('1', 'true', 'sim')
+
+        loop = asyncio.get_running_loop()
+        novo_comando = asyncio.Event()
+
+        def acordar():
+            try:
+                loop.call_soon_threadsafe(novo_comando.set)
+            except RuntimeError:
+                pass
+
+        # Registra antes da primeira consulta para não perder um comando enfileirado entre as duas
+        nuvem.notificador_comandos.ouvir(device_id, acordar)
+        try:
+            comandos_para_enviar = await self.reivindicar_comandos(device_id, lease)
+            fim = loop.time() + timeout
+            while not comandos_para_enviar:
+                restante = fim - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(novo_comando.wait(), restante)
+                except asyncio.TimeoutError:
+                    break
+                novo_comando.clear()
+                comandos_para_enviar = await self.reivindicar_comandos(device_id, lease)
+        except Exception as e:
+            nuvem.app.logger.error(f"Erro ao aguardar comandos no MongoDB: {e}")
+            await responder_json(send, 500, {"error": "Erro ao buscar comandos"})
+            return
+        finally:
+            nuvem.notificador_comandos.deixar_de_ouvir(device_id, acordar)
+        await responder_json(send, 200, comandos_para_enviar)
+
+
+app_asgi = AppAsgi(nuvem.app)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.getenv("PORT", 8080))
+    nuvem.app.logger.info(f"Iniciando servidor ASGI na porta {port}")
+    uvicorn.run("nuvem_asgi:app_asgi", host='0.0.0.0', port=port,
+                workers=int(os.getenv("WEB_CONCURRENCY", 1)), proxy_headers=True,
+                timeout_keep_alive=int(os.getenv("KEEP_ALIVE_SEGUNDOS", 75)))
@@ -46,7 +46,7 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 
 function buscarUltimoEstadoAtuador(){
-    fetch('/api/estado_atual')
+    fetch(`/api/estado_atual?device_id=${encodeURIComponent(DEVICE_ID)}`)
       .then(response => response.json())
       .then(data => {
         if (data.estado_atuadores) {
@@ -54,13 +54,7 @@ function buscarUltimoEstadoAtuador(){
         }
       })
       .catch(err => console.error('Erro ao obter estado atual:', err));
-
-    // Conecta ao stream SSE
-    const eventSource = new EventSource('/stream');
-    eventSource.addEventListener('live_leitura', function(event) {
-        const data = JSON.parse(event.data);
-        atualizar_interface_com_estado(data.estado_atuadores);
-    });
+    // As atualizações seguintes chegam pelo stream SSE (conectarStreamAoVivo)
 }
 
 function buscarUltimaLeitura() {
@@ -191,36 +185,100 @@ function atualizar_interface_com_estado(estadoAtuadores) {
 
 
 // --- Conectar ao Stream SSE para Leituras Ao Vivo ---
-if (!!window.EventSource) {
-    const source = new EventSource('/stream');
+// Usa o protocolo delta: um 'snapshot' com o estado completo ao conectar e depois 'delta'
+// só com os campos alterados. Cada delta diz a versão do estado sobre a qual foi calculado
+// ('base'); se não for a versão local (ou 'seq' pular), reconecta para receber um snapshot novo.
+let estadoAoVivo = null;
+let ultimoSeq = 0;
+let streamAoVivo = null;
+
+const CAMPOS_DE_CONTROLE = ['device_id', 'base', 'versao', 'removidos'];
+
+function aplicarDelta(estado, delta) {
+    const novo = Object.assign({}, estado, { versao: delta.versao });
+    for (const [chave, valor] of Object.entries(delta)) {
+        if (CAMPOS_DE_CONTROLE.includes(chave)) continue;
+        if (chave === 'estado_atuadores' && valor !== null && typeof valor === 'object') {
+            novo.estado_atuadores = Object.assign({}, estado.estado_atuadores || {}, valor);
+        } else {
+            novo[chave] = valor;
+        }
+    }
+    for (const caminho of delta.removidos || []) {
+        const [chave, subchave] = caminho.split('.', 2);
+        if (subchave === undefined) {
+            delete novo[chave];
+        } else if (novo[chave]) {
+            novo[chave] = Object.assign({}, novo[chave]);
+            delete novo[chave][subchave];
+        }
+    }
+    return novo;
+}
 
-    source.addEventListener('live_leitura', function(event) {
-        console.log("Dados SSE (live_leitura):", event.data);
-        const leitura = JSON.parse(event.data);
+function mostrarLeituraAoVivo(leitura) {
+    const timestamp = new Date(leitura.timestamp).toLocaleString('pt-BR');
+    const item = document.createElement('li');
 
-        if (leitura.device_id === DEVICE_ID) {
-            const timestamp = new Date(leitura.timestamp).toLocaleString('pt-BR');
-            const item = document.createElement('li');
+    let estadoAtuadoresLidos = leitura.estado_atuadores || {};
+    let estadoAtuadoresStr = Object.entries(estadoAtuadoresLidos)
+                                 .map(([key, value]) => `${key.replace('estado', '')}: ${value}`)
+                                 .join(', ');
 
-            let estadoAtuadoresLidos = leitura.estado_atuadores || {};
-            let estadoAtuadoresStr = Object.entries(estadoAtuadoresLidos)
-                                         .map(([key, value]) => `${key.replace('estado', '')}: ${value}`)
-                                         .join(', ');
+    item.textContent = `[${timestamp}] Temp: ${leitura.temperatura}°C, Umi: ${leitura.umidade === 0 ? 'Molhado' : 'Seco'} (${leitura.umidade}), Lum: ${leitura.luminosidade} | Atuadores: ${estadoAtuadoresStr || 'N/A'}`;
 
-            item.textContent = `[${timestamp}] Temp: ${leitura.temperatura}°C, Umi: ${leitura.umidade === 0 ? 'Molhado' : 'Seco'} (${leitura.umidade}), Lum: ${leitura.luminosidade} | Atuadores: ${estadoAtuadoresStr || 'N/A'}`;
+    if (listaLeiturasUl.firstChild && listaLeiturasUl.firstChild.textContent.includes('Aguardando')) {
+        listaLeiturasUl.innerHTML = '';
+    }
+    listaLeiturasUl.insertBefore(item, listaLeiturasUl.firstChild);
+    while (listaLeiturasUl.children.length > 15) {
+        listaLeiturasUl.removeChild(listaLeiturasUl.lastChild);
+    }
 
-            if (listaLeiturasUl.firstChild && listaLeiturasUl.firstChild.textContent.includes('Aguardando')) {
-                listaLeiturasUl.innerHTML = '';
-            }
-            listaLeiturasUl.insertBefore(item, listaLeiturasUl.firstChild);
-            while (listaLeiturasUl.children.length > 15) {
-                listaLeiturasUl.removeChild(listaLeiturasUl.lastChild);
-            }
+    // Atualizar UI dos botões e status
+    atualizar_interface_com_estado(estadoAtuadoresLidos);
+    setEstadoCarregamento(false);
+}
 
-            // Atualizar UI dos botões e status
-            atualizar_interface_com_estado(estadoAtuadoresLidos);
-            setEstadoCarregamento(false);
+function conectarStreamAoVivo() {
+    if (streamAoVivo) streamAoVivo.close();
+    const source = new EventSource(`/stream?device_id=${encodeURIComponent(DEVICE_ID)}&protocolo=delta`);
+    streamAoVivo = source;
+
+    source.addEventListener('snapshot', function(event) {
+        const snapshot = JSON.parse(event.data);
+        ultimoSeq = snapshot.seq;
+        estadoAoVivo = snapshot.dispositivos.find(d => d.device_id === DEVICE_ID) || null;
+        if (estadoAoVivo && estadoAoVivo.estado_atuadores) {
+            atualizar_interface_com_estado(estadoAoVivo.estado_atuadores);
+        }
+    });
+
+    source.addEventListener('delta', function(event) {
+        console.log("Dados SSE (delta):", event.data);
+        const quadro = JSON.parse(event.data);
+        if (quadro.seq !== ultimoSeq + 1) {
+            console.warn(`Sequência SSE pulou de ${ultimoSeq} para ${quadro.seq}. Ressincronizando...`);
+            conectarStreamAoVivo();
+            return;
+        }
+        ultimoSeq = quadro.seq;
 
+        // Dispositivo que apareceu depois do snapshot chega completo
+        for (const dispositivo of quadro.dispositivos || []) {
+            if (dispositivo.device_id !== DEVICE_ID) continue;
+            estadoAoVivo = dispositivo;
+            mostrarLeituraAoVivo(estadoAoVivo);
+        }
+        for (const delta of quadro.deltas) {
+            if (delta.device_id !== DEVICE_ID) continue;
+            if (!estadoAoVivo || estadoAoVivo.versao !== delta.base) {
+                console.warn(`Delta sobre a versão ${delta.base}, estado local na ${estadoAoVivo && estadoAoVivo.versao}. Ressincronizando...`);
+                conectarStreamAoVivo();
+                return;
+            }
+            estadoAoVivo = aplicarDelta(estadoAoVivo, delta);
+            mostrarLeituraAoVivo(estadoAoVivo);
         }
     });
 
@@ -236,6 +294,10 @@ if (!!window.EventSource) {
             listaLeiturasUl.innerHTML = '<li>Erro na conexão para dados ao vivo. Verifique o console.</li>';
         }
     };
+}
+
+if (!!window.EventSource) {
+    conectarStreamAoVivo();
 } else {
     console.warn("Seu navegador não suporta Server-Sent Events.");
     listaLeiturasUl.innerHTML = '<li>Seu navegador não suporta atualizações ao vivo.</li>';
@@ -383,7 +445,13 @@ async function solicitarRelatorio() {
         const resultado = await response.json();
         if (response.ok) {
             console.log(`Solicitação de relatório enviada! Mensagem: ${resultado.message}`);
-            alert("Relatório enviado com sucesso!");
+            // O relatório é gerado em segundo plano; acompanha o job até terminar
+            const job = await aguardarJobRelatorio(resultado.job_id);
+            if (job.status === 'enviado') {
+                alert("Relatório enviado com sucesso!");
+            } else {
+                alert("Erro ao enviar relatório: " + (job.erro || job.status));
+            }
         } else {
             console.log(`Erro ao solicitar relatório: ${resultado.error || response.status}`);
             alert("Erro ao enviar relatório: " + (resultado.error || response.status));
@@ -399,6 +467,23 @@ async function solicitarRelatorio() {
     }
 }
 
+async function aguardarJobRelatorio(jobId) {
+    const prazo = Date.now() + 120000; // desiste de acompanhar após 2 minutos
+    while (Date.now() < prazo) {
+        const response = await fetch(`/api/relatorios/${jobId}`);
+        const job = await response.json();
+        if (!response.ok) {
+            // Job não encontrado ou erro no servidor: a resposta traz só {"error": ...}
+            return { status: 'falhou', erro: job.error || `HTTP ${response.status}` };
+        }
+        if (job.status === 'enviado' || job.status === 'falhou') {
+            return job;
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+    return { status: 'em processamento', erro: 'O relatório ainda está sendo gerado. Verifique seu e-mail em instantes.' };
+}
+
 function verificarTwitchStream() {
     const videoContainer = document.getElementById('video-container');
     const twitchEmbedDiv = document.getElementById('twitch-embed');
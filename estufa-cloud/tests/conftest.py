@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def nuvem():
+    # nuvem.py conecta no MongoDB ao ser importado; nos testes o cliente é o mongomock
+    mongomock = pytest.importorskip("mongomock")
+    import pymongo.mongo_client
+    pymongo.mongo_client.MongoClient = mongomock.MongoClient
+    os.environ.setdefault("MONGO_URI_PROD", "mongodb://localhost/testes")
+    os.environ["ESTADO_BACKEND"] = "local"
+    import nuvem
+    return nuvem
@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("asgiref")
+
+
+def test_lifespan_fecha_cliente_mongo(nuvem, monkeypatch):
+    import nuvem_asgi
+    monkeypatch.setattr(nuvem, "ingestao_leituras", None)
+    app = nuvem_asgi.AppAsgi(nuvem.app)
+    enviados = []
+
+    async def ciclo():
+        mensagens = asyncio.Queue()
+        await mensagens.put({"type": "lifespan.startup"})
+        await mensagens.put({"type": "lifespan.shutdown"})
+
+        async def send(mensagem):
+            enviados.append(mensagem["type"])
+            if mensagem["type"] == "lifespan.startup.complete":
+                assert app.cliente_mongo is not None
+
+        await app({"type": "lifespan"}, mensagens.get, send)
+
+    asyncio.run(ciclo())
+
+    assert enviados == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    assert app.cliente_mongo is None and app.colecao_comandos is None
@@ -0,0 +1,23 @@
+import time
+
+
+def test_inativo_nao_e_servido_antes_da_remocao(nuvem):
+    backend = nuvem.BackendLocal(inativo_segundos=60)
+    agora = time.time()
+    backend.salvar_estado({"device_id": "parado", "visto_em": agora - 120})
+    backend.salvar_estado({"device_id": "ativo", "visto_em": agora})
+
+    assert backend.obter_estado("parado") is None
+    assert backend.obter_estado()["device_id"] == "ativo"
+    assert [e["device_id"] for e in backend.listar_estados()] == ["ativo"]
+    assert backend.remover_inativos(agora - 60) == ["parado"]
+
+
+def test_estado_atual_ignora_dispositivo_inativo(nuvem, monkeypatch):
+    backend = nuvem.BackendLocal(inativo_segundos=60)
+    backend.salvar_estado({"device_id": "parado", "visto_em": time.time() - 120})
+    monkeypatch.setattr(nuvem, "backend_estado", backend)
+
+    resposta = nuvem.app.test_client().get("/api/estado_atual?device_id=parado")
+
+    assert resposta.status_code == 404
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def test_assinatura_so_comeca_ao_iniciar(nuvem):
+    backend = nuvem.BackendRedis(cliente=fakeredis.FakeRedis())
+    recebidos = []
+    chegou = threading.Event()
+    backend.inscrever("live", lambda dados: (recebidos.append(dados), chegou.set()))
+    assert backend._thread is None  # inscrever (no import) não cria a thread
+
+    backend.iniciar()
+    thread = backend._thread
+    backend.iniciar()
+    assert backend._thread is thread
+
+    # A mensagem publicada antes do SUBSCRIBE se perde; repete até a thread assinar
+    limite = time.monotonic() + 5
+    while not chegou.wait(0.05) and time.monotonic() < limite:
+        backend.publicar("live", {"device_id": "e1", "temperatura": 20.0})
+    assert recebidos[0] == {"device_id": "e1", "temperatura": 20.0}
+
+
+def test_estado_compartilhado(nuvem):
+    redis = fakeredis.FakeRedis()
+    escritor = nuvem.BackendRedis(cliente=redis, inativo_segundos=60)
+    leitor = nuvem.BackendRedis(cliente=redis, inativo_segundos=60)
+    agora = time.time()
+
+    escritor.salvar_estado({"device_id": "e1", "temperatura": 20.0, "visto_em": agora - 30})
+    escritor.salvar_estado({"device_id": "e2", "temperatura": 22.0, "visto_em": agora})
+
+    assert leitor.obter_estado()["device_id"] == "e2"
+    assert leitor.remover_inativos(agora - 10) == ["e1"]
+    assert [e["device_id"] for e in leitor.listar_estados()] == ["e2"]
+
+
+def test_inativo_nao_e_servido_antes_da_remocao(nuvem):
+    backend = nuvem.BackendRedis(cliente=fakeredis.FakeRedis(), inativo_segundos=60)
+    backend.salvar_estado({"device_id": "e1", "visto_em": time.time() - 120})
+
+    assert backend.obter_estado("e1") is None
+    assert backend.obter_estado() is None
+    assert backend.listar_estados() == []
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import requests
+
+
+class ConsultaFalsa:
+    # Faz o papel do ClienteTwitch; cada consulta espera 'liberar' e devolve 'status' ou levanta 'erro'
+    def __init__(self, status):
+        self.status = status
+        self.erro = None
+        self.chamadas = 0
+        self.liberar = threading.Event()
+        self.liberar.set()
+
+    def consultar_status(self):
+        self.chamadas += 1
+        self.liberar.wait(5)
+        if self.erro:
+            raise self.erro
+        return self.status
+
+
+def esperar(condicao, limite=5):
+    fim = time.monotonic() + limite
+    while not condicao() and time.monotonic() < fim:
+        time.sleep(0.01)
+    assert condicao()
+
+
+def test_primeira_carga_simultanea_consulta_uma_vez(nuvem):
+    consulta = ConsultaFalsa({"is_live": True, "user_name": "estufa"})
+    consulta.liberar.clear()
+    cache = nuvem.CacheTwitch(consulta, ttl=60)
+    respostas = []
+    threads = [threading.Thread(target=lambda: respostas.append(cache.obter())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    esperar(lambda: consulta.chamadas == 1)
+    consulta.liberar.set()
+    for t in threads:
+        t.join()
+
+    assert consulta.chamadas == 1
+    assert respostas == [({"is_live": True, "user_name": "estufa"}, 200)] * 8
+
+
+def test_vencido_devolve_o_antigo_enquanto_atualiza(nuvem):
+    consulta = ConsultaFalsa({"is_live": False})
+    cache = nuvem.CacheTwitch(consulta, ttl=60)
+    assert cache.obter() == ({"is_live": False}, 200)
+
+    cache._valido_ate = 0  # TTL venceu
+    consulta.status = {"is_live": True, "user_name": "estufa"}
+    consulta.liberar.clear()
+    assert cache.obter() == ({"is_live": False}, 200)  # não espera a Twitch
+    assert cache.obter() == ({"is_live": False}, 200)
+    esperar(lambda: consulta.chamadas == 2)
+    consulta.liberar.set()
+
+    esperar(lambda: cache.obter()[0]["is_live"])
+    assert consulta.chamadas == 2  # uma única atualização em segundo plano
+
+
+def test_falha_na_atualizacao_mantem_o_ultimo_status(nuvem):
+    consulta = ConsultaFalsa({"is_live": True, "user_name": "estufa"})
+    cache = nuvem.CacheTwitch(consulta, ttl=60, ttl_erro=60)
+    cache.obter()
+
+    cache._valido_ate = 0
+    consulta.erro = requests.exceptions.ConnectionError("Twitch fora do ar")
+    assert cache.obter() == ({"is_live": True, "user_name": "estufa"}, 200)
+    esperar(lambda: not cache._atualizando)
+
+    # Mantém o valor bom e só tenta de novo depois de ttl_erro
+    assert cache.obter() == ({"is_live": True, "user_name": "estufa"}, 200)
+    assert consulta.chamadas == 2
+
+
+def test_falha_sem_valor_anterior_responde_503(nuvem):
+    consulta = ConsultaFalsa(None)
+    consulta.erro = requests.exceptions.Timeout("timeout")
+    cache = nuvem.CacheTwitch(consulta, ttl=60, ttl_erro=60)
+
+    corpo, status_http = cache.obter()
+
+    assert status_http == 503
+    assert corpo["is_live"] is False
+    assert cache.obter() == (corpo, status_http)
+    assert consulta.chamadas == 1
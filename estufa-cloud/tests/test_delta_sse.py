@@ -0,0 +1,40 @@
+import json
+
+
+def ler_quadro(quadro):
+    linhas = dict(linha.split(": ", 1) for linha in quadro.strip().split("\n"))
+    return linhas["event"], json.loads(linhas["data"])
+
+
+def test_diferenca_separa_removidos_de_null(nuvem):
+    anterior = {"device_id": "e1", "temperatura": 20.0, "umidade": 1,
+                "estado_atuadores": {"estadoLampada": "ON", "estadoIrrigador": "OFF"}}
+    novo = {"device_id": "e1", "temperatura": None,
+            "estado_atuadores": {"estadoLampada": "OFF"}, "visto_em": 123}
+
+    diff, removidos = nuvem.diferenca_estado(anterior, novo)
+
+    assert diff == {"temperatura": None, "estado_atuadores": {"estadoLampada": "OFF"}}
+    assert sorted(removidos) == ["estado_atuadores.estadoIrrigador", "umidade"]
+
+
+def test_delta_leva_base_e_versao(nuvem):
+    codificador = nuvem.CodificadorDeltaSSE()
+    _, snapshot = ler_quadro(codificador.snapshot([{"device_id": "e1", "temperatura": 20.0}]))
+    assert snapshot["dispositivos"][0]["versao"] == 1
+
+    _, quadro = ler_quadro(codificador.delta([{"device_id": "e1", "temperatura": 21.0}]))
+
+    assert quadro["seq"] == 2
+    assert quadro["deltas"] == [{"device_id": "e1", "temperatura": 21.0, "base": 1, "versao": 2}]
+    assert codificador.delta([{"device_id": "e1", "temperatura": 21.0}]) is None
+
+
+def test_dispositivo_novo_chega_completo(nuvem):
+    codificador = nuvem.CodificadorDeltaSSE()
+    codificador.snapshot([])
+
+    _, quadro = ler_quadro(codificador.delta([{"device_id": "e2", "temperatura": 19.0, "visto_em": 1}]))
+
+    assert quadro["deltas"] == []
+    assert quadro["dispositivos"] == [{"device_id": "e2", "temperatura": 19.0, "versao": 1}]
@@ -0,0 +1,48 @@
+import datetime
+
+import mongomock
+import pytest
+
+
+@pytest.fixture
+def colecao(nuvem, monkeypatch):
+    colecao = mongomock.MongoClient()["EstufaBD"]["ComandosTable"]
+    monkeypatch.setattr(nuvem, "colecao_comandos", colecao)
+    monkeypatch.setattr(nuvem, "COMANDOS_ENTREGAS_MAXIMAS", 2)
+    return colecao
+
+
+def vencer_leases(colecao):
+    vencido = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    colecao.update_many({"status": "enviado"}, {"$set": {"lease_ate": vencido}})
+
+
+def test_comando_sem_ack_e_reentregue_ate_o_limite(nuvem, colecao):
+    colecao.insert_one({"device_id": "e1", "comando": "toggleLampada_ON", "status": "pendente",
+                        "created_at": datetime.datetime.utcnow()})
+
+    assert [c["comando"] for c in nuvem.reivindicar_comandos("e1", lease=True)] == ["toggleLampada_ON"]
+    assert nuvem.reivindicar_comandos("e1", lease=True) == []  # lease em vigor
+    vencer_leases(colecao)
+    assert len(nuvem.reivindicar_comandos("e1", lease=True)) == 1  # segunda entrega
+    vencer_leases(colecao)
+    assert nuvem.reivindicar_comandos("e1", lease=True) == []
+
+    comando = colecao.find_one()
+    assert comando["status"] == "falhou"
+    assert comando["entregas"] == 2
+    assert comando["concluido_em"] is not None
+    assert "lease_ate" not in comando
+
+
+def test_comando_confirmado_nao_falha(nuvem, colecao):
+    colecao.insert_one({"device_id": "e1", "comando": "toggleLampada_ON", "status": "pendente",
+                        "created_at": datetime.datetime.utcnow()})
+    comando = nuvem.reivindicar_comandos("e1", lease=True)[0]
+
+    resposta = nuvem.app.test_client().post("/api/comandos/ack", json={"device_id": "e1", "ids": [comando["id"]]})
+    vencer_leases(colecao)
+    nuvem.reivindicar_comandos("e1", lease=True)
+
+    assert resposta.get_json() == {"confirmados": 1}
+    assert colecao.find_one()["status"] == "confirmado"
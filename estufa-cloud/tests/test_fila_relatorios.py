@@ -0,0 +1,89 @@
+import datetime
+import threading
+
+import mongomock
+import pytest
+
+
+class TransporteFalso:
+    def __init__(self, falhar=False):
+        self.falhar = falhar
+        self.enviados = []
+
+    def enviar(self, email, assunto, html):
+        if self.falhar:
+            raise RuntimeError("SendGrid fora do ar")
+        self.enviados.append(email)
+        return 202
+
+
+@pytest.fixture
+def fila(nuvem, monkeypatch):
+    monkeypatch.setattr(nuvem, "criar_relatorio_nuvem_completo", lambda janela, device_id: ("<p>ok</p>", "Relatório"))
+    monkeypatch.setattr(nuvem, "RELATORIO_TENTATIVAS", 1)
+    fila = nuvem.FilaRelatorios(mongomock.MongoClient()["EstufaBD"]["RelatoriosTable"], TransporteFalso())
+    fila.criar_indices()
+    return fila
+
+
+def test_pedido_identico_reaproveita_o_job(fila):
+    job, novo = fila.enfileirar("a@x.com", "ultimos_10", "e1")
+    repetido, repetido_novo = fila.enfileirar("a@x.com", "ultimos_10", "e1")
+    outro, outro_novo = fila.enfileirar("a@x.com", "ultimos_10", "e2")
+
+    assert novo and not repetido_novo and outro_novo
+    assert repetido["_id"] == job["_id"]
+    assert outro["_id"] != job["_id"]
+
+
+def test_pedidos_simultaneos_criam_um_job(fila):
+    resultados = []
+    barreira = threading.Barrier(8)
+
+    def pedir():
+        barreira.wait()
+        resultados.append(fila.enfileirar("a@x.com", "ultimos_10", None))
+
+    threads = [threading.Thread(target=pedir) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len({job["_id"] for job, _ in resultados}) == 1
+    assert sum(novo for _, novo in resultados) == 1
+    assert fila.colecao.count_documents({}) == 1
+
+
+def test_chave_liberada_apos_falha_e_fora_da_janela(fila, nuvem):
+    job, _ = fila.enfileirar("a@x.com", "ultimos_10", "e1")
+    fila.transporte.falhar = True
+    fila._processar(fila._reivindicar())
+    assert fila.obter(job["_id"])["status"] == "falhou"
+
+    fila.transporte.falhar = False
+    segundo, novo = fila.enfileirar("a@x.com", "ultimos_10", "e1")
+    assert novo
+    fila._processar(fila._reivindicar())
+    assert fila.obter(segundo["_id"])["status"] == "enviado"
+    assert not fila.enfileirar("a@x.com", "ultimos_10", "e1")[1]
+
+    # Enviado há mais que RELATORIO_DEDUP_SEGUNDOS: um pedido novo gera outro job
+    antigo = datetime.datetime.utcnow() - datetime.timedelta(seconds=nuvem.RELATORIO_DEDUP_SEGUNDOS + 1)
+    fila.colecao.update_one({"_id": segundo["_id"]}, {"$set": {"concluido_em": antigo}})
+    assert fila.enfileirar("a@x.com", "ultimos_10", "e1")[1]
+
+
+def test_lease_vencido_volta_para_a_fila(fila):
+    job, _ = fila.enfileirar("a@x.com", "ultimos_10", "e1")
+    assert fila._reivindicar()["_id"] == job["_id"]
+    assert fila._reivindicar() is None  # lease em vigor: ninguém mais pega
+
+    # Worker morreu no meio do job e o lease venceu
+    vencido = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    fila.colecao.update_one({"_id": job["_id"]}, {"$set": {"lease_ate": vencido}})
+    retomado = fila._reivindicar()
+
+    assert retomado["_id"] == job["_id"]
+    assert retomado["status"] == "processando"
+    assert retomado["lease_ate"] > datetime.datetime.utcnow()
@@ -0,0 +1,36 @@
+import datetime
+
+import mongomock
+import pytest
+
+
+@pytest.fixture
+def leituras(nuvem, monkeypatch):
+    colecao = mongomock.MongoClient()["EstufaBD"]["LeiturasTable"]
+    monkeypatch.setattr(nuvem, "colecao_leituras", colecao)
+    monkeypatch.setattr(nuvem, "HISTORICO_PONTOS_MAXIMO", 1)  # até 10 pontos raw
+    inicio = datetime.datetime(2026, 1, 1)
+    colecao.insert_many([{"device_id": "e1", "timestamp": inicio + datetime.timedelta(minutes=i),
+                          "temperatura": 20.0 + i} for i in range(12)])
+    return inicio
+
+
+def historico(nuvem, inicio, minutos):
+    fim = inicio + datetime.timedelta(minutes=minutos)
+    return nuvem.app.test_client().get(
+        f"/api/historico?device_id=e1&resolution=raw&from={inicio.isoformat()}&to={fim.isoformat()}").get_json()
+
+
+def test_raw_sinaliza_corte(nuvem, leituras):
+    resposta = historico(nuvem, leituras, 60)
+
+    assert resposta["truncado"] is True
+    assert len(resposta["pontos"]) == 10
+    assert resposta["pontos"][-1]["temperatura"] == 29.0
+
+
+def test_raw_completo_nao_sinaliza(nuvem, leituras):
+    resposta = historico(nuvem, leituras, 10)
+
+    assert resposta["truncado"] is False
+    assert len(resposta["pontos"]) == 10